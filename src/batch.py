@@ -0,0 +1,210 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# This script runs the entire pipeline for many contact pairs without asking anything. As input, it
+# needs a manifest csv file with one contact pair per row, containing at least the columns input and
+# contact_rp. The columns resolution, threshold, central, contact, labels and stream are optional.
+# The pairs are divided over a pool of processes, a pair that fails does not stop the others. The
+# results of each pair are appended to the directionality results file of its central group, and
+# to a results file next to the manifest.
+#
+# Author: Natasja Wezel
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+import argparse
+import contextlib
+import os
+import sys
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+sys.path.append(".//scripts")
+
+from classes.Settings import AlignmentSettings
+
+from constants.paths import WORKDIR_MAIN
+from constants.constants import STANDARD_RES, STANDARD_THRESHOLD
+
+from align_kabsch import split_file_if_too_big
+from quantify import run_pipeline
+
+# the values of the stream column that are understood, an empty cell means False
+STREAM_VALUES = {'true': True, 'yes': True, 'y': True, '1': True, '1.0': True,
+                 'false': False, 'no': False, 'n': False, '0': False, '0.0': False, '': False}
+
+RESULT_COLUMNS = ['input', 'central', 'contact', 'contact_rp', 'resolution', 'threshold', 'status', 'datapoints',
+                  'datafrac', 'Vcluster', 'Vavailable', 'directionality', 'time_align', 'time_model',
+                  'time_coordinates', 'time_density', 'time_stream', 'time_volume', 'time_total', 'reused', 'error']
+
+
+def main():
+    parser = initiate_parser()
+    args = parser.parse_args()
+
+    manifest = read_manifest(args.manifest)
+
+    results_filename = args.manifest.rsplit('.', 1)[0] + "_results.csv"
+
+    t0 = time.time()
+    results = run_batch(manifest, results_filename, args.workers)
+    t1 = time.time() - t0
+
+    failed = results[results.status != 'done']
+    print(f"\nDone: {len(results) - len(failed)}/{len(results)} pairs in {t1 :.2f} s. Results in {results_filename}")
+
+    for _, pair in failed.iterrows():
+        print(f"Failed: {pair.input} ({pair.contact_rp}): {pair.error}")
+
+
+def read_manifest(filename):
+    """ Reads the manifest and fills in the default values of the optional columns. """
+
+    manifest = pd.read_csv(filename, comment="#", skipinitialspace=True)
+
+    missing = {'input', 'contact_rp'} - set(manifest.columns)
+    if len(missing) > 0:
+        print(f"batch.py: error: the manifest misses the column(s): {', '.join(sorted(missing))}")
+        sys.exit(1)
+
+    defaults = {'resolution': STANDARD_RES, 'threshold': STANDARD_THRESHOLD, 'central': None, 'contact': None,
+                'labels': None, 'stream': False}
+
+    for column, default in defaults.items():
+        if column not in manifest.columns:
+            manifest[column] = default
+
+    manifest = manifest.astype(object).where(manifest.notnull(), None)
+    manifest['resolution'] = manifest.resolution.fillna(STANDARD_RES).astype(float)
+    manifest['threshold'] = manifest.threshold.fillna(STANDARD_THRESHOLD).astype(float)
+    manifest['stream'] = read_stream_column(manifest.stream)
+
+    return manifest
+
+
+def read_stream_column(column):
+    """ Translates the stream column to booleans. Unknown values stop the batch, so a pair never runs in a mode that
+        was not asked for. """
+
+    values = column.map(lambda value: '' if value is None else str(value).strip().lower())
+    unknown = sorted(set(values) - set(STREAM_VALUES))
+
+    if len(unknown) > 0:
+        print(f"batch.py: error: unknown value(s) in the column stream: {', '.join(unknown)} (use yes or no)")
+        sys.exit(1)
+
+    return values.map(STREAM_VALUES).astype(bool)
+
+
+def run_batch(manifest, results_filename, workers=1):
+    """ Runs all pairs of the manifest in a pool of workers, and saves the results as soon as they are done. Pairs
+        with the same input file share their result folder, so they are run one after the other by the same worker.
+        Returns the results of all pairs. """
+
+    groups = [group.to_dict('records') for _, group in
+              manifest.groupby(['input', 'central', 'contact'], sort=False, dropna=False)]
+    results = []
+
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(run_pairs, pairs): pairs for pairs in groups}
+
+        for future in as_completed(futures):
+            pairs = futures[future]
+
+            try:
+                group_results = future.result()
+            except Exception as error:
+                # the worker process itself stopped, so the pairs did not even get to report their error
+                group_results = [{'input': pair['input'], 'contact_rp': pair['contact_rp'], 'status': 'failed',
+                                  'error': repr(error)} for pair in pairs]
+
+            for result in group_results:
+                save_result(result, results_filename)
+                results.append(result)
+
+                print(f"[{len(results)}/{len(manifest)}] {result['status']}: {result['input']} " +
+                      f"({result['contact_rp']})")
+
+    return pd.DataFrame(results).reindex(columns=RESULT_COLUMNS)
+
+
+def run_pairs(pairs):
+    """ Runs pairs that share their input file one after the other. """
+
+    return [run_pair(pair) for pair in pairs]
+
+
+def run_pair(pair):
+    """ Runs the pipeline for one pair. The output of the pipeline is written to a log file in the results folder of
+        the pair. Errors are caught and returned as part of the result, so one pair can't stop the batch. """
+
+    t0 = time.time()
+    result = {'input': pair['input'], 'contact_rp': pair['contact_rp'], 'status': 'failed', 'error': ''}
+
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            settings = make_pair_settings(pair)
+
+        result['results_filename'] = settings.get_directionality_results_filename()
+
+        with open(settings.outputfile_prefix + "_batch.log", 'w') as logfile, contextlib.redirect_stdout(logfile):
+            result.update(run_pipeline(settings, stream=pair['stream']))
+
+        result['status'] = 'done'
+    except (Exception, SystemExit) as error:
+        result['error'] = ''.join(traceback.format_exception_only(type(error), error)).strip()
+
+    result['time_total'] = time.time() - t0
+
+    return result
+
+
+def make_pair_settings(pair):
+    """ Makes the settings of one pair of the manifest, like quantify.py does with its arguments. """
+
+    if pair['central'] is not None and pair['contact'] is not None:
+        settings = AlignmentSettings(WORKDIR=WORKDIR_MAIN, coordinate_file=pair['input'], central=pair['central'],
+                                     contact=pair['contact'])
+    else:
+        settings = AlignmentSettings(WORKDIR=WORKDIR_MAIN, coordinate_file=pair['input'])
+
+    if pair['labels'] is not None:
+        settings.set_label_file(pair['labels'])
+
+    settings.set_contact_reference_point(str(pair['contact_rp']).upper())
+    settings.set_resolution(pair['resolution'])
+    settings.set_threshold(pair['threshold'])
+
+    split_file_if_too_big(settings.coordinate_file, settings.no_atoms)
+    settings.update_coordinate_filename()
+
+    return settings
+
+
+def save_result(result, results_filename):
+    """ Appends the result to the results file of the batch and, if the settings of the pair could be made, to the
+        directionality results file of its central group. """
+
+    row = pd.DataFrame([result]).reindex(columns=RESULT_COLUMNS)
+
+    filenames = [results_filename]
+    if result.get('results_filename') is not None:
+        filenames.append(result['results_filename'])
+
+    for filename in filenames:
+        row.to_csv(filename, index=False, mode='a', header=not os.path.exists(filename))
+
+
+def initiate_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('manifest', help='csv file with one contact pair per row, with the columns input and\
+                        contact_rp, and optionally resolution, threshold, central, contact, labels and stream')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='amount of pairs that is run at the same time\
+                        (default 1)')
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@
 # Author: Natasja Wezel
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 import argparse
+import os
 import sys
 
 import pandas as pd
@@ -15,23 +16,21 @@ sys.path.append(".//scripts")
 
 from classes.LoadArgsFromFile import LoadArgsFromFile
 from classes.Settings import AlignmentSettings
-from classes.Radii import Radii
+from classes.AlignedFragments import AlignedFragments
+from classes.DensityGrid import DensityGrid
+from classes.Session import Session
+from classes.StageCache import StageCache
+from classes.Profiler import Profiler
 
 from constants.paths import WORKDIR_MAIN
 from constants.colors import COLORS
 
-from helpers.plot_functions import plot_fragments
-
 from align_kabsch import split_file_if_too_big, align_all_fragments
-from plot_density import make_density_plot
-from scripts.plot_avg_fragment import plot_avg_fragment
 from calc_avg_fragment import calc_avg_frag
-from plot_contact_atoms import make_contact_rps_plot
-from plot_fingerprint import make_fingerprint_plots
 
-from density_slider import make_density_slider_plot
+from stream_density import stream_density
 
-from helpers.density_helpers import make_density_df, find_available_volume
+from helpers.density_helpers import make_density_df, make_density_grids
 from helpers.geometry_helpers import make_coordinate_df
 
 from constants.constants import STANDARD_RES, STANDARD_THRESHOLD, STANDARD_EXTRA_VDW
@@ -46,57 +45,179 @@ def main():
     args = check_args(parser)
     settings = make_settings_with_args(args)
 
-    # Pipeline step 1: Align all fragments
-    aligned_df = align_all_fragments(settings)
-
-    # Pipeline step 2-3: Central group model
-    radii = Radii(settings.get_radii_csv_name())
-    central_model = calc_avg_frag(aligned_df, settings, radii)
-    central_model.to_csv(settings.get_avg_frag_filename(), index=False)
-
-    # Pipeline step 4: Distance contact atom/center to the model
-    coordinate_df = make_coordinate_df(aligned_df, settings, central_model, radii)
+    # the data of the pipeline stays in memory for the plots
+    session = Session(settings)
+    results = run_pipeline(settings, stream=args.stream, session=session)
 
-    # Pipeline step 5: Density calculation
-    density_df = make_density_df(settings, coordinate_df)
-    density_df['datafrac_normalized'] = density_df[settings.contact_rp] / density_df[settings.contact_rp].sum()
-
-    # Pipeline step 6: Volumes
-    tolerance = 0.5
-    contact_group_radius = radii.get_vdw_distance_contact(settings.contact_rp)
-    Vavailable = find_available_volume(avg_fragment=central_model, extra=(tolerance + contact_group_radius))
-    threshold_calc = density_df.datafrac_normalized.max() * settings.threshold
-    in_cluster = density_df[density_df.datafrac_normalized >= threshold_calc]
-
-    datafrac = in_cluster.datafrac_normalized.sum()
-    Vcluster = len(in_cluster) * settings.resolution**3
-
-    # Pipeline step 7: Directionality
-    directionality = datafrac / Vcluster * (Vavailable/2)
     print(f"The directionality of {settings.central_name}--{settings.contact_name} ({settings.contact_rp}) is\
-            {directionality}\n")
+            {results['directionality']}\n")
+
+    # the plots need the aligned fragments, which are not saved when streaming
+    if args.stream:
+        print_epilog()
+        return
 
     # when done running, give option menu
     print_menu()
     possible_inputs = [1, 2, 3, 4, 5, 6, 7]
     option = ask_int_input("What do you want to plot?", possible_inputs)
     while not option == 7:
-        perform_option(option, settings)
+        perform_option(option, session)
         print_menu()
         option = ask_int_input("What do you want to plot?", possible_inputs)
 
     print_epilog()
 
 
-def perform_option(option, settings):
-    # do something
+def run_pipeline(settings, stream=False, session=None):
+    """ Runs step 1 to 7 of the pipeline for one contact pair without asking anything, so it can also be used for
+        batches of pairs. Returns a dictionary with the results and the duration of each step in seconds. If a
+        session is given, everything that is made or loaded is kept in it. """
+
+    if session is None:
+        session = Session(settings)
+
+    # the duration of each step is the wall time its stages added to the profiler, loading a reused stage is not counted
+    profiler = settings.profiler
+    timings = {}
+    radii = session.get_radii()
+
+    # the stages of which the inputs and parameters did not change since the last run are loaded instead of made
+    stage_cache = StageCache(settings)
+
+    if stream:
+        # Pipeline step 1-5: align the fragments in chunks, without saving them, and make the model and density
+        wall_time = profiler.get_wall_time()
+        if stage_cache.is_valid('stream'):
+            central_model = pd.read_csv(settings.get_avg_frag_filename())
+            density_grid = DensityGrid.read_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
+            stage_cache.reuse('stream')
+        else:
+            central_model, density_grid = stream_density(settings, radii)
+            stage_cache.add_stage('stream', [(settings.get_avg_frag_filename(), None),
+                                             (settings.get_structure_csv_filename(), None),
+                                             (settings.get_density_df_filename(), settings.get_density_df_key())])
+        timings['time_stream'] = profiler.get_wall_time() - wall_time
+    else:
+        # Pipeline step 1: Align all fragments
+        wall_time = profiler.get_wall_time()
+        # an alignment that was stopped halfway is not complete, and is done again
+        if stage_cache.is_valid('align') and AlignedFragments(settings).exists():
+            aligned_fragments = align_all_fragments(settings)
+            stage_cache.reuse('align')
+        else:
+            aligned_fragments = align_all_fragments(settings, again=True)
+            stage_cache.add_stage('align', [(filename, None) for filename in aligned_fragments.get_filenames().values()]
+                                  + [(settings.get_structure_csv_filename(), None)])
+        timings['time_align'] = profiler.get_wall_time() - wall_time
+
+        # Pipeline step 2-3: Central group model
+        wall_time = profiler.get_wall_time()
+        if stage_cache.is_valid('model'):
+            central_model = pd.read_csv(settings.get_avg_frag_filename())
+            stage_cache.reuse('model')
+        else:
+            central_model = calc_avg_frag(aligned_fragments.get_central_groups(), settings, radii)
+            central_model.to_csv(settings.get_avg_frag_filename(), index=False)
+            stage_cache.add_stage('model', [(settings.get_avg_frag_filename(), None)])
+        timings['time_model'] = profiler.get_wall_time() - wall_time
+
+        # Pipeline step 4: Distance contact atom/center to the model, the fragments are read part by part
+        wall_time = profiler.get_wall_time()
+        valid = stage_cache.is_valid('coordinates')
+        coordinate_df = make_coordinate_df(aligned_fragments.iterate_parts(), settings, central_model, radii,
+                                           again=not valid)
+        if valid:
+            stage_cache.reuse('coordinates')
+        else:
+            stage_cache.add_stage('coordinates', [(settings.get_coordinate_df_filename(),
+                                                   settings.get_coordinate_df_key())])
+        timings['time_coordinates'] = profiler.get_wall_time() - wall_time
+
+        # Pipeline step 5: Density calculation
+        wall_time = profiler.get_wall_time()
+        valid = stage_cache.is_valid('density')
+        density_grid = make_density_df(settings, coordinate_df, again=not valid)
+        if valid:
+            stage_cache.reuse('density')
+        else:
+            stage_cache.add_stage('density', [(settings.get_density_df_filename(), settings.get_density_df_key())])
+        timings['time_density'] = profiler.get_wall_time() - wall_time
+
+        session.set_aligned_fragments(aligned_fragments)
+        session.set_coordinate_df(coordinate_df)
+
+    session.set_central_model(central_model)
+    session.add_density_grid(density_grid)
+
+    print("Stages of this run:")
+    stage_cache.print_last_run()
+    print()
+
+    # Pipeline step 6: Volumes
+    wall_time = profiler.get_wall_time()
+    with profiler.stage('volume'):
+        Vavailable = session.get_available_volume()
+    timings['time_volume'] = profiler.get_wall_time() - wall_time
+
+    # Pipeline step 7: Directionality, of every threshold at once so the density slider can look its values up
+    with profiler.stage('directionality'):
+        datafrac, Vcluster, directionality = session.get_directionality_curve().loc[settings.threshold]
+
+    results = {'central': settings.central_name,
+               'contact': settings.contact_name,
+               'contact_rp': settings.contact_rp,
+               'resolution': settings.resolution,
+               'threshold': settings.threshold,
+               'datapoints': density_grid.get_total(),
+               'datafrac': datafrac,
+               'Vcluster': Vcluster,
+               'Vavailable': Vavailable,
+               'directionality': directionality,
+               'reused': " ".join(stage_cache.get_reused())}
+    results.update(timings)
+
+    save_profile_report(settings, results)
+
+    return results
+
+
+def save_profile_report(settings, results):
+    """ Prints the measurements of the stages that were run and saves them next to the results, together with the
+        size of the input, so runs on different datasets can be compared. """
+
+    info = {key: results[key] for key in ['central', 'contact', 'contact_rp', 'resolution', 'threshold',
+                                          'datapoints', 'reused']}
+    info['input'] = {filename: os.path.getsize(filename) for filename in settings.coordinate_files}
+    info['no_atoms'] = settings.no_atoms_file
+    info['workers'] = settings.workers
+
+    print("Time and memory per stage:")
+    settings.profiler.print_report()
+    print()
+
+    settings.profiler.save(settings.get_profile_filename(), info)
+
+
+def perform_option(option, session):
+    """ Makes the plot of the option. All data comes from the session, so it is only read the first time it is
+        needed. """
+
+    settings = session.settings
+
+    # the plotting modules import matplotlib, which takes long, so they are only imported when a plot is asked for
     if option == 1:
-        data = pd.read_csv(settings.get_aligned_csv_filename())
-        max_frags = len(data.fragment_id.unique())
+        from helpers.plot_functions import plot_fragments
+
+        aligned_fragments = session.get_aligned_fragments()
+        max_frags = aligned_fragments.get_no_fragments()
         possible_inputs = range(0, max_frags + 1)
         amount = ask_int_input("How many superimposed fragments would you like to plot?\n(Recommended < 100)\n",
                                possible_inputs)
 
+        # only the fragments that are plotted are read
+        data = aligned_fragments.to_dataframe(last=amount)
+
         default = "Y"
         only_central = ask_bool_input("Do you want to plot the contact groups as well? [Y]\\N\n", default)
         print()
@@ -105,6 +226,8 @@ def perform_option(option, settings):
             data = data[data.label != "-"]
         plot_fragments(data, amount, COLORS)
     elif option == 2:
+        from scripts.plot_avg_fragment import plot_avg_fragment
+
         default = "Y"
         only_central = ask_bool_input("Do you want to plot the labels as well? [Y]\\N\n", default)
 
@@ -112,42 +235,58 @@ def perform_option(option, settings):
         if "y" in only_central.lower():
             labels = True
         
-        plot_avg_fragment(settings, labels)
+        plot_avg_fragment(session, labels)
     elif option == 3:
-        df = pd.read_csv(settings.get_aligned_csv_filename(), header=0)
-        avg_frag = pd.read_csv(settings.outputfile_prefix + "_avg_fragment.csv", header=0)
-        make_fingerprint_plots(df, avg_frag, settings, STANDARD_EXTRA_VDW)
+        from plot_fingerprint import make_fingerprint_plots
+
+        make_fingerprint_plots(session, STANDARD_EXTRA_VDW)
         print()
     elif option == 4:
-        avg_fragment = pd.read_csv(settings.get_avg_frag_filename())
-        density_df = pd.read_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
-        make_density_plot(avg_fragment, density_df, settings)
-    elif option == 5:
-        df = pd.read_csv(settings.get_aligned_csv_filename())
+        from plot_density import make_density_plot
 
-        avg_fragment = pd.read_csv(settings.get_avg_frag_filename())
-
-        radii = Radii(settings.get_radii_csv_name())
-        coordinate_df = make_coordinate_df(df, settings, avg_fragment, radii)
+        make_density_plot(session)
+    elif option == 5:
+        from plot_contact_atoms import make_contact_rps_plot
 
-        make_contact_rps_plot(avg_fragment, coordinate_df, settings)
+        make_contact_rps_plot(session)
     elif option == 6:
+        from density_slider import make_density_slider_plot
+
         default = "Y"
         confimation = ask_bool_input("The program still has to calculate non-standard resolutions." +
                                      "This may take some time. Do you want to continue? [Y]\\N\n", default)
         print()
         if (confimation.lower() == "y"):
-            alligned_df = pd.read_csv(settings.get_aligned_csv_filename())
-            central_model = pd.read_csv(settings.get_avg_frag_filename())
-            radii = Radii(settings.get_radii_csv_name())
-            coordinate_df = make_coordinate_df(alligned_df, settings, central_model, radii)
-            for res in np.arange(0.2, 1.05, 0.05):
-                settings.set_resolution(res)
-                make_density_df(settings, coordinate_df)
+            coordinate_df = session.get_coordinate_df()
+
+            # grids that were made with other inputs than the current coordinates are made again, the grids that are
+            # already in the session are not read again
+            stage_cache = StageCache(settings)
+            resolutions, again = [], []
+            for resolution in np.arange(0.2, 1.05, 0.05):
+                settings.set_resolution(resolution)
+                if not stage_cache.is_valid('density'):
+                    again.append(settings.resolution)
+                elif session.has_density_grid():
+                    continue
+                resolutions.append(resolution)
+
+            density_grids = make_density_grids(settings, coordinate_df, resolutions, again=again)
+
+            for resolution, density_grid in density_grids.items():
+                settings.set_resolution(resolution)
+                if resolution in again:
+                    stage_cache.add_stage('density', [(settings.get_density_df_filename(),
+                                                       settings.get_density_df_key())])
+                else:
+                    stage_cache.reuse('density')
+
+            # the grids that were just made are given to the slider, so it doesn't have to read them again
+            for density_grid in density_grids.values():
+                session.add_density_grid(density_grid)
 
             settings.set_resolution(STANDARD_RES)
-            avg_fragment = pd.read_csv(settings.get_avg_frag_filename())
-            make_density_slider_plot(avg_fragment, settings)
+            make_density_slider_plot(session)
 
 
 def ask_bool_input(message, default):
@@ -237,6 +376,10 @@ def make_settings_with_args(args):
         pass
     if args.output is not None:
         pass
+    if args.workers is not None:
+        settings.set_workers(args.workers)
+    if args.profile is not None:
+        settings.set_profile_stage(args.profile)
 
     settings.set_contact_reference_point(args.contact_rp.upper())
     settings.set_resolution(STANDARD_RES)
@@ -289,6 +432,11 @@ def initiate_parser():
                           splitted on underscores)')
     optional.add_argument('-o', '--output', help='prefix of the outputfile (default CENTRAL_CONTACT)')
     optional.add_argument('-vdw', '--vanderwaals', help='used van der waals tolerance (default 0.5)')
+    optional.add_argument('-w', '--workers', type=int, help='amount of processes used for the alignment (default 1)')
+    optional.add_argument('-s', '--stream', action='store_true', help='align and calculate the density chunk by chunk\
+                          without saving the aligned fragments, for files that do not fit in memory (no plots)')
+    optional.add_argument('-p', '--profile', choices=Profiler.STAGES, help='profile one stage of the pipeline with\
+                          cProfile, the statistics are saved next to the time and memory report of all stages')
 
     return parser
 
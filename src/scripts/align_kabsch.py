@@ -3,28 +3,31 @@
 # thesis in the Master Computational Science, University of Amsterdam, 2021.
 #
 # `align_kabsch.py` loads the coordinates of the fragments exported from a conquest query and aligns the central groups
-# with the kabsch algorithm. It then saves the new coordinates in a .csv file.
+# with the kabsch algorithm. It then saves the new coordinates in binary files and in a .csv file.
 #
 # Author: Natasja Wezel
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
+import contextlib
+import json
 import sys
 import os
-import time
 
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
 import numpy as np
 
 from classes.Settings import AlignmentSettings
+from classes.AlignedFragments import AlignedFragments
 from constants.paths import WORKDIR
-from constants.constants import MAX_DATAFILE_SIZE
-from tqdm import tqdm
+from constants.constants import MAX_DATAFILE_SIZE, ALIGNMENT_BATCH_SIZE, SPLIT_ROW_LIMIT
 
-from helpers.general_helpers import split
+from helpers.general_helpers import split, hash_file
 
-from helpers.alignment_helpers import (calc_rmse, kabsch_align,
+from helpers.alignment_helpers import (calc_rmse_all, kabsch_align_all,
                                        perform_rotations, perform_translation,
-                                       read_raw_data)
+                                       read_raw_data, iterate_raw_data)
 
 
 def main():
@@ -33,8 +36,6 @@ def main():
         print("Usage: python load_from_coords.py <path/to/coordinatefile>")
         sys.exit(1)
 
-    t0 = time.time()
-
     coordinate_file = sys.argv[1]
 
     settings = AlignmentSettings(WORKDIR, coordinate_file)
@@ -42,69 +43,186 @@ def main():
     split_file_if_too_big(settings.coordinate_file, settings.no_atoms)
     settings.update_coordinate_filename()
 
-    align_all_fragments(settings)
+    aligned_fragments = align_all_fragments(settings)
 
-    t1 = time.time() - t0
+    # also save the aligned fragments as csv, for use outside of this program
+    aligned_fragments.to_csv(settings.get_aligned_csv_filename())
 
-    print("Duration: %.2f s." % t1)
+    settings.profiler.print_report()
 
 
 def align_all_fragments(settings, to_mirror=True, again=False):
-    # get filenames
-    aligned_csv_filename, structures_csv_filename = settings.get_aligned_csv_filenames()
+    """ Aligns the fragments of all parts of the coordinate file onto the first fragment of the first part, and saves
+        them in the binary aligned fragments files. Only one part is in memory at the same time. Returns the aligned
+        fragments, memory-mapped from the saved files. """
+
+    aligned_fragments = AlignedFragments(settings)
+    structures_csv_filename = settings.get_structure_csv_filename()
 
     # check if already aligned
-    if not again and os.path.exists(aligned_csv_filename):
+    if not again and aligned_fragments.exists():
         print("The fragments are already aligned")
-        return pd.read_csv(aligned_csv_filename)
+        return aligned_fragments.load()
+
+    for part, (data, structures) in enumerate(iterate_aligned_parts(settings, to_mirror)):
+        if part == 0:
+            aligned_fragments.create(settings.label_list, settings.no_atoms_central)
+
+        with settings.profiler.stage('write'):
+            # save the structures as csv and the fragments in the binary files, the parts after the first are appended
+            mode, header = ('w', True) if part == 0 else ('a', False)
+            structures.to_csv(structures_csv_filename, index=False, mode=mode, header=header)
+
+            coordinates = data[['x', 'y', 'z']].to_numpy().reshape(len(structures), settings.no_atoms, 3)
+            aligned_fragments.append(coordinates, data.symbol, data._id)
+
+        settings.profiler.add_items('write', len(structures))
+
+    # only now the fragments are complete, if the alignment stops before this they are aligned again the next time
+    aligned_fragments.finish()
+
+    return aligned_fragments.load()
+
+
+def iterate_aligned_parts(settings, to_mirror=True, chunk_size=None):
+    """ Aligns the fragments of all parts of the coordinate file onto the first fragment of the first part, and
+        yields the aligned data and the structures of one part at a time. If a chunk size is given, the parts are
+        read and aligned in chunks of that amount of fragments instead. The reference fragment is always the first
+        fragment, so the fragments are aligned the same way for every chunk size. """
+
+    first_fragment = None
+    total_fragments = 0
+    profiler = settings.profiler
+
+    for part, coordinate_file in enumerate(settings.coordinate_files):
+        if len(settings.coordinate_files) > 1:
+            print(f"Aligning part {part + 1}/{len(settings.coordinate_files)}")
+
+        if chunk_size is None:
+            chunks = (read_raw_data(coordinate_file, settings.no_atoms_file) for _ in range(1))
+        else:
+            chunks = iterate_raw_data(coordinate_file, settings.no_atoms_file, chunk_size)
+
+        for data, structures in profiler.iterate('read', chunks):
+            profiler.add_items('read', len(structures))
+
+            with profiler.stage('align'):
+                # give the fragments their ids and labels, and bin atoms to be binned
+                settings, no_fragments, data = prepare_data(settings, data, first_fragment_id=total_fragments)
+
+                # the first fragment of the first part is the reference for the fragments of all parts
+                start = 0 if first_fragment is not None else 1
+                parallel = use_workers(settings, no_fragments, start)
+
+                # restructure df to matrix, in shared memory if the workers align it
+                with make_coordinate_matrix(len(data), parallel) as (data_matrix, shared_name):
+                    data_matrix[:, 0], data_matrix[:, 1], data_matrix[:, 2] = data.x, data.y, data.z
+
+                    if first_fragment is None:
+                        structures, data_matrix, first_fragment = rotate_first_fragment(settings, data_matrix,
+                                                                                        structures, to_mirror)
+
+                    # align all fragments
+                    structures, data_matrix = do_kabsch_align(settings, data_matrix, structures, first_fragment,
+                                                              to_mirror, start, shared_name)
 
-    # TODO: count files
-    data, structures, data_matrix, first_fragment = rotate_first_fragment(settings, to_mirror)
+                    # put back into df, which copies the coordinates out of the matrix
+                    data.x, data.y, data.z = data_matrix.T
+                    del data_matrix
 
-    # align all fragments
-    structures, data_matrix = do_kabsch_align(settings, data_matrix, structures, first_fragment, to_mirror)
+            profiler.add_items('align', no_fragments)
+            total_fragments += no_fragments
 
-    # put back into df
-    data_matrix = data_matrix.T
-    x_vec, y_vec, z_vec = data_matrix[0], data_matrix[1], data_matrix[2]
-    data.x, data.y, data.z = x_vec, y_vec, z_vec
+            yield data, structures
 
-    # reindex the data to a more readable format
-    data = data.reindex(['fragment_id', '_id', 'symbol', 'label', 'x', 'y', 'z'], axis=1)
+    settings.set_no_fragments(total_fragments)
 
-    # save as csv
-    structures.to_csv(structures_csv_filename, index=False)
-    data.to_csv(aligned_csv_filename, index=False)
 
-    return data
+def get_fragments_per_part(no_atoms):
+    """ Returns the amount of fragments that is put in one part when a coordinate file is split. """
+
+    # each fragment has no_atoms + 1 header line
+    return int(SPLIT_ROW_LIMIT // (no_atoms + 1))
 
 
 # TODO: move too settings class
 def split_file_if_too_big(filename, no_atoms):
+    """ Splits the coordinate file into parts if it is too big. The size, modification time and hash of the file
+        that was split are saved next to the parts, so when the file changes, the old parts are removed and the file
+        is split again. """
+
     # do a filesize check
     filesize = os.path.getsize(filename)
 
-    # if file bigger than max size, split it into several files
-    if filesize > MAX_DATAFILE_SIZE:
-        print("Splitting original datafile...")
-        output_name_template = filename.rsplit('.', 1)[0] + '_%s.' + filename.rsplit('.', 1)[1]
+    output_name_template = filename.rsplit('.', 1)[0] + '_%s.' + filename.rsplit('.', 1)[1]
+
+    if filesize <= MAX_DATAFILE_SIZE:
+        return
+
+    # if file bigger than max size, split it into several files, if that did not happen before with the same file
+    if os.path.exists(output_name_template % 1) and is_split_up_to_date(filename):
+        return
+
+    remove_split_parts(output_name_template)
+
+    print("Splitting original datafile...")
+
+    # split after fragments
+    row_limit = get_fragments_per_part(no_atoms) * (no_atoms + 1)
+
+    # splits if file is too big
+    with open(filename) as inputfile:
+        split(inputfile, delimiter=',', row_limit=row_limit, output_name_template=output_name_template,
+              output_path='.')
+
+    # only saved when the split is done, so a split that was stopped halfway is done again
+    save_split_record(filename)
+
+
+def get_split_record_filename(filename):
+    return filename.rsplit('.', 1)[0] + '_split.json'
+
+
+def save_split_record(filename):
+    stat = os.stat(filename)
+
+    with open(get_split_record_filename(filename), 'w') as outputfile:
+        json.dump({'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': hash_file(filename)}, outputfile)
+
+
+def is_split_up_to_date(filename):
+    """ Checks whether the parts were made from the file as it is now. The file is only hashed again when its
+        modification time changed but its size did not. """
+
+    try:
+        with open(get_split_record_filename(filename)) as inputfile:
+            record = json.load(inputfile)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+
+    stat = os.stat(filename)
+
+    if record['size'] != stat.st_size:
+        return False
+    if record['mtime'] == stat.st_mtime_ns:
+        return True
+    if record['hash'] != hash_file(filename):
+        return False
 
-        # split after fragments, each fragment has no_atoms + 1 header line
-        row_limit = 6e6 - (6e6 % (no_atoms + 1))
+    # the file was only touched, remember its new modification time
+    save_split_record(filename)
 
-        # splits if file is too big
-        split(open(filename), delimiter=',', row_limit=row_limit,
-              output_name_template=output_name_template, output_path='.')
+    return True
 
 
-def rotate_first_fragment(settings, to_mirror):
-    data, structures = read_raw_data(settings.coordinate_file, settings.no_atoms)
+def remove_split_parts(output_name_template):
+    part = 1
+    while os.path.exists(output_name_template % part):
+        os.remove(output_name_template % part)
+        part += 1
 
-    # bin atoms to be binned
-    settings, fragments, data = prepare_data(settings, data)
 
-    # restructure df to matrix
-    data_matrix = np.array([np.array(data.x), np.array(data.y), np.array(data.z)]).T
+def rotate_first_fragment(settings, data_matrix, structures, to_mirror):
     A = data_matrix[:settings.no_atoms]
 
     # translate and rotate first fragment onto the origin as for nice viewing
@@ -120,9 +238,9 @@ def rotate_first_fragment(settings, to_mirror):
 
     data_matrix[:settings.no_atoms] = A
 
-    A = data_matrix[0:settings.no_atoms_central]
+    A = data_matrix[0:settings.no_atoms_central].copy()
 
-    return data, structures, data_matrix, A
+    return structures, data_matrix, A
 
 
 def mirror(matrix):
@@ -136,62 +254,180 @@ def mirror(matrix):
     return False, matrix
 
 
-def do_kabsch_align(settings, data_matrix, structures, A, to_mirror):
+def use_workers(settings, no_fragments, start=1):
+    """ Returns whether the fragments are aligned by several worker processes, which is only worth it if there is
+        more than one batch. """
+
+    return settings.workers > 1 and no_fragments - start > ALIGNMENT_BATCH_SIZE
+
+
+@contextlib.contextmanager
+def make_coordinate_matrix(no_rows, shared):
+    """ Yields an empty matrix of shape (rows, 3) for the coordinates of a part, and the name of its shared memory.
+        If shared, the matrix is made in shared memory, so the alignment workers can align it in place. The matrix
+        can not be used after the with block, so every reference to it has to be deleted before the end. """
+
+    if not shared:
+        yield np.empty((no_rows, 3)), None
+        return
+
+    shared_memory = SharedMemory(create=True, size=no_rows * 3 * np.dtype('float64').itemsize)
+
+    try:
+        yield np.ndarray((no_rows, 3), dtype='float64', buffer=shared_memory.buf), shared_memory.name
+    finally:
+        try:
+            shared_memory.close()
+        except BufferError:
+            # the matrix is still referenced after an error, the memory is freed when it is garbage collected
+            pass
+        shared_memory.unlink()
+
+
+def do_kabsch_align(settings, data_matrix, structures, A, to_mirror, start=1, shared_name=None):
+    """ Aligns the fragments in data_matrix, a C-contiguous matrix of shape (rows, 3), in place. If the matrix is in
+        shared memory, its name is given, and the workers align it without copying. """
+
     no_atoms = settings.no_atoms
     no_atoms_central = settings.no_atoms_central
+    no_fragments = settings.get_no_fragments()
+
+    # view the data as one matrix per fragment, so the aligned fragments are written into data_matrix
+    assert data_matrix.flags.c_contiguous, "The coordinates have to be one C-contiguous matrix to align in place"
+    fragments = data_matrix.reshape(no_fragments, no_atoms, 3)
 
-    n = A.shape[0]
+    rmse = np.zeros(no_fragments)
+    mirrored = structures.mirrored.to_numpy(dtype=bool, copy=True)
 
     print("Applying Kabsch Algorithm...")
-    for i in tqdm(range(1, settings.get_no_fragments())):
-        B_central = data_matrix[i * no_atoms:no_atoms_central + i * no_atoms]
-        B_total = data_matrix[i * no_atoms: (i + 1) * no_atoms]
 
-        # run kabsch, shift frame in data each time
-        B_total = kabsch_align(A, B_central, B_total, n)
+    # starting after the fragments that are already in place
+    if use_workers(settings, no_fragments, start):
+        align_batches_parallel(fragments, rmse, mirrored, A, no_atoms_central, to_mirror, start, settings.workers,
+                               shared_name)
+    else:
+        align_batches(fragments, rmse, mirrored, A, no_atoms_central, to_mirror, start, no_fragments)
+
+    structures['rmse'] = rmse
+    structures['mirrored'] = mirrored
+
+    return structures, data_matrix
+
+
+def align_batches(fragments, rmse, mirrored, A, no_atoms_central, to_mirror, start, stop):
+    """ Aligns fragments start up to stop in place, in batches so the temporary arrays stay small. The batches always
+        start at start + a multiple of the batch size, so every fragment is aligned in the same batch as it would be
+        in the serial alignment. """
+
+    for first in range(start, stop, ALIGNMENT_BATCH_SIZE):
+        last = min(first + ALIGNMENT_BATCH_SIZE, stop)
+        B_total = fragments[first:last]
+
+        B_total = kabsch_align_all(A, B_total[:, :no_atoms_central], B_total)
 
         if to_mirror:
-            mirrored, B_total = mirror(B_total)
+            mirrored[first:last], B_total = mirror_all(B_total)
 
-            if mirrored:
-                structures.loc[structures.index == i, 'mirrored'] = True
+        # calculate error and put back into overall matrix
+        rmse[first:last] = calc_rmse_all(A, B_total[:, :no_atoms_central])
+        fragments[first:last] = B_total
 
-        # calculate and save error
-        rmse = calc_rmse(A, B_total[:no_atoms_central], n)
-        structures.loc[structures.index == i, 'rmse'] = rmse
 
-        # put back into overall matrix
-        data_matrix[i * no_atoms: (i + 1) * no_atoms] = B_total
+def align_batches_parallel(fragments, rmse, mirrored, A, no_atoms_central, to_mirror, start, workers,
+                           shared_name=None):
+    """ Divides the batches into contiguous ranges, one for each worker. The fragments are already in the shared
+        memory with shared_name, so the workers align their range in place and the fragments are never copied. Only
+        the small rmses and mirror flags are copied to and from shared memory, as are the fragments if they are not
+        shared yet. Since the batches are the same as in the serial alignment, so are the results. """
 
-    return structures, data_matrix
+    arrays = [rmse, mirrored] if shared_name is not None else [fragments, rmse, mirrored]
+    shared_memories = [SharedMemory(create=True, size=array.nbytes) for array in arrays]
+
+    try:
+        shared_arrays = []
+        for array, shared_memory in zip(arrays, shared_memories):
+            shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=shared_memory.buf)
+            shared_array[:] = array
+            shared_arrays.append(shared_array)
 
+        descriptions = [(shared_memory.name, array.shape, array.dtype.str)
+                        for array, shared_memory in zip(arrays, shared_memories)]
 
-def prepare_data(settings, data):
+        if shared_name is not None:
+            descriptions.insert(0, (shared_name, fragments.shape, fragments.dtype.str))
+
+        # give each worker a contiguous range of whole batches
+        batch_starts = list(range(start, len(fragments), ALIGNMENT_BATCH_SIZE))
+        ranges = [(batches[0], min(batches[-1] + ALIGNMENT_BATCH_SIZE, len(fragments)))
+                  for batches in np.array_split(batch_starts, min(workers, len(batch_starts)))]
+
+        with ProcessPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(align_shared_batches, descriptions, A, no_atoms_central, to_mirror, first, last)
+                       for first, last in ranges]
+
+            for future in futures:
+                future.result()
+
+        for array, shared_array in zip(arrays, shared_arrays):
+            array[:] = shared_array
+
+        del shared_arrays, shared_array
+    finally:
+        for shared_memory in shared_memories:
+            shared_memory.close()
+            shared_memory.unlink()
+
+
+def align_shared_batches(descriptions, A, no_atoms_central, to_mirror, start, stop):
+    """ Runs in a worker process: attaches to the shared fragments, rmses and mirror flags, and aligns a range. """
+
+    shared_memories = [SharedMemory(name=name) for name, _, _ in descriptions]
+
+    try:
+        fragments, rmse, mirrored = [np.ndarray(shape, dtype=dtype, buffer=shared_memory.buf)
+                                     for (_, shape, dtype), shared_memory in zip(descriptions, shared_memories)]
+
+        align_batches(fragments, rmse, mirrored, A, no_atoms_central, to_mirror, start, stop)
+
+        del fragments, rmse, mirrored
+    finally:
+        for shared_memory in shared_memories:
+            shared_memory.close()
+
+
+def mirror_all(fragments):
+    """ Mirrors every fragment in a stack of fragments of which the mean of z is negative. """
+
+    mirrored = fragments[:, :, 2].mean(axis=1) < 0
+
+    # mirror by switching signs of z coordinate
+    fragments[mirrored, :, 2] *= -1
+
+    return mirrored, fragments
+
+
+def prepare_data(settings, data, first_fragment_id=0):
     amount_rows = len(data)
 
     # calc amount of fragments
-    no_fragments = int(amount_rows / settings.no_atoms)
+    no_fragments = int(amount_rows / settings.no_atoms_file)
 
     settings.set_no_fragments(no_fragments)
 
     # give each fragment a unique id
-    fragment_ids = range(0, no_fragments)
-    fragment_ids = np.repeat(fragment_ids, settings.no_atoms)
+    fragment_ids = range(first_fragment_id, first_fragment_id + no_fragments)
+    fragment_ids = np.repeat(fragment_ids, settings.no_atoms_file)
     data['fragment_id'] = fragment_ids
 
     # give each atom in each fragment their label from conquest
-    labels = settings.label_list * no_fragments
+    labels = settings.label_list_file * no_fragments
     data['label'] = labels
 
     # TODO: decide if you want to give the posibility of ignoring atoms during alignment
     # Then you would have to also add them again later.
     if settings.alignment['bin'] != '-':
         print(f"Throwing away {len(settings.alignment['bin'])} atoms.")
-        settings.no_atoms -= len(settings.alignment['bin'])
-        settings.no_atoms_central -= len(settings.alignment['bin'])
-
-        for label in settings.alignment['bin']:
-            settings.label_list.remove(label)
+        settings.bin_atoms()
 
         data = data[~data.label.isin(settings.alignment['bin'])].reset_index()
 
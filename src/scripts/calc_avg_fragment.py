@@ -12,12 +12,12 @@ import pandas as pd
 
 from classes.Settings import Settings
 from classes.Radii import Radii
-from helpers.geometry_helpers import average_fragment, add_model_methyl
-from helpers.alignment_helpers import calc_rmse
+from classes.AlignedFragments import AlignedFragments
+from helpers.geometry_helpers import (average_fragment, add_model_methyl, count_atoms_per_fragment,
+                                     assign_atoms_to_centers)
+from helpers.alignment_helpers import calc_rmse_all
 
-from constants.constants import RMSE_TEST
-
-from sklearn.cluster import KMeans
+from constants.constants import RMSE_TEST, READ_CHUNK_SIZE, MAX_LABEL_ITERATIONS
 
 from constants.paths import WORKDIR
 
@@ -33,7 +33,7 @@ def main():
     inputfilename = sys.argv[1]
 
     avg_frag_settings = Settings(WORKDIR, inputfilename)
-    df = pd.read_csv(avg_frag_settings.get_aligned_csv_filename(), header=0)
+    df = AlignedFragments(avg_frag_settings).load().get_central_groups()
 
     # make radii object to get vdw radii
     radii = Radii(avg_frag_settings.get_radii_csv_name())
@@ -46,23 +46,45 @@ def main():
 
 
 def calc_avg_frag(df, avg_frag_settings, radii):
-    fragment = average_fragment(df, avg_frag_settings, radii)
+    profiler = avg_frag_settings.profiler
+
+    with profiler.stage('average'):
+        fragment = average_fragment(df, avg_frag_settings, radii)
+
+        # test
+        calc_kabsch_rmse(avg_frag_settings)
+        rmses = calc_avg_rmse(fragment, *get_central_coordinates(df))
 
-    # test
-    calc_kabsch_rmse(avg_frag_settings)
-    rmse_avg = calc_avg_rmse(fragment, avg_frag_settings)
+    profiler.add_items('average', df.fragment_id.nunique())
 
     # dependent on rmses, do kmeans or not
-    if rmse_avg > RMSE_TEST:
+    if rmses.mean() > RMSE_TEST:
         print("RMSEs too high. Resetting labels using KMeans")
-        df = reset_labels_with_kmeans(df, avg_frag_settings)
 
-        # sort df based on new labels
-        df = df.sort_values(['fragment_id', 'kmeans_label'])
+        with profiler.stage('k-means'):
+            df = reset_labels_with_kmeans(df, avg_frag_settings)
+
+        profiler.add_items('k-means', df.fragment_id.nunique())
+
+        with profiler.stage('average'):
+            # sort df based on new labels
+            df = df.sort_values(['fragment_id', 'kmeans_label'])
+
+            fragment = average_fragment(df, avg_frag_settings, radii)
+
+            rmses = calc_avg_rmse(fragment, *get_central_coordinates(df, 'kmeans_label'), 'kmeans_label')
+
+    with profiler.stage('average'):
+        fragment = add_model_methyl_if_needed(fragment, avg_frag_settings, radii)
+
+    with profiler.stage('write'):
+        save_model_rmses(avg_frag_settings, rmses)
+
+    return fragment
 
-        fragment = average_fragment(df, avg_frag_settings, radii)
 
-        rmse_avg = calc_avg_rmse(fragment, avg_frag_settings, df)
+def add_model_methyl_if_needed(fragment, avg_frag_settings, radii):
+    """ Adds the hydrogens of a methyl group to the model, if the central group is in the methyl model file. """
 
     if avg_frag_settings.central_name in list(pd.read_csv(avg_frag_settings.get_methyl_csv_filename(),
                                               header=0, comment="#").central):
@@ -73,22 +95,33 @@ def calc_avg_frag(df, avg_frag_settings, radii):
 
 
 def reset_labels_with_kmeans(df, avg_frag_settings):
+    """ Gives the atoms of the central groups new labels, with k-means in which every fragment gets every label
+        exactly once. The centers start at the atoms of the first fragment. The atoms of each fragment are assigned to
+        the centers with the lowest total squared distance, and the centers move to the mean of their atoms, until the
+        labels do not change anymore. """
+
     # only keep central group
     df = df[df.label != "-"].copy().reset_index()
 
-    first_frag = df[df.fragment_id == 0]
-    no_atoms_central = len(first_frag)
+    no_atoms_central = count_atoms_per_fragment(df)
+    coordinates = np.ascontiguousarray(df[['x', 'y', 'z']].to_numpy(dtype='float64').reshape(-1, no_atoms_central, 3))
+
+    centers = coordinates[0].copy()
+    labels = None
 
-    first_frag = np.array([np.array(first_frag.x), np.array(first_frag.y), np.array(first_frag.z)]).T
-    data = np.array([np.array(df.x), np.array(df.y), np.array(df.z)]).T
+    for _ in range(MAX_LABEL_ITERATIONS):
+        new_labels = assign_atoms_to_centers(coordinates, centers)
 
-    # initialize kmeans
-    kmeans = KMeans(n_clusters=no_atoms_central, init=first_frag, n_init=1)
+        if labels is not None and (new_labels == labels).all():
+            break
 
-    kmeans.fit(data)
-    labels = kmeans.labels_
+        labels = new_labels
 
-    df['kmeans_label'] = [str(label) for label in labels]
+        # every fragment has every label once, so every center is the mean of one atom per fragment
+        centers = np.array([np.bincount(labels.ravel(), weights=coordinates[:, :, axis].ravel(),
+                                        minlength=no_atoms_central) for axis in range(3)]).T / len(coordinates)
+
+    df['kmeans_label'] = labels.ravel()
 
     return df
 
@@ -96,54 +129,69 @@ def reset_labels_with_kmeans(df, avg_frag_settings):
 def calc_kabsch_rmse(settings):
     structures_file = settings.get_structure_csv_filename()
 
-    first_rmse = pd.read_csv(structures_file).rmse.mean()
+    first_rmse = pd.read_csv(structures_file, usecols=['rmse']).rmse.mean()
     print(f"Average RMSE kabsch alignment: {first_rmse :.2f}")
 
     return first_rmse
 
 
-def get_aligned_fragments_for_rmse(settings):
-    frags_file = settings.get_aligned_csv_filename()
+def get_central_coordinates(df, label_column='label'):
+    """ Returns the coordinates of the central groups in df as an array of shape (fragments, central atoms, 3), and
+        the label of each atom. The labels of the alignment are the same for every fragment, so then one label per
+        atom is returned, other labels are returned per fragment and atom. df can also contain the contact groups. """
 
-    # this is the old number of atoms
-    rows = 5000
+    # only keep central group
+    df = df[df.label != "-"]
 
-    df = pd.read_csv(frags_file, nrows=rows)
+    no_atoms_central = count_atoms_per_fragment(df)
 
-    # correct for atoms that are thrown away after reading
-    no_atoms = len(df[df.fragment_id == 0])
-    rows = 100 * no_atoms
-    df = pd.read_csv(frags_file, nrows=rows)
+    coordinates = df[['x', 'y', 'z']].to_numpy(dtype='float64').reshape(-1, no_atoms_central, 3)
+    labels = df[label_column].to_numpy().reshape(-1, no_atoms_central)
+
+    if label_column == 'label':
+        labels = labels[0]
+
+    return coordinates, labels
 
-    return df
 
+def calc_model_rmses(avg_fragment, coordinates, labels, label_column='label'):
+    """ Returns the RMSE of every fragment with the central model. Each atom is compared with the atom of the model
+        that has the same label. The fragments are compared in chunks, so the temporary arrays stay small. """
 
-def calc_avg_rmse(avg_fragment, settings, df=None):
+    model_rows = pd.Index(avg_fragment[label_column]).get_indexer(np.ravel(labels)).reshape(np.shape(labels))
 
-    if df is None:
-        df = get_aligned_fragments_for_rmse(settings)
+    assert (model_rows >= 0).all(), "Not every label of the fragments is in the central model."
 
-    no_atoms_central = len(df[(df.fragment_id == 0) & (df.label != "-")])
+    model = avg_fragment[['x', 'y', 'z']].to_numpy(dtype='float64')[model_rows]
 
-    unique_frags = df.fragment_id.unique()
+    rmses = np.empty(len(coordinates))
+    for first in range(0, len(coordinates), READ_CHUNK_SIZE):
+        last = first + READ_CHUNK_SIZE
+        rmses[first:last] = calc_rmse_all(model if model.ndim == 2 else model[first:last], coordinates[first:last])
 
-    # matrix A is avg fragment
-    avg_fragment = avg_fragment[:no_atoms_central]
-    A = np.array([np.array(avg_fragment.x), np.array(avg_fragment.y), np.array(avg_fragment.z)]).T
-    n = A.shape[0]
+    return rmses
 
-    rmse_list = []
-    # matrix B is first 100 fragments
-    for unique_frag in unique_frags[:100]:
-        frag = df[df.fragment_id == unique_frag][:no_atoms_central]
-        B = np.array([np.array(frag.x), np.array(frag.y), np.array(frag.z)]).T
 
-        rmse_list.append(calc_rmse(A, B, n))
+def calc_avg_rmse(avg_fragment, coordinates, labels, label_column='label'):
+    """ Calculates the RMSE of every fragment with the central model, prints their distribution and returns them. """
 
-    avg_rmse = np.mean(rmse_list)
-    print(f"Average RMSE average fragment: {avg_rmse :.2f}")
+    rmses = calc_model_rmses(avg_fragment, coordinates, labels, label_column)
+
+    print(f"Average RMSE average fragment: {rmses.mean() :.2f}")
+    print("RMSE percentiles (50, 90, 99, max): " +
+          ", ".join(f"{value :.2f}" for value in np.percentile(rmses, [50, 90, 99, 100])))
+
+    return rmses
+
+
+def save_model_rmses(settings, rmses):
+    """ Adds the RMSE of every fragment with the central model to the structures csv. """
+
+    structures_file = settings.get_structure_csv_filename()
 
-    return avg_rmse
+    structures = pd.read_csv(structures_file)
+    structures['model_rmse'] = rmses
+    structures.to_csv(structures_file, index=False)
 
 
 if __name__ == "__main__":
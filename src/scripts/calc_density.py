@@ -10,15 +10,13 @@
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 import sys
-import time
 
 import numpy as np
-import pandas as pd
 
 from classes.Settings import Settings
-from classes.Radii import Radii
+from classes.Session import Session
+from classes.VolumeCache import VolumeCache
 from helpers.density_helpers import make_density_df, find_available_volume, calc_distances
-from helpers.geometry_helpers import make_coordinate_df
 
 from constants.constants import STANDARD_THRESHOLD, STANDARD_RES, STANDARD_EXTRA_VDW
 from constants.paths import WORKDIR
@@ -30,8 +28,6 @@ def main():
         print("Usage: python plot_density.py <path/to/inputfile> <contact group reference point>")
         sys.exit(1)
 
-    t0 = time.time()
-
     settings = Settings(WORKDIR, sys.argv[1])
     settings.set_contact_reference_point(sys.argv[2])
 
@@ -39,53 +35,46 @@ def main():
     settings.set_resolution(STANDARD_RES)
     settings.set_threshold(STANDARD_THRESHOLD)
 
+    session = Session(settings)
+
     try:
-        df = pd.read_csv(settings.get_aligned_csv_filename(), header=0)
-        avg_frag = pd.read_csv(settings.outputfile_prefix + "_avg_fragment.csv", header=0)
+        session.get_aligned_fragments()
+        avg_frag = session.get_central_model()
     except FileNotFoundError:
         print('First align and calculate average fragment.')
         sys.exit(2)
 
-    radii = Radii(settings.get_radii_csv_name())
+    radii = session.get_radii()
 
     # grab only the atoms that are in the contact groups
-    coordinate_df = make_coordinate_df(df, settings, avg_frag, radii)
+    coordinate_df = session.get_coordinate_df()
 
-    density_df = make_density_df(settings, coordinate_df, again=True)
+    density_grid = make_density_df(settings, coordinate_df, again=True)
 
-    t1 = time.time() - t0
-    print("Duration: %.2f s." % t1)
+    settings.profiler.print_report()
 
     # find the volume of the central group
     tolerance = STANDARD_EXTRA_VDW
     contact_group_radius = radii.get_vdw_distance_contact(settings.contact_rp)
-    Vavailable = find_available_volume(avg_fragment=avg_frag, extra=(tolerance + contact_group_radius))
+    Vavailable = find_available_volume(avg_fragment=avg_frag, extra=(tolerance + contact_group_radius),
+                                       cache=VolumeCache(settings))
     print('Available volume:', Vavailable)
 
-    threshold_calc = density_df.datafrac_normalized.max() * settings.threshold
-
-    in_cluster = density_df[density_df.datafrac_normalized >= threshold_calc]
-    datafrac = in_cluster.datafrac_normalized.sum()
-
-    Vcluster = len(in_cluster) * settings.resolution**3
-
-    directionality = datafrac / Vcluster * (Vavailable/2)
+    directionality = density_grid.get_directionality(settings.threshold, Vavailable)
 
     print(f"Directionality: {directionality}")
 
-    vdw_overlap = calc_vdw_overlap(in_cluster.copy(), settings, avg_frag, contact_group_radius)
+    vdw_overlap = calc_vdw_overlap(density_grid, settings, avg_frag, contact_group_radius)
     print(f"Vdw overlap datapoints in cluster: {vdw_overlap :.2f}%")
 
 
-def calc_vdw_overlap(in_cluster, settings, avg_fragment, contact_group_radius):
+def calc_vdw_overlap(density_grid, settings, avg_fragment, contact_group_radius):
 
-    # center of bin is at xstart + a half times the resolution
-    in_cluster['x_center'] = in_cluster.xstart + 0.5 * settings.resolution
-    in_cluster['y_center'] = in_cluster.ystart + 0.5 * settings.resolution
-    in_cluster['z_center'] = in_cluster.zstart + 0.5 * settings.resolution
+    in_cluster = density_grid.get_mask(settings.threshold)
 
-    bin_coordinates = np.transpose(np.array([in_cluster.x_center, in_cluster.y_center, in_cluster.z_center]))
-    in_vdw_vol = np.zeros(len(in_cluster))
+    bin_coordinates = density_grid.get_bin_centers(in_cluster)
+    datafrac_normalized = density_grid.get_fractions()[in_cluster]
+    in_vdw_vol = np.zeros(len(bin_coordinates))
 
     for i, atom in avg_fragment.iterrows():
         indices = np.transpose(np.where(in_vdw_vol == 0))
@@ -95,9 +84,7 @@ def calc_vdw_overlap(in_cluster, settings, avg_fragment, contact_group_radius):
         in_vdw_vol = calc_distances(in_vdw_vol, bin_coordinates, fragment_point, indices,
                                     extra=(contact_group_radius))
 
-    in_cluster['in_vdw_vol'] = in_vdw_vol
-
-    return in_cluster[in_cluster.in_vdw_vol != 0].datafrac_normalized.sum() * 100
+    return datafrac_normalized[in_vdw_vol != 0].sum() * 100
 
 
 if __name__ == "__main__":
@@ -0,0 +1,179 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
+# thesis in the Master Computational Science, University of Amsterdam, 2021.
+#
+# `AlignedFragments` is a class that saves and loads the aligned fragments in a binary format. The coordinates are
+# saved as one big array of shape (fragments, atoms, 3) that is memory-mapped when it is loaded, so loading takes no
+# time and no memory, no matter how many fragments there are. The labels are the same for every fragment, so they are
+# saved only once. The element of each atom is saved as a one byte code, because the R groups can differ per fragment.
+# The information per fragment (structure name, rmse, mirrored) stays in the structures csv. The fragments are only
+# complete when the last part is added, so a set that was interrupted while aligning is not loaded.
+#
+# Author: Natasja Wezel
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from constants.constants import READ_CHUNK_SIZE
+
+
+class AlignedFragments():
+    """ Saves the aligned fragments of a contact pair in binary files, and loads them as memory-mapped arrays. """
+
+    ID_LENGTH = 8
+
+    def __init__(self, settings):
+        self.prefix = settings.get_aligned_store_prefix()
+
+        self.info = None
+        self.coordinates = None
+        self.symbol_codes = None
+        self.ids = None
+
+    def get_filenames(self):
+        return {'info': self.prefix + ".json",
+                'coordinates': self.prefix + "_coordinates.bin",
+                'symbols': self.prefix + "_symbols.bin",
+                'ids': self.prefix + "_ids.bin"}
+
+    def exists(self):
+        """ Returns whether the fragments are saved, and all parts were added. """
+
+        try:
+            with open(self.get_filenames()['info']) as inputfile:
+                return json.load(inputfile).get('complete', False)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+
+    def create(self, labels, no_atoms_central):
+        """ Starts a new, empty set of aligned fragments. Fragments are added with append, and after the last part
+            the set is marked as complete with finish. """
+
+        self.info = {'complete': False,
+                     'no_fragments': 0,
+                     'no_atoms': len(labels),
+                     'no_atoms_central': no_atoms_central,
+                     'labels': list(labels),
+                     'elements': []}
+
+        for key, filename in self.get_filenames().items():
+            if key != 'info':
+                open(filename, 'wb').close()
+
+        self.save_info()
+
+    def append(self, coordinates, symbols, ids):
+        """ Appends aligned fragments. Coordinates is an array of shape (fragments, atoms, 3), symbols and ids contain
+            one value per atom, in the same order. """
+
+        assert coordinates.shape[1] == self.info['no_atoms'], "Fragments do not have the same amount of atoms"
+
+        # translate the symbols to codes, new elements are added to the end of the list
+        elements, codes = np.unique(np.asarray(symbols, dtype=str), return_inverse=True)
+        for element in elements:
+            if element not in self.info['elements']:
+                self.info['elements'].append(element)
+
+        element_codes = np.array([self.info['elements'].index(element) for element in elements], dtype=np.uint8)
+
+        ids = np.asarray(ids, dtype=str)
+        assert np.char.str_len(ids).max() <= self.ID_LENGTH, "Atom id is too long to save"
+
+        filenames = self.get_filenames()
+        with open(filenames['coordinates'], 'ab') as outputfile:
+            outputfile.write(np.ascontiguousarray(coordinates, dtype='float64').tobytes())
+        with open(filenames['symbols'], 'ab') as outputfile:
+            outputfile.write(element_codes[codes].tobytes())
+        with open(filenames['ids'], 'ab') as outputfile:
+            outputfile.write(ids.astype('S' + str(self.ID_LENGTH)).tobytes())
+
+        self.info['no_fragments'] += coordinates.shape[0]
+        self.save_info()
+
+    def finish(self):
+        self.info['complete'] = True
+        self.save_info()
+
+    def save_info(self):
+        with open(self.get_filenames()['info'], 'w') as outputfile:
+            json.dump(self.info, outputfile)
+
+    def load(self):
+        """ Memory-maps the saved fragments. Returns itself, so it can be used directly after initializing. """
+
+        filenames = self.get_filenames()
+
+        if not self.exists():
+            raise FileNotFoundError(f"The aligned fragments {self.prefix} are not saved completely, align them again")
+
+        with open(filenames['info']) as inputfile:
+            self.info = json.load(inputfile)
+
+        shape = (self.info['no_fragments'], self.info['no_atoms'])
+
+        self.coordinates = np.memmap(filenames['coordinates'], dtype='float64', mode='r', shape=shape + (3,))
+        self.symbol_codes = np.memmap(filenames['symbols'], dtype=np.uint8, mode='r', shape=shape)
+        self.ids = np.memmap(filenames['ids'], dtype='S' + str(self.ID_LENGTH), mode='r', shape=shape)
+
+        return self
+
+    def get_no_fragments(self):
+        return self.info['no_fragments']
+
+    def get_no_atoms_central(self):
+        return self.info['no_atoms_central']
+
+    def get_labels(self):
+        return np.array(self.info['labels'])
+
+    def get_symbols(self, first=0, last=None, atoms=slice(None)):
+        """ Returns the element symbols of the given fragments and atoms as an array of shape (fragments, atoms). """
+
+        return np.array(self.info['elements'])[self.symbol_codes[first:last, atoms]]
+
+    def get_central_coordinates(self):
+        """ Returns a view on the coordinates of the central groups, of shape (fragments, central atoms, 3). """
+
+        return self.coordinates[:, :self.get_no_atoms_central()]
+
+    def get_contact_coordinates(self):
+        """ Returns a view on the coordinates of the contact groups, of shape (fragments, contact atoms, 3). """
+
+        return self.coordinates[:, self.get_no_atoms_central():]
+
+    def to_dataframe(self, first=0, last=None, atoms=slice(None)):
+        """ Converts the given fragments and atoms to a dataframe in the layout of the aligned csv. """
+
+        coordinates = self.coordinates[first:last, atoms]
+        no_fragments, no_atoms = coordinates.shape[:2]
+
+        df = pd.DataFrame({'fragment_id': np.repeat(np.arange(first, first + no_fragments), no_atoms),
+                           '_id': self.ids[first:last, atoms].ravel().astype(str),
+                           'symbol': self.get_symbols(first, last, atoms).ravel(),
+                           'label': np.tile(self.get_labels()[atoms], no_fragments),
+                           'x': coordinates[:, :, 0].ravel(),
+                           'y': coordinates[:, :, 1].ravel(),
+                           'z': coordinates[:, :, 2].ravel()})
+
+        return df
+
+    def get_central_groups(self):
+        """ Returns a dataframe containing only the atoms of the central groups. """
+
+        return self.to_dataframe(atoms=slice(0, self.get_no_atoms_central()))
+
+    def iterate_parts(self, fragments_per_part=READ_CHUNK_SIZE):
+        """ Yields dataframes of all atoms, fragments_per_part fragments at a time. """
+
+        for first in range(0, self.get_no_fragments(), fragments_per_part):
+            yield self.to_dataframe(first, first + fragments_per_part)
+
+    def to_csv(self, filename):
+        """ Exports the aligned fragments to a csv, for compatibility with the old aligned csv. """
+
+        for i, part in enumerate(self.iterate_parts()):
+            part.to_csv(filename, index=False, mode='w' if i == 0 else 'a', header=(i == 0))
@@ -0,0 +1,57 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
+# thesis in the Master Computational Science, University of Amsterdam, 2021.
+#
+# `DensityCache` is a class that keeps the density grids that were used most recently in memory, so the density slider
+# only reads a grid from the hdf file the first time a resolution is shown.
+#
+# Author: Natasja Wezel
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+from collections import OrderedDict
+
+from classes.DensityGrid import DensityGrid
+from constants.constants import DENSITY_CACHE_SIZE
+
+
+class DensityCache():
+    """ Contains the density grids per contact reference point and resolution, with their normalized grids, maxima and
+        threshold indices already calculated. When the grids use more than max_bytes of memory, the grid that was used
+        longest ago is removed, but the grid that is in use is always kept. """
+
+    def __init__(self, settings, max_bytes=DENSITY_CACHE_SIZE):
+        self.settings = settings
+        self.max_bytes = max_bytes
+
+        self.grids = OrderedDict()
+
+    def get_grid(self):
+        """ Returns the grid of the current contact reference point and resolution of the settings. """
+
+        key = (self.settings.contact_rp, self.settings.resolution)
+
+        if key in self.grids:
+            self.grids.move_to_end(key)
+            return self.grids[key]
+
+        density_grid = DensityGrid.read_hdf(self.settings.get_density_df_filename(),
+                                            self.settings.get_density_df_key())
+        self.add_grid(density_grid)
+
+        return density_grid
+
+    def add_grid(self, density_grid):
+        """ Adds a grid that is already in memory, for example right after it was made. """
+
+        density_grid.get_fractions()
+        density_grid.get_maximum_fraction()
+        density_grid.make_threshold_index()
+
+        self.grids[(density_grid.contact_rp, density_grid.resolution)] = density_grid
+        self.grids.move_to_end((density_grid.contact_rp, density_grid.resolution))
+
+        while len(self.grids) > 1 and self.get_nbytes() > self.max_bytes:
+            self.grids.popitem(last=False)
+
+    def get_nbytes(self):
+        return sum(density_grid.get_nbytes() for density_grid in self.grids.values())
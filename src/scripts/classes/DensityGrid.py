@@ -0,0 +1,197 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
+# thesis in the Master Computational Science, University of Amsterdam, 2021.
+#
+# `DensityGrid` is a class that contains the amount of contact points per bin as a contiguous 3D array, together with
+# the origin, resolution and shape of the grid. The coordinates of the bins are not stored, but calculated when they
+# are needed, so only the bins that are actually used are ever made.
+#
+# Author: Natasja Wezel
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import numpy as np
+import pandas as pd
+
+
+class DensityGrid():
+    """ Contains the counts of the contact points per bin in a 3D array. The origin is the lower corner of the first
+        bin, and bin (ix, iy, iz) spans [origin + i * resolution, origin + (i + 1) * resolution) on every axis. """
+
+    # the thresholds of the density slider
+    THRESHOLDS = np.round(np.arange(0, 1.005, 0.01), 2)
+
+    def __init__(self, counts, origin, resolution, contact_rp):
+        self.counts = np.ascontiguousarray(counts)
+        self.origin = np.array(origin, dtype='float64')
+        self.resolution = resolution
+        self.shape = self.counts.shape
+        self.contact_rp = contact_rp
+
+        # the normalized grid and its maximum are calculated once, when they are first needed
+        self.total = self.counts.sum()
+        self.fractions = None
+        self.maximum_fraction = None
+
+        # the threshold index is also only made when it is needed
+        self.sorted_fractions = None
+        self.cumulative_counts = None
+
+    def get_total(self):
+        return self.total
+
+    def get_fractions(self):
+        """ Returns the normalized counts, so the fraction of all data that is in each bin. """
+
+        if self.fractions is None:
+            self.fractions = self.counts / self.get_total()
+
+        return self.fractions
+
+    def get_maximum_fraction(self):
+        if self.maximum_fraction is None:
+            self.maximum_fraction = self.counts.max() / self.get_total()
+
+        return self.maximum_fraction
+
+    def get_nbytes(self):
+        """ Returns the amount of memory the grid uses. """
+
+        arrays = [self.counts, self.fractions, self.sorted_fractions, self.cumulative_counts]
+
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def get_mask(self, threshold):
+        """ Returns a boolean grid that is True for the bins with at least threshold times the maximum fraction. """
+
+        return self.get_fractions() >= threshold * self.get_maximum_fraction()
+
+    def get_bin_starts(self, mask=None):
+        """ Returns the lower corners of the bins in the mask, or of all bins if no mask is given, in the same order as
+            the rows of the density dataframe. """
+
+        if mask is None:
+            mask = np.ones(self.shape, dtype=bool)
+
+        indices = np.transpose(np.nonzero(mask))
+
+        return self.origin + indices * self.resolution
+
+    def get_bin_centers(self, mask=None):
+        """ Returns the centers of the bins in the mask, or of all bins if no mask is given. """
+
+        return self.get_bin_starts(mask) + 0.5 * self.resolution
+
+    def make_threshold_index(self):
+        """ Sorts the fractions of all bins, and sums the counts from the fullest bin down. The bins in the cluster at
+            any threshold are then the last ones of the sorted fractions, so their amount and data can be looked up
+            without going through the grid. """
+
+        if self.sorted_fractions is None:
+            sorted_counts = np.sort(self.counts, axis=None)
+
+            self.sorted_fractions = sorted_counts / self.get_total()
+            self.cumulative_counts = np.cumsum(sorted_counts[::-1])
+
+    def get_cluster_statistics(self, threshold):
+        """ Returns the fraction of the data that is in the cluster at the given threshold, and the volume of that
+            cluster. The threshold can also be an array of thresholds, then arrays are returned. """
+
+        self.make_threshold_index()
+
+        # the amount of bins with at least threshold times the maximum fraction
+        limits = np.asarray(threshold) * self.get_maximum_fraction()
+        no_bins = self.sorted_fractions.size - np.searchsorted(self.sorted_fractions, limits, side='left')
+
+        cumulative_counts = np.concatenate([[0], self.cumulative_counts])
+
+        datafrac = cumulative_counts[no_bins] / self.get_total()
+        Vcluster = no_bins * self.resolution**3
+
+        return datafrac, Vcluster
+
+    def get_directionality(self, threshold, Vavailable):
+        """ Returns the directionality of the cluster at the given threshold, or an array for an array of thresholds.
+            """
+
+        datafrac, Vcluster = self.get_cluster_statistics(threshold)
+
+        return datafrac / Vcluster * (Vavailable/2)
+
+    def get_directionality_curve(self, Vavailable, thresholds=None):
+        """ Returns a dataframe with the data fraction, cluster volume and directionality for each threshold. By
+            default the thresholds of the density slider are used. """
+
+        if thresholds is None:
+            thresholds = self.THRESHOLDS
+
+        datafrac, Vcluster = self.get_cluster_statistics(thresholds)
+
+        return pd.DataFrame({'threshold': thresholds,
+                             'datafrac': datafrac,
+                             'Vcluster': Vcluster,
+                             'directionality': datafrac / Vcluster * (Vavailable/2)})
+
+    def to_dataframe(self):
+        """ Converts the grid to a dataframe containing one row per bin, with the same columns as the old density df.
+            Only use this for small grids, since this is exactly what the grid is meant to avoid. """
+
+        starts = self.get_bin_starts()
+
+        df = pd.DataFrame(starts, columns=['xstart', 'ystart', 'zstart'])
+        df[self.contact_rp] = self.counts.ravel()
+        df['datafrac_normalized'] = self.get_fractions().ravel()
+
+        return df
+
+    def to_hdf(self, filename, key):
+        """ Saves only the bins that contain data, together with the origin, resolution and shape of the grid. """
+
+        DensityGrid.write_hdf(filename, {key: self})
+
+    @staticmethod
+    def write_hdf(filename, density_grids):
+        """ Saves several grids, given as a dictionary with the key of each grid, in one write. """
+
+        with pd.HDFStore(filename) as store:
+            for key, density_grid in density_grids.items():
+                density_grid.put(store, key)
+
+    def put(self, store, key):
+        """ Puts the grid in an open HDFStore. """
+
+        ix, iy, iz = np.nonzero(self.counts)
+
+        df = pd.DataFrame({'ix': ix, 'iy': iy, 'iz': iz, self.contact_rp: self.counts[ix, iy, iz]})
+
+        store.put(key, df)
+        store.get_storer(key).attrs.grid = {'origin': list(self.origin),
+                                            'resolution': self.resolution,
+                                            'shape': list(self.shape)}
+
+    @classmethod
+    def read_hdf(cls, filename, key):
+        """ Loads a grid saved with to_hdf. Raises a KeyError if the key does not exist or does not contain a grid. """
+
+        with pd.HDFStore(filename, mode='r') as store:
+            return cls.get(store, key)
+
+    @classmethod
+    def get(cls, store, key):
+        """ Loads a grid from an open HDFStore. Raises a KeyError if the key does not exist or does not contain a
+            grid. """
+
+        if key not in store:
+            raise KeyError(key)
+
+        df = store.get(key)
+        grid_info = getattr(store.get_storer(key).attrs, 'grid', None)
+
+        if grid_info is None:
+            raise KeyError(f"{key} does not contain a density grid")
+
+        contact_rp = df.columns[-1]
+
+        counts = np.zeros(grid_info['shape'], dtype=np.int64)
+        counts[df.ix, df.iy, df.iz] = df[contact_rp]
+
+        return cls(counts, grid_info['origin'], grid_info['resolution'], contact_rp)
@@ -0,0 +1,157 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
+# thesis in the Master Computational Science, University of Amsterdam, 2021.
+#
+# `Profiler` is a class that measures the wall time, cpu time and amount of items of every stage of the pipeline, and
+# the peak memory of the process so far when the stage ends, and saves them as a json report next to the results. One
+# stage can also be profiled with cProfile, to see which functions take the time. Every settings object has a profiler,
+# so the stages can measure themselves wherever they are called from.
+#
+# Author: Natasja Wezel
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import contextlib
+import cProfile
+import io
+import json
+import pstats
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # resource does not exist on windows, the cpu time of child processes and the peak memory are not measured there
+    resource = None
+
+
+class Profiler():
+    """ Adds up the measurements of each stage over all the times it is entered, so a stage that runs once per chunk
+        gets one total. The peak memory is not of the stage itself: it is the highest resident memory of the process
+        (and of its biggest child process) so far, at the end of the stage. """
+
+    STAGES = ['read', 'align', 'write', 'average', 'k-means', 'coordinates', 'density', 'volume', 'directionality']
+
+    def __init__(self, profile_stage=None):
+        assert profile_stage is None or profile_stage in self.STAGES, f"Unknown stage to profile: {profile_stage}"
+
+        self.profile_stage = profile_stage
+        self.cprofile = None
+
+        self.stages = {}
+        self.started = time.strftime("%Y-%m-%d %H:%M:%S")
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Measures everything that happens inside the with block as part of the stage. """
+
+        if name == self.profile_stage:
+            if self.cprofile is None:
+                self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+        wall_time, cpu_time = time.perf_counter(), self.get_cpu_time()
+
+        try:
+            yield
+        finally:
+            wall_time, cpu_time = time.perf_counter() - wall_time, self.get_cpu_time() - cpu_time
+
+            if name == self.profile_stage:
+                self.cprofile.disable()
+
+            entry = self.get_entry(name)
+            entry['calls'] += 1
+            entry['wall_time'] += wall_time
+            entry['cpu_time'] += cpu_time
+            entry['process_peak_rss_mb'], entry['children_peak_rss_mb'] = self.get_peak_rss()
+
+    def iterate(self, name, iterable):
+        """ Yields the items of an iterable, measuring the time it takes to make each item as part of the stage. """
+
+        iterator = iter(iterable)
+
+        while True:
+            with self.stage(name):
+                item = next(iterator, StopIteration)
+
+            if item is StopIteration:
+                return
+
+            yield item
+
+    def add_items(self, name, items):
+        self.get_entry(name)['items'] += int(items)
+
+    def get_entry(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'items': 0,
+                                 'process_peak_rss_mb': None, 'children_peak_rss_mb': None}
+
+        return self.stages[name]
+
+    def get_wall_time(self, *names):
+        """ Returns the total wall time of the stages, or of all stages if no names are given. Stages that did not run
+            count as zero. """
+
+        names = names if names else self.stages
+
+        return sum((self.stages[name]['wall_time'] for name in names if name in self.stages), 0.0)
+
+    @staticmethod
+    def get_cpu_time():
+        """ The cpu time of this process and of the child processes that finished, like the alignment workers. """
+
+        if resource is None:
+            return time.process_time()
+
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        return time.process_time() + children.ru_utime + children.ru_stime
+
+    @staticmethod
+    def get_peak_rss():
+        if resource is None:
+            return None, None
+
+        # linux gives the peak in kilobytes, mac in bytes
+        unit = 1e6 if sys.platform == 'darwin' else 1e3
+
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit)
+
+    def get_report(self, info=None):
+        return {'started': self.started,
+                'info': info if info is not None else {},
+                'stages': self.stages,
+                'total': {'wall_time': sum(entry['wall_time'] for entry in self.stages.values()),
+                          'cpu_time': sum(entry['cpu_time'] for entry in self.stages.values())}}
+
+    def save(self, filename, info=None):
+        """ Saves the report as json. If a stage was profiled with cProfile, its statistics are saved next to it. """
+
+        with open(filename, 'w') as outputfile:
+            # numpy numbers are saved as normal numbers
+            json.dump(self.get_report(info), outputfile, indent=4, default=lambda value: value.item())
+
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(self.get_cprofile_filename(filename))
+
+    def get_cprofile_filename(self, filename):
+        return filename.rsplit('.', 1)[0] + "_" + self.profile_stage + ".prof"
+
+    def print_report(self):
+        print(f"\t{'stage':<16}{'calls':>8}{'wall (s)':>12}{'cpu (s)':>12}{'items':>12}" +
+              f"{'process peak so far (MB)':>28}")
+
+        for name, entry in self.stages.items():
+            peak = "-" if entry['process_peak_rss_mb'] is None else f"{entry['process_peak_rss_mb']:.0f}"
+            print(f"\t{name:<16}{entry['calls']:>8}{entry['wall_time']:>12.3f}{entry['cpu_time']:>12.3f}" +
+                  f"{entry['items']:>12}{peak:>28}")
+
+        if self.cprofile is not None:
+            stream = io.StringIO()
+            pstats.Stats(self.cprofile, stream=stream).sort_stats('cumulative').print_stats(25)
+
+            print(f"\ncProfile of stage {self.profile_stage}:")
+            print(stream.getvalue())
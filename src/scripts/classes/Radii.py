@@ -3,54 +3,63 @@
 # thesis in the Master Computational Science, University of Amsterdam, 2021.
 #
 # `Radii` is a class that takes as input the Radii csv, and is used to get the covalent and vanderwaals radii of
-# elements. They are saved in a dictionary, so that if the same element is looked up again, we do not need to open the
-# file and read it again.
+# elements. The csv is read once per process into a table with the element symbols as index, so the radii of a whole
+# array of symbols are looked up at once, and every Radii object of the same file shares that table.
 #
 # Author: Natasja Wezel
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
+import os
+
+import numpy as np
 import pandas as pd
 
 
 class Radii():
+    """ Contains the covalent and vanderwaals radius of every element of the radii csv. """
+
+    # the tables that were read in this process, by filename and the time they were last changed
+    TABLES = {}
+
     def __init__(self, RADII_CSV):
         self.radii_filename = RADII_CSV
-        self.vdw_radii = {}
-        self.cov_radii = {}
+        self.table = self.read_table(RADII_CSV)
 
-    def get_vdw_radius(self, symbol):
-        """ Adds element with vdw radius to dictionary if not exists yet, and returns its vdw radius. """
+    @classmethod
+    def read_table(cls, filename):
+        key = (filename, os.path.getmtime(filename))
 
-        # if not looked up before
-        if symbol not in self.vdw_radii.keys():
+        if key not in cls.TABLES:
+            radii_df = pd.read_csv(filename, comment="#")
 
-            # read file, find and add vdw_radius to dictionary
-            radii_df = pd.read_csv(self.radii_filename, comment="#")
-            test_df = radii_df[radii_df.symbol == symbol]
+            assert radii_df.symbol.is_unique, "The radii csv contains an element more than once."
 
-            assert len(test_df) == 1, "You're trying to look up vdw radius of element that is not in bondi's list."
+            cls.TABLES[key] = radii_df.set_index('symbol')[['vdw_radius', 'cov_radius']].astype('float64')
 
-            self.vdw_radii[symbol] = float(test_df.vdw_radius)
+        return cls.TABLES[key]
 
-        # return dictionary value
-        return self.vdw_radii[symbol]
+    def get_radii(self, symbols, column):
+        """ Returns an array with the radius in the column for every symbol. """
 
-    def get_cov_radius(self, symbol):
-        """ Adds element with cov radius to dictionary if not exist yet, and returns its covalent radius. """
+        symbols = np.asarray(symbols, dtype=object)
+        indices = self.table.index.get_indexer(symbols)
+
+        assert (indices >= 0).all(), "You're trying to look up the radius of an element that is not in bondi's " +\
+            f"list: {', '.join(sorted(set(symbols[indices < 0])))}"
 
-        # if not looked up before
-        if symbol not in self.cov_radii.keys():
+        return self.table[column].to_numpy()[indices]
 
-            # read file, find and add cov_radius to dictionary
-            radii_df = pd.read_csv(self.radii_filename, comment="#")
-            test_df = radii_df[radii_df.symbol == symbol]
+    def get_vdw_radii(self, symbols):
+        return self.get_radii(symbols, 'vdw_radius')
 
-            assert len(test_df) == 1, "You're trying to look up cov radius of element that is not in bondi's list."
+    def get_cov_radii(self, symbols):
+        return self.get_radii(symbols, 'cov_radius')
 
-            self.cov_radii[symbol] = float(test_df.cov_radius)
+    def get_vdw_radius(self, symbol):
+        return float(self.get_vdw_radii([symbol])[0])
 
-        # return dictionary value
-        return self.cov_radii[symbol]
+    def get_cov_radius(self, symbol):
+        return float(self.get_cov_radii([symbol])[0])
 
     def get_vdw_distance_contact(self, contact_rp):
         """ Returns the vanderwaals radius from the atom that is the reference point of the contact group. If the rp is
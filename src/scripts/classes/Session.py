@@ -0,0 +1,129 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
+# thesis in the Master Computational Science, University of Amsterdam, 2021.
+#
+# `Session` is a class that keeps the data of one contact pair in memory: the aligned fragments, the central group
+# model, the coordinates of the contact groups, the density grids, the available volume, the directionality at every
+# threshold and the radii. The pipeline gives the session everything it made, so the options of the menu can use it
+# without reading the result files again. When a plot is made from its own script, the session reads or makes the data
+# the first time it is asked for.
+#
+# Author: Natasja Wezel
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import numpy as np
+import pandas as pd
+
+from classes.AlignedFragments import AlignedFragments
+from classes.DensityCache import DensityCache
+from classes.DensityGrid import DensityGrid
+from classes.Radii import Radii
+from classes.VolumeCache import VolumeCache
+from helpers.density_helpers import find_available_volume
+from helpers.geometry_helpers import make_coordinate_df
+
+from constants.constants import STANDARD_EXTRA_VDW
+
+
+class Session():
+    """ Contains the data of the contact pair of the settings. Every get function only reads or makes its data the
+        first time, after that it is returned from memory. The coordinates and density grids are kept per contact
+        reference point (and resolution), so changing those in the settings gives the right data. """
+
+    def __init__(self, settings):
+        self.settings = settings
+
+        self.aligned_fragments = None
+        self.central_model = None
+        self.radii = None
+        self.coordinate_dfs = {}
+        self.available_volumes = {}
+        self.directionality_curves = {}
+
+        self.density_cache = DensityCache(settings)
+
+    def set_aligned_fragments(self, aligned_fragments):
+        self.aligned_fragments = aligned_fragments
+
+    def set_central_model(self, central_model):
+        self.central_model = central_model
+
+    def set_radii(self, radii):
+        self.radii = radii
+
+    def set_coordinate_df(self, coordinate_df):
+        self.coordinate_dfs[self.settings.contact_rp] = coordinate_df
+
+    def add_density_grid(self, density_grid):
+        self.density_cache.add_grid(density_grid)
+
+    def get_aligned_fragments(self):
+        if self.aligned_fragments is None:
+            self.aligned_fragments = AlignedFragments(self.settings).load()
+
+        return self.aligned_fragments
+
+    def get_central_model(self):
+        if self.central_model is None:
+            self.central_model = pd.read_csv(self.settings.get_avg_frag_filename())
+
+        return self.central_model
+
+    def get_radii(self):
+        if self.radii is None:
+            self.radii = Radii(self.settings.get_radii_csv_name())
+
+        return self.radii
+
+    def get_coordinate_df(self):
+        """ Returns the coordinates of the contact reference point of the settings. They are loaded from the hdf file,
+            or made from the aligned fragments if they were never saved. """
+
+        if self.settings.contact_rp not in self.coordinate_dfs:
+            aligned_fragments = self.get_aligned_fragments()
+
+            # the aligned fragments can also be one dataframe, which is used as a whole
+            if isinstance(aligned_fragments, AlignedFragments):
+                aligned_fragments = aligned_fragments.iterate_parts()
+
+            self.set_coordinate_df(make_coordinate_df(aligned_fragments, self.settings, self.get_central_model(),
+                                                      self.get_radii()))
+
+        return self.coordinate_dfs[self.settings.contact_rp]
+
+    def has_density_grid(self):
+        return (self.settings.contact_rp, self.settings.resolution) in self.density_cache.grids
+
+    def get_density_grid(self):
+        """ Returns the density grid of the contact reference point and resolution of the settings. """
+
+        return self.density_cache.get_grid()
+
+    def get_available_volume(self):
+        """ Returns the volume around the central group model that is available to the contact reference point of the
+            settings. The volumes are saved in the VolumeCache, so they are only calculated once per model. """
+
+        contact_rp = self.settings.contact_rp
+
+        if contact_rp not in self.available_volumes:
+            extra = STANDARD_EXTRA_VDW + self.get_radii().get_vdw_distance_contact(contact_rp)
+
+            self.available_volumes[contact_rp] = find_available_volume(avg_fragment=self.get_central_model(),
+                                                                       extra=extra, cache=VolumeCache(self.settings))
+
+        return self.available_volumes[contact_rp]
+
+    def get_directionality_curve(self):
+        """ Returns the data fraction, cluster volume and directionality of the density grid of the settings, for the
+            thresholds of the density slider and the threshold of the settings, with the threshold as index. """
+
+        key = (self.settings.contact_rp, self.settings.resolution)
+        curve = self.directionality_curves.get(key)
+
+        if curve is None or self.settings.threshold not in curve.index:
+            thresholds = np.union1d(DensityGrid.THRESHOLDS, [self.settings.threshold])
+
+            curve = self.get_density_grid().get_directionality_curve(self.get_available_volume(), thresholds)
+            self.directionality_curves[key] = curve = curve.set_index('threshold')
+
+        return curve
@@ -16,6 +16,9 @@ import sys
 
 import pandas as pd
 
+from classes.Profiler import Profiler
+from constants.constants import MAX_DATAFILE_SIZE
+
 
 class Settings():
     """ Contains all information for where to find what file. Also contains central and contact names for name
@@ -29,11 +32,11 @@ class Settings():
         self.WORKDIR = WORKDIR
         self.coordinate_file = coordinate_file
 
-        # setup results folders
-        if not os.path.exists(WORKDIR + "\\results"):
-            os.mkdir(WORKDIR + "\\results")
-        if not os.path.exists(WORKDIR + "\\results\\pairs"):
-            os.mkdir(WORKDIR + "\\results\\pairs")
+        # measures the time and memory of every stage of the pipeline
+        self.profiler = Profiler()
+
+        # setup results folders, pairs that run at the same time can make them at the same moment
+        os.makedirs(WORKDIR + "\\results\\pairs", exist_ok=True)
 
         name = coordinate_file.rsplit('\\')[-1].rsplit('.', 1)[0]
 
@@ -61,10 +64,8 @@ class Settings():
 
         self.outputfile_prefix = self.output_folder_specific + self.central_name + '_' + self.contact_name
 
-        if not os.path.exists(self.output_folder_central_group):
-            os.mkdir(self.output_folder_central_group)
-        if not os.path.exists(self.output_folder_specific):
-            os.mkdir(self.output_folder_specific)
+        os.makedirs(self.output_folder_central_group, exist_ok=True)
+        os.makedirs(self.output_folder_specific, exist_ok=True)
 
     def set_resolution(self, resolution):
         self.resolution = round(resolution, 2)
@@ -72,9 +73,15 @@ class Settings():
     def set_threshold(self, threshold):
         self.threshold = round(threshold, 2)
 
+    def set_profile_stage(self, stage):
+        self.profiler = Profiler(profile_stage=stage)
+
     def get_aligned_csv_filename(self):
         return self.outputfile_prefix + "_aligned.csv"
 
+    def get_aligned_store_prefix(self):
+        return self.outputfile_prefix + "_aligned"
+
     def get_structure_csv_filename(self):
         return self.outputfile_prefix + "_structures.csv"
 
@@ -96,6 +103,15 @@ class Settings():
     def get_directionality_results_filename(self):
         return self.output_folder_central_group + self.central_name + "_directionality_results.csv"
 
+    def get_volume_cache_filename(self):
+        return self.output_folder_central_group + self.central_name + "_volumes.json"
+
+    def get_profile_filename(self):
+        return self.outputfile_prefix + "_profile.json"
+
+    def get_stage_cache_filename(self):
+        return self.outputfile_prefix + "_stages.json"
+
     def get_structure_csv_filename(self):
         return self.outputfile_prefix + "_structures.csv"
 
@@ -128,14 +144,23 @@ class AlignmentSettings(Settings):
         Settings.__init__(self, WORKDIR, coordinate_file, central, contact)
 
         self.label_data = coordinate_file.rsplit('.', 1)[0] + '.csv'
+        self.coordinate_files = [coordinate_file]
+        self.workers = 1
         self.alignment = {}
 
         self.read_coord_file()
         self.make_alignment_dict()
 
+        # remember the layout of the coordinate file, the atoms that are binned are removed from the other two
+        self.no_atoms_file = self.no_atoms
+        self.label_list_file = list(self.label_list)
+
     def set_label_file(self, filename):
         self.label_data = filename
 
+    def set_workers(self, workers):
+        self.workers = max(1, workers)
+
     def set_no_fragments(self, no_fragments):
         self.no_fragments = no_fragments
 
@@ -146,12 +171,31 @@ class AlignmentSettings(Settings):
         return self.get_aligned_csv_filename(), self.get_structure_csv_filename()
 
     def update_coordinate_filename(self):
-        # TODO: fix dit met multiple files and original file too big enzo
-        if self.central_name == "RC6H5" and (self.contact_name == "ArCH" or
-                                             self.contact_name == "RC6H5"):
+        """ If the coordinate file was too big and has been split, use all of its parts instead of the file itself. """
+
+        if os.path.getsize(self.coordinate_file) <= MAX_DATAFILE_SIZE:
+            return
+
+        name, extension = self.coordinate_file.rsplit('.', 1)
+
+        self.coordinate_files = []
+        while os.path.exists(f"{name}_{len(self.coordinate_files) + 1}.{extension}"):
+            self.coordinate_files.append(f"{name}_{len(self.coordinate_files) + 1}.{extension}")
+
+        assert len(self.coordinate_files) > 0, "The coordinate file is too big, but has not been split."
+
+    def bin_atoms(self):
+        """ Removes the atoms that are thrown away before the alignment from the atom counts and the label list. This
+            only happens once, even if it is called for every part of the coordinate file. """
+
+        if self.alignment['bin'] == '-' or self.no_atoms != self.no_atoms_file:
+            return
+
+        self.no_atoms -= len(self.alignment['bin'])
+        self.no_atoms_central -= len(self.alignment['bin'])
 
-            self.coordinate_file = self.coordinate_file.rsplit('.', 1)[0] + "_1."\
-                                   + self.coordinate_file.rsplit('.', 1)[1]
+        for label in self.alignment['bin']:
+            self.label_list.remove(label)
 
     def read_coord_file(self):
         """ Reads the first 100 lines of a csv file to count the atoms per fragment and per central
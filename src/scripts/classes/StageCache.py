@@ -0,0 +1,150 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
+# thesis in the Master Computational Science, University of Amsterdam, 2021.
+#
+# `StageCache` is a class that remembers which inputs and parameters were used to make the result files of each stage
+# of the pipeline. Every stage gets a key: a hash of its parameters, the contents of its input files and the keys of
+# the stages it uses. A stage is only done again when its key changed or its result files are gone, so when for
+# example radii.csv changes, the alignment is reused but the central group model and everything after it is made
+# again. The cache is saved as a manifest in the result folder of the pair, which also lists what the last run reused.
+#
+# Author: Natasja Wezel
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import hashlib
+import json
+import os
+import time
+
+from helpers.general_helpers import hash_file
+
+
+class StageCache():
+    """ Keeps the keys and result files of the stages of one contact pair in a json manifest. The stages are align,
+        model, coordinates (per contact reference point), density (per contact reference point and resolution) and
+        stream, which makes the model and the density at once. The hashes of the input files are remembered together
+        with their size and modification time, so big coordinate files are only read again when they changed. """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.filename = settings.get_stage_cache_filename()
+
+        self.manifest = self.load()
+        self.manifest['last_run'] = {'started': time.strftime("%Y-%m-%d %H:%M:%S"), 'stages': {}}
+
+    def get_name(self, stage):
+        """ The coordinates and density are saved per contact reference point and resolution, so they are different
+            stages for each of them. """
+
+        if stage == 'coordinates':
+            return stage + "_" + self.settings.get_coordinate_df_key()
+        if stage in ['density', 'stream']:
+            return stage + "_" + self.settings.get_density_df_key()
+
+        return stage
+
+    def get_inputs(self, stage):
+        """ Returns the input files, the parameters and the stages that a stage depends on. """
+
+        settings = self.settings
+
+        # the original coordinate file is also an input when it was split, so a changed file is never missed
+        coordinate_files = [settings.coordinate_file] + [filename for filename in settings.coordinate_files
+                                                         if filename != settings.coordinate_file]
+        input_files = coordinate_files + [settings.label_data, settings.get_central_groups_csv_filename()]
+        model_files = [settings.get_radii_csv_name(), settings.get_methyl_csv_filename()]
+
+        if stage == 'align':
+            return input_files, {}, []
+        elif stage == 'model':
+            return model_files, {}, ['align']
+        elif stage == 'coordinates':
+            return [settings.get_radii_csv_name()], {'contact_rp': settings.contact_rp}, ['model']
+        elif stage == 'density':
+            return [], {'resolution': settings.resolution}, ['coordinates']
+        elif stage == 'stream':
+            return input_files + model_files, {'contact_rp': settings.contact_rp,
+                                               'resolution': settings.resolution}, []
+
+        raise KeyError(stage)
+
+    def get_key(self, stage):
+        """ Returns the key of a stage, from the contents of its input files, its parameters and the keys of the
+            stages it depends on. """
+
+        files, params, depends = self.get_inputs(stage)
+
+        key = {'stage': stage,
+               'files': {os.path.basename(filename): self.hash_file(filename) for filename in files},
+               'params': params,
+               'depends': [self.get_key(other) for other in depends]}
+
+        return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+    def is_valid(self, stage):
+        """ A stage can be reused if it was made with the same key and all of its result files still exist. """
+
+        entry = self.manifest['stages'].get(self.get_name(stage))
+
+        if entry is None or entry['key'] != self.get_key(stage):
+            return False
+
+        return all(os.path.exists(filename) for filename, _ in entry['outputs'])
+
+    def reuse(self, stage):
+        self.manifest['last_run']['stages'][self.get_name(stage)] = 'reused'
+        self.save()
+
+    def add_stage(self, stage, outputs):
+        """ Remembers that a stage was just made. Outputs is a list of (filename, hdf key or None). Other stages that
+            wrote to the same outputs are forgotten, because their results were just overwritten. """
+
+        name = self.get_name(stage)
+        outputs = [[filename, output_key] for filename, output_key in outputs]
+
+        for other in list(self.manifest['stages']):
+            if other != name and any(output in outputs for output in self.manifest['stages'][other]['outputs']):
+                del self.manifest['stages'][other]
+
+        self.manifest['stages'][name] = {'key': self.get_key(stage), 'outputs': outputs,
+                                         'made': time.strftime("%Y-%m-%d %H:%M:%S")}
+        self.manifest['last_run']['stages'][name] = 'computed'
+        self.save()
+
+    def get_reused(self):
+        return [name for name, status in self.manifest['last_run']['stages'].items() if status == 'reused']
+
+    def print_last_run(self):
+        for name, status in self.manifest['last_run']['stages'].items():
+            print(f"\t{name:<20} {status}")
+
+    def hash_file(self, filename):
+        """ Returns the sha1 hash of the contents of a file. The hash is only calculated again if the size or the
+            modification time of the file changed since it was last hashed. """
+
+        stat = os.stat(filename)
+        entry = self.manifest['files'].get(filename)
+
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['hash']
+
+        self.manifest['files'][filename] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                                            'hash': hash_file(filename)}
+
+        return self.manifest['files'][filename]['hash']
+
+    def load(self):
+        try:
+            with open(self.filename) as inputfile:
+                return json.load(inputfile)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {'files': {}, 'stages': {}}
+
+    def save(self):
+        # write to a temporary file first, so a run that is stopped halfway never leaves half a manifest
+        temporary_filename = self.filename + "." + str(os.getpid())
+
+        with open(temporary_filename, 'w') as outputfile:
+            json.dump(self.manifest, outputfile, indent=4)
+
+        os.replace(temporary_filename, self.filename)
@@ -0,0 +1,139 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
+# thesis in the Master Computational Science, University of Amsterdam, 2021.
+#
+# `VolumeCache` is a class that remembers the volumes of central group models. One central group is combined with many
+# contact groups, and the volumes only depend on the geometry of the central model, the extra radius and the
+# resolution. The cache is saved once per central group, so every contact pair of that central group can use it.
+#
+# Author: Natasja Wezel
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import contextlib
+import hashlib
+import json
+import os
+import time
+
+from constants.constants import VOLUME_CACHE_SIZE
+
+
+class VolumeCache():
+    """ Saves the volumes of central models in a json file in the folder of the central group. The volumes are found
+        by a hash of the model, so pairs with the same model share them. When the model of a pair changes, the
+        volumes of its old model are removed, unless another pair still has that model. Only the VOLUME_CACHE_SIZE
+        most recently used results are kept. Pairs of the same central group can run at the same time, so the file is
+        locked while it is read, changed and saved. """
+
+    # the time of last use only has to be known to the minute, so a hit does not always write the file
+    LAST_USED_RESOLUTION = 60
+
+    # a lock that is older than this is left behind by a pair that stopped, and is taken over
+    STALE_LOCK = 60
+
+    def __init__(self, settings):
+        self.filename = settings.get_volume_cache_filename()
+        self.model_filename = settings.get_avg_frag_filename()
+
+    def get_volumes(self, avg_fragment, extra, resolution):
+        """ Returns the saved volumes of this model, extra and resolution, or None if they are not saved. """
+
+        with self.locked():
+            cache = self.load()
+            model_hash, changed = self.update_model(cache, avg_fragment)
+
+            entry = cache['volumes'].get(self.get_key(model_hash, extra, resolution))
+
+            if entry is not None and time.time() - entry['last_used'] > self.LAST_USED_RESOLUTION:
+                entry['last_used'] = time.time()
+                changed = True
+
+            if changed:
+                self.save(cache)
+
+        return None if entry is None else entry['volumes']
+
+    def add_volumes(self, avg_fragment, extra, resolution, volumes):
+        with self.locked():
+            cache = self.load()
+            model_hash, _ = self.update_model(cache, avg_fragment)
+
+            cache['volumes'][self.get_key(model_hash, extra, resolution)] = {'model': model_hash,
+                                                                             'volumes': [float(v) for v in volumes],
+                                                                             'last_used': time.time()}
+
+            # remove the results that were used longest ago
+            while len(cache['volumes']) > VOLUME_CACHE_SIZE:
+                del cache['volumes'][min(cache['volumes'], key=lambda key: cache['volumes'][key]['last_used'])]
+
+            self.save(cache)
+
+    def update_model(self, cache, avg_fragment):
+        """ Remembers the hash of the model of this pair. If it changed, the volumes of the old model are removed when
+            no other pair uses that model anymore. Returns the hash and whether the cache changed. """
+
+        model_hash = self.hash_model(avg_fragment)
+        old_hash = cache['models'].get(self.model_filename)
+
+        if old_hash == model_hash:
+            return model_hash, False
+
+        cache['models'][self.model_filename] = model_hash
+
+        if old_hash is not None and old_hash not in cache['models'].values():
+            cache['volumes'] = {key: entry for key, entry in cache['volumes'].items() if entry['model'] != old_hash}
+
+        return model_hash, True
+
+    @staticmethod
+    def hash_model(avg_fragment):
+        """ Hashes only the columns that the volumes depend on. """
+
+        model = avg_fragment[['label', 'x', 'y', 'z', 'vdw_radius']].to_csv(index=False, float_format='%.6f')
+
+        return hashlib.sha1(model.encode()).hexdigest()
+
+    @staticmethod
+    def get_key(model_hash, extra, resolution):
+        return f"{model_hash}_{extra:.4f}_{resolution:.4f}"
+
+    @contextlib.contextmanager
+    def locked(self):
+        """ Holds a lock file while the with block runs. Creating the lock file fails if it already exists, on every
+            platform, so only one pair at a time gets it. """
+
+        lock_filename = self.filename + ".lock"
+
+        while True:
+            try:
+                os.close(os.open(lock_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_filename) > self.STALE_LOCK:
+                        os.remove(lock_filename)
+                except FileNotFoundError:
+                    pass
+
+                time.sleep(0.01)
+
+        try:
+            yield
+        finally:
+            os.remove(lock_filename)
+
+    def load(self):
+        try:
+            with open(self.filename) as inputfile:
+                return json.load(inputfile)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {'models': {}, 'volumes': {}}
+
+    def save(self, cache):
+        # write to a temporary file first, so a pair that is stopped halfway never leaves half a file
+        temporary_filename = self.filename + "." + str(os.getpid())
+
+        with open(temporary_filename, 'w') as outputfile:
+            json.dump(cache, outputfile)
+
+        os.replace(temporary_filename, self.filename)
@@ -1,6 +1,13 @@
 CUT_OFF_ZERO = 1e-10            # when to treat a low number as zero
 MAX_DATAFILE_SIZE = 500e6       # in bytes
+SPLIT_ROW_LIMIT = 6e6           # maximum amount of lines in one part of a coordinate file that is too big
+ALIGNMENT_BATCH_SIZE = 100000   # amount of fragments that is aligned at once
+READ_CHUNK_SIZE = 50000         # amount of fragments that is read from the coordinate file at once
 STANDARD_RES = 0.3              # standard binsize in angstrom
 STANDARD_THRESHOLD = 0.1        # standard threshold is 10% of maximum bin
 RMSE_TEST = 0.1                 # if rmse central model higher than this value, the program will try to reset the labels
+MAX_LABEL_ITERATIONS = 100      # maximum amount of times the labels are reset before the centers stop moving
+MAX_PERMUTATION_ATOMS = 7       # central groups up to this size get new labels by trying all permutations of the atoms
 STANDARD_EXTRA_VDW = 0.5        # standard extra overlap is 0.5 Angstrom
+VOLUME_CACHE_SIZE = 256         # amount of volume results that is remembered per central group
+DENSITY_CACHE_SIZE = 500e6      # in bytes, memory the density slider may use for density grids
@@ -11,11 +11,11 @@ import math
 import sys
 
 import matplotlib.pyplot as plt
-import pandas as pd
 from matplotlib.widgets import Button, Slider
 from mpl_toolkits.mplot3d import Axes3D
 from constants.paths import WORKDIR
 from classes.Settings import Settings
+from classes.Session import Session
 from helpers.plot_functions import plot_fragment_colored, plot_density
 
 from constants.constants import STANDARD_THRESHOLD, STANDARD_RES
@@ -34,16 +34,16 @@ def main():
     settings.set_threshold(STANDARD_THRESHOLD)
     settings.set_contact_reference_point(sys.argv[2])
 
-    avg_fragment = pd.read_csv(settings.get_avg_frag_filename())
+    make_density_slider_plot(Session(settings))
 
-    make_density_slider_plot(avg_fragment, settings)
 
+def make_density_slider_plot(session):
+    # the grids stay in the session, so changing the threshold or going back to a resolution does not read the file
+    # again
+    settings = session.settings
+    avg_fragment = session.get_central_model()
 
-def make_density_slider_plot(avg_fragment, settings):
-    df = pd.read_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
-    df[settings.contact_rp] = df[settings.contact_rp] / df[settings.contact_rp].sum()
-
-    maximum = df[settings.contact_rp].max()
+    density_grid = session.get_density_grid()
 
     fig = plt.figure(figsize=(8, 5))
 
@@ -53,7 +53,7 @@ def make_density_slider_plot(avg_fragment, settings):
     ax = plot_fragment_colored(ax, avg_fragment)
 
     global p
-    p, ax = plot_density(ax=ax, df=df, settings=settings)
+    p, ax = plot_density(ax=ax, density_grid=density_grid, settings=settings)
 
     title = f"{settings.central_name}--{settings.contact_name} ({settings.contact_rp}) density\n"
     title += f"Resolution: {settings.resolution :.2f}, fraction: {settings.threshold :.2f}"
@@ -82,18 +82,15 @@ def make_density_slider_plot(avg_fragment, settings):
     ax_lowerlim = plt.axes([0.25, 0.1, 0.65, 0.03], facecolor=axcolor)
     lowerlim = Slider(ax_lowerlim, 'Lim', 0, 1, valinit=settings.threshold, valstep=0.01)
 
-    percentage = round(df[df[settings.contact_rp] >=
-                          settings.threshold * maximum][settings.contact_rp].sum() * 100, 2)
-    text_holder = fig.text(.25, .05, f"Showing {percentage}% of all data")
+    # the data fraction, cluster volume and directionality of every threshold are looked up in the curve
+    text_holder = fig.text(.25, .05, get_statistics_text(session))
 
     # update everything
     def update_res(val):
         print("\nChanged resolution to:", round(val, 2))
         settings.set_resolution(round(val, 2))
         print(f"Threshold: {settings.threshold}")
-        df = pd.read_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
-        df[settings.contact_rp] = df[settings.contact_rp] / df[settings.contact_rp].sum()
-        maximum = df[settings.contact_rp].max()
+        density_grid = session.get_density_grid()
 
         global p
 
@@ -108,12 +105,10 @@ def make_density_slider_plot(avg_fragment, settings):
         title += f"Resolution: {settings.resolution :.2f}, fraction: {settings.threshold :.2f}"
         ax.set_title(title)
 
-        p, ax1 = plot_density(ax=ax, df=df, settings=settings)
+        p, ax1 = plot_density(ax=ax, density_grid=density_grid, settings=settings)
         ax1 = plot_fragment_colored(ax1, avg_fragment)
 
-        percentage = round(df[df[settings.contact_rp] >=
-                              settings.threshold * maximum][settings.contact_rp].sum() * 100, 2)
-        text_holder.set_text(f"Showing {percentage}% of all data")
+        text_holder.set_text(get_statistics_text(session))
 
         cbar = fig.colorbar(p, cax=cax, pad=0.2)
 
@@ -126,9 +121,7 @@ def make_density_slider_plot(avg_fragment, settings):
         print("Resolution:", settings.resolution)
         global p
 
-        df = pd.read_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
-        df[settings.contact_rp] = df[settings.contact_rp] / df[settings.contact_rp].sum()
-        maximum = df[settings.contact_rp].max()
+        density_grid = session.get_density_grid()
 
         settings.set_threshold(round(val, 2))
 
@@ -139,21 +132,16 @@ def make_density_slider_plot(avg_fragment, settings):
         ax.set_ylim(ylim)
         ax.set_zlim(zlim)
 
-        _, ax1 = plot_density(ax=ax, df=df, settings=settings)
+        _, ax1 = plot_density(ax=ax, density_grid=density_grid, settings=settings)
         ax1 = plot_fragment_colored(ax1, avg_fragment)
 
         title = f"{settings.central_name}--{settings.contact_name} ({settings.contact_rp}) density\n"
         title += f"Resolution: {settings.resolution :.2f}, fraction: {settings.threshold :.2f}"
         ax.set_title(title)
 
-        no_bins_cluster = len(df[df[settings.contact_rp] >= settings.threshold * maximum])
-        bins_cluster = df[df[settings.contact_rp] >= settings.threshold * maximum]
-
-        percentage = round(bins_cluster[settings.contact_rp].sum() * 100, 2)
+        text_holder.set_text(get_statistics_text(session))
 
-        text_holder.set_text(f"Showing {percentage}% of all data")
-
-        print(f"Volume: {no_bins_cluster*settings.resolution**3 :.2f}")
+        print(f"Volume: {session.get_directionality_curve().loc[settings.threshold, 'Vcluster'] :.2f}")
 
         cbar = fig.colorbar(p, cax=cax, pad=0.2)
 
@@ -175,5 +163,15 @@ def make_density_slider_plot(avg_fragment, settings):
     plt.show()
 
 
+def get_statistics_text(session):
+    """ Returns the text under the slider with the data fraction and directionality at the threshold of the settings.
+        """
+
+    statistics = session.get_directionality_curve().loc[session.settings.threshold]
+
+    return f"Showing {round(statistics.datafrac * 100, 2)}% of all data, " +\
+        f"directionality: {statistics.directionality :.2f}"
+
+
 if __name__ == "__main__":
     main()
@@ -7,58 +7,143 @@
 # Author: Natasja Wezel
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
+import io
+from itertools import islice
+
 import numpy as np
 import pandas as pd
 
+from constants.constants import READ_CHUNK_SIZE
 
-def read_raw_data(filename, no_atoms):
-    """ Reads the raw datafiles making use of a logical function. One part reads the fragments their coordinates
-        and the other part reads the structure names. """
 
-    print("Pandas is reading csv..." + filename)
+def read_raw_data(filename, no_atoms, chunk_size=READ_CHUNK_SIZE):
+    """ Reads the raw datafile in a single pass. Each fragment consists of a header line containing the structure
+        name and no_atoms lines with the coordinates of the atoms. The file is read chunk_size fragments at a time,
+        and the coordinates are put in arrays that are allocated before reading, so only one chunk of text is in
+        memory at the same time. The layout of each chunk is checked while reading. """
 
-    # use amount of atoms for skiprow function to read into df immediately
-    data = pd.read_csv(filename, sep='\\s+', usecols=[0, 1, 2, 3], names=['_id', 'x', 'y', 'z'],
-                       header=None,
-                       skiprows=lambda x: logic(x, no_atoms))
+    print("Reading coordinates..." + filename)
 
-    # get the actual symbols of each atom
-    data['symbol'] = data.apply(lambda row: get_atom_symbol(row), axis=1)
+    no_fragments = count_fragments(filename, no_atoms)
 
-    # use amount of atoms for skiprow function to read only the structures from the data
-    structures = pd.read_csv(filename, sep='*', usecols=[0], names=['structure_id'],
-                             header=None,
-                             skiprows=lambda x: not logic(x, no_atoms))
+    # prepare arrays for all atoms and a list for all structure names
+    ids = np.empty(no_fragments * no_atoms, dtype=object)
+    coordinates = np.empty((no_fragments * no_atoms, 3))
+    structure_ids = []
 
-    structures['structure_id'] = structures['structure_id'].str.rstrip()
+    with open(filename) as inputfile:
+        for start in range(0, no_fragments, chunk_size):
+            amount = min(chunk_size, no_fragments - start)
 
-    structures['rmse'] = 0
-    structures['mirrored'] = False
+            chunk, chunk_structure_ids = read_chunk(inputfile, no_atoms, start, amount)
+
+            ids[start * no_atoms:(start + amount) * no_atoms] = chunk['_id'].to_numpy()
+            coordinates[start * no_atoms:(start + amount) * no_atoms] = chunk[['x', 'y', 'z']].to_numpy()
+            structure_ids.extend(chunk_structure_ids)
+
+    data = pd.DataFrame(coordinates, columns=['x', 'y', 'z'])
+    data.insert(0, '_id', ids)
+
+    data, structures = finish_raw_data(data, structure_ids)
 
     print("Done")
 
     return data, structures
 
 
-def get_atom_symbol(row):
-    """ Regex the row id to get the actual name of the element. """
+def iterate_raw_data(filename, no_atoms, chunk_size=READ_CHUNK_SIZE):
+    """ Reads the raw datafile like read_raw_data, but yields the data and structures of each chunk of chunk_size
+        fragments separately, so only one chunk is in memory at the same time. """
+
+    print("Reading coordinates in chunks..." + filename)
+
+    no_fragments = count_fragments(filename, no_atoms)
+
+    with open(filename) as inputfile:
+        for start in range(0, no_fragments, chunk_size):
+            amount = min(chunk_size, no_fragments - start)
+
+            chunk, structure_ids = read_chunk(inputfile, no_atoms, start, amount)
+
+            yield finish_raw_data(chunk, structure_ids)
+
+
+def count_fragments(filename, no_atoms):
+    """ Returns the amount of fragments in the raw datafile, and checks that the file only contains whole fragments.
+        """
+
+    lines_per_fragment = no_atoms + 1
+    no_lines = count_lines(filename)
 
-    # if second symbol is a number, return only first character
-    if row._id[1] in '0123456789':
-        return row._id[:1]
+    assert no_lines % lines_per_fragment == 0, "The amount of lines in the coordinate file is not a multiple of the " +\
+        "amount of atoms per fragment plus its header"
 
-    # else, its br, cl etc. so return first 2 characters
-    return row._id[:2]
+    return no_lines // lines_per_fragment
 
 
-def logic(index, amount_atoms):
-    """ Logic function to skip each header line - or read only the headers for the structure names - when reading
-        in the data. """
+def read_chunk(inputfile, no_atoms, start, amount):
+    """ Reads the next amount fragments from an opened raw datafile. Returns a dataframe with the id and coordinates
+        of each atom, and the structure name of each fragment. """
 
-    if index % (amount_atoms + 1) == 0:
-        return True
-        
-    return False
+    lines_per_fragment = no_atoms + 1
+    lines = list(islice(inputfile, amount * lines_per_fragment))
+
+    # every fragment starts with a header, the rest of the lines are atoms
+    headers = lines[::lines_per_fragment]
+    del lines[::lines_per_fragment]
+
+    assert all("FRAG" in header for header in headers), "Fragment " + str(start) + " to " +\
+        str(start + amount) + " do not have " + str(no_atoms) + " atoms like the first fragment"
+
+    structure_ids = [header.split('*', 1)[0].rstrip() for header in headers]
+
+    chunk = pd.read_csv(io.StringIO("".join(lines)), sep='\\s+', usecols=[0, 1, 2, 3],
+                        names=['_id', 'x', 'y', 'z'], header=None)
+
+    assert not chunk[['x', 'y', 'z']].isnull().values.any(), "Found an atom without coordinates in " +\
+        "fragment " + str(start) + " to " + str(start + amount)
+
+    return chunk, structure_ids
+
+
+def finish_raw_data(data, structure_ids):
+    """ Adds the element symbols to the atoms, and makes the structures dataframe. """
+
+    # get the actual symbols of each atom
+    data['symbol'] = get_atom_symbols(data['_id'])
+
+    structures = pd.DataFrame({'structure_id': structure_ids})
+
+    structures['rmse'] = 0
+    structures['mirrored'] = False
+
+    return data, structures
+
+
+def count_lines(filename):
+    """ Counts the lines in a file by reading it in binary blocks. """
+
+    no_lines, last_block = 0, b''
+
+    with open(filename, 'rb') as inputfile:
+        for block in iter(lambda: inputfile.read(2**20), b''):
+            no_lines += block.count(b'\n')
+            last_block = block
+
+    # the last line does not need to end with a newline
+    if last_block and not last_block.endswith(b'\n'):
+        no_lines += 1
+
+    return no_lines
+
+
+def get_atom_symbols(ids):
+    """ Gets the actual names of the elements from the atom ids. """
+
+    # if second symbol is a number, take only first character, else its br, cl etc. so take first 2 characters
+    one_character = ids.str[1].isin(list('0123456789'))
+
+    return np.where(one_character, ids.str[:1], ids.str[:2])
 
 
 def kabsch_align(A, B, B2, n):
@@ -94,6 +179,40 @@ def kabsch_align(A, B, B2, n):
     return B2.T
 
 
+def kabsch_align_all(A, B_central, B_total):
+    """ Performs the kabsch algorithm for a batch of fragments at once. A is the central group of the reference
+        fragment (n x 3), B_central contains the central groups (fragments x n x 3) and B_total all atoms
+        (fragments x atoms x 3) of the fragments to align. All covariance matrices, rotations and translations are
+        calculated at once, and the aligned fragments are returned in the shape of B_total. """
+
+    assert A.shape[0] == B_central.shape[1], "Fragment 1 and fragments to align do not have the same length"
+
+    # center the points
+    centroid_A = np.mean(A, axis=0)
+    centroid_B = np.mean(B_central, axis=1)
+    AA = A - centroid_A
+    BB = B_central - centroid_B[:, np.newaxis, :]
+
+    # one covariance matrix per fragment
+    H = np.einsum('fni,nj->fij', BB, AA)
+
+    # decompose into singular values, numpy does this for the whole stack of matrices
+    U, S, Vt = np.linalg.svd(H)
+
+    V, Ut = np.transpose(Vt, (0, 2, 1)), np.transpose(U, (0, 2, 1))
+    rotation_matrices = np.matmul(V, Ut)
+
+    # special reflection case
+    reflected = np.linalg.det(rotation_matrices) < 0
+    if reflected.any():
+        Vt[reflected, 2, :] *= -1
+        rotation_matrices[reflected] = np.matmul(np.transpose(Vt[reflected], (0, 2, 1)), Ut[reflected])
+
+    translation_vectors = centroid_A - np.einsum('fij,fj->fi', rotation_matrices, centroid_B)
+
+    return np.einsum('fij,faj->fai', rotation_matrices, B_total) + translation_vectors[:, np.newaxis, :]
+
+
 def perform_translation(fragment, index_center):
     """ Lays the atom on index_center on the origin and moves the rest of the atoms as well. """
 
@@ -236,3 +355,12 @@ def calc_rmse(A, B, n):
     err = np.sum(err)
 
     return np.sqrt(err / n)
+
+
+def calc_rmse_all(A, B):
+    """ Calculate the RMSE of matrix A with each matrix in the stack B (fragments x n x 3). A can also be a stack of
+        the same shape as B, to compare every fragment with its own matrix. """
+
+    err = B - A
+
+    return np.sqrt(np.einsum('fni,fni->f', err, err) / B.shape[1])
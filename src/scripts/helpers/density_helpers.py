@@ -14,6 +14,8 @@ import pandas as pd
 from numba import jit
 from numba import prange
 
+from classes.DensityGrid import DensityGrid
+
 
 def calculate_no_bins(resolution, limits):
     """ Calculates the number of bins needed between a minimum and a maximum at a certain resolution.
@@ -32,136 +34,212 @@ def calculate_no_bins(resolution, limits):
 
 
 def make_density_df(settings, coordinate_df, again=False):
-    """ Make density df if it doesn't already exists. """
+    """ Make density grid if it doesn't already exists. """
 
     try:
         if again:
             raise KeyError
-        density_df = pd.read_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
-        print("Density df already existed, loaded from file")
+        density_grid = DensityGrid.read_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
+        print("Density grid already existed, loaded from file")
     except (FileNotFoundError, KeyError):
 
-        # prepare empty df
-        empty_density_df = prepare_df(df=coordinate_df, settings=settings)
+        with settings.profiler.stage('density'):
+            contact_coordinates = np.transpose(np.array([coordinate_df.x,
+                                                         coordinate_df.y,
+                                                         coordinate_df.z], dtype='float64'))
+
+            # count data per bin
+            density_grid = make_density_grid(contact_coordinates, settings.resolution, settings.contact_rp)
+
+            # save so we can use the data but only change the plot - saves time :)
+            density_grid.to_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
+
+        settings.profiler.add_items('density', len(contact_coordinates))
+
+    return density_grid
+
+
+def make_density_grids(settings, coordinate_df, resolutions, again=False):
+    """ Makes the density grids of several resolutions at once, and returns them in a dictionary with the resolution
+        as key. The grids that already exist are loaded, unless again is True or a list that contains their
+        resolution. For the others, the contact points and their limits are only collected once, the points are
+        counted for all resolutions in one pass, and all new grids are saved in one write. """
+
+    filename = settings.get_density_df_filename()
+
+    # find the key of each resolution, without changing the resolution of the settings
+    current_resolution = settings.resolution
+    keys = {}
+    for resolution in resolutions:
+        settings.set_resolution(resolution)
+        keys[settings.resolution] = settings.get_density_df_key()
+    settings.set_resolution(current_resolution)
+
+    if again is True:
+        again = resolutions
+    again = [round(resolution, 2) for resolution in again] if again else []
+
+    density_grids = {}
+    if len(again) < len(keys):
+        try:
+            with pd.HDFStore(filename, mode='r') as store:
+                for resolution, key in keys.items():
+                    if resolution in again:
+                        continue
+                    try:
+                        density_grids[resolution] = DensityGrid.get(store, key)
+                    except KeyError:
+                        pass
+        except FileNotFoundError:
+            pass
+
+    missing = [resolution for resolution in keys if resolution not in density_grids]
+
+    if len(missing) > 0:
+        contact_coordinates = np.transpose(np.array([coordinate_df.x,
+                                                     coordinate_df.y,
+                                                     coordinate_df.z], dtype='float64'))
+        limits = contact_coordinates.min(axis=0), contact_coordinates.max(axis=0)
+
+        new_grids = make_density_grid_per_resolution(contact_coordinates, missing, settings.contact_rp, limits)
+
+        DensityGrid.write_hdf(filename, {keys[resolution]: grid for resolution, grid in new_grids.items()})
+        density_grids.update(new_grids)
 
-        # count data per bin
-        density_df = count_data_points_per_bin(df=empty_density_df, contact_points_df=coordinate_df, settings=settings)
+    return density_grids
 
-        # normalize
-        density_df['datafrac_normalized'] = (density_df[settings.contact_rp] /
-                                             density_df[settings.contact_rp].sum())
 
-        # save so we can use the data but only change the plot - saves time :)
-        density_df.to_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
+def make_density_grid(contact_coordinates, resolution, contact_rp, limits=None):
+    """ Divides the space around the contact points into bins and counts the amount of points in each bin. The
+        minimum and maximum coordinates of the contact points can be given, if they are already known. """
 
-    return density_df
+    if limits is None:
+        limits = contact_coordinates.min(axis=0), contact_coordinates.max(axis=0)
 
+    shape, origin = get_grid_layout(resolution, limits)
 
-def count_data_points_per_bin(df, contact_points_df, settings):
-    """ Counts the amount of datapoints that is in a bin. """
+    print(f"Counting points per bin, amount of bins: {np.prod(shape)}")
 
-    contact_points_df = contact_points_df
+    amount = fill_bins(contact_coordinates, origin, resolution, shape)
 
-    print("Counting points per bin: ")
-    # prepare vector that will contain the amount
-    amount = np.zeros(len(df))
+    assert amount.sum() == len(contact_coordinates), "Something went wrong with filling bins" + str(amount.sum())\
+        + " " + str(len(contact_coordinates))
 
-    bin_coordinates = np.array([df.xstart, df.ystart, df.zstart])
-    contact_coordinates = np.transpose(np.array([contact_points_df.x,
-                                                 contact_points_df.y,
-                                                 contact_points_df.z]))
+    return DensityGrid(amount.reshape(shape), origin, resolution, contact_rp)
 
-    amount = fill_bins(amount, bin_coordinates, contact_coordinates, settings.resolution)
 
-    assert amount.sum() == len(contact_points_df), "Something went wrong with filling bins" + str(amount.sum())\
-        + " " + str(len(contact_points_df))
+def make_density_grid_per_resolution(contact_coordinates, resolutions, contact_rp, limits):
+    """ Makes the density grids of several resolutions in one pass over the contact points, instead of one pass per
+        resolution. The bins of each point are calculated in the same way as in fill_bins, so the grids are the same
+        as the grids make_density_grid makes. Returns a dictionary with the resolution as key. """
 
-    df[settings.contact_rp] = amount
+    layouts = [get_grid_layout(resolution, limits) for resolution in resolutions]
 
-    return df
+    for shape, _ in layouts:
+        print(f"Counting points per bin, amount of bins: {np.prod(shape)}")
 
+    # the counts of all grids are put after each other in one flat array
+    shapes = np.array([shape for shape, _ in layouts], dtype=np.int64)
+    origins = np.array([origin for _, origin in layouts], dtype='float64')
+    starts = np.concatenate([[0], np.cumsum(np.prod(shapes, axis=1))])
 
-def fill_bins(amount, bin_coordinates, contact_coordinates, resolution):
-    """ Count how many datapoints there are in each bin. """
+    counts = np.zeros(starts[-1], dtype=np.int64)
+    fill_bins_per_resolution(np.ascontiguousarray(contact_coordinates, dtype='float64'), origins,
+                             np.array(resolutions, dtype='float64'), shapes, starts, counts)
 
-    x, y, z = 0, 1, 2
-    i = 0
-    total = len(contact_coordinates)
+    density_grids = {}
+    for i, (resolution, (shape, origin)) in enumerate(zip(resolutions, layouts)):
+        # a copy, so the counts of the other grids are freed when this grid is kept longer
+        amount = counts[starts[i]:starts[i + 1]].copy()
 
-    for i in range(total):
-        cor = contact_coordinates[i]
-        cor = np.array([cor[x], cor[y], cor[z]], dtype='float32')
-        cor_res = np.array([cor[x] - resolution,
-                            cor[y] - resolution,
-                            cor[z] - resolution], dtype='float32')
+        assert amount.sum() == len(contact_coordinates), "Something went wrong with filling bins" + str(amount.sum())\
+            + " " + str(len(contact_coordinates))
 
-        idx = np.where((bin_coordinates[x] <= cor[x]) & (cor_res[x] <= bin_coordinates[x]) &
-                       (bin_coordinates[y] <= cor[y]) & (cor_res[y] <= bin_coordinates[y]) &
-                       (bin_coordinates[z] <= cor[z]) & (cor_res[z] <= bin_coordinates[z]))
+        density_grids[resolution] = DensityGrid(amount.reshape(shape), origin, resolution, contact_rp)
 
-        if len(idx[0]) > 1:
-            #  because of floating point imprecision, sometimes bins overlap, so get first bin
-            amount[idx[0][0]] += 1
-        elif len(idx[0]) == 0:
-            print("Oh no this is going wrong")
-            print(cor, cor_res)
-        else:
-            amount[idx] += 1
+    return density_grids
 
-        if i % 5000 == 0:
-            print(i, "/", total)
 
-    return amount
+def get_grid_layout(resolution, limits):
+    """ Returns the shape and the origin of the grid that holds all points between the limits at the resolution. """
 
+    shape, origin = [], []
 
-def prepare_df(df, settings):
-    """ Prepares an empty df containing the coordinates for all the bins. """
+    for minimum, maximum in zip(*limits):
+        no_bins, minimum, maximum = calculate_no_bins(resolution=resolution, limits=[minimum, maximum])
 
-    maxx, maxy, maxz = df.x.max(), df.y.max(), df.z.max()
-    minx, miny, minz = df.x.min(), df.y.min(), df.z.min()
+        shape.append(no_bins)
+        origin.append(minimum)
 
-    no_bins_x, minx, maxx = calculate_no_bins(resolution=settings.resolution, limits=[minx, maxx])
-    no_bins_y, miny, maxy = calculate_no_bins(resolution=settings.resolution, limits=[miny, maxy])
-    no_bins_z, minz, maxz = calculate_no_bins(resolution=settings.resolution, limits=[minz, maxz])
+    return tuple(shape), np.array(origin)
 
-    amount_bins = no_bins_x * no_bins_y * no_bins_z
 
-    print(f"Preparing df, amount of bins: {amount_bins}")
-    print(f"X Range: ({minx :.2f},{maxx :.2f}), Y Range: ({miny :.2f},{maxy :.2f}), Z Range: ({minz :.2f},{maxz :.2f})")
+def add_to_density_grid(density_grid, contact_coordinates, limits, resolution, contact_rp):
+    """ Adds contact points to a density grid, for when the contact points come in parts. limits contains the minimum
+        and maximum coordinates of all points so far, including the new ones. The grid is made larger when the limits
+        change. Since calculate_no_bins always puts the bin centers at multiples of the resolution, the bins of the
+        old grid are also bins of the new grid, and their counts are moved over as they are. Returns the new grid. """
 
-    indices = [i for i in range(0, amount_bins)]
+    shape, origin, bins_neg = [], [], []
 
-    bins = [np.linspace(minx, maxx, num=no_bins_x, endpoint=False),
-            np.linspace(miny, maxy, num=no_bins_y, endpoint=False),
-            np.linspace(minz, maxz, num=no_bins_z, endpoint=False)]
+    for minimum, maximum in zip(*limits):
+        no_bins, minimum, _ = calculate_no_bins(resolution=resolution, limits=[minimum, maximum])
 
-    df = add_boundaries_per_bin(bins, indices)
-    df[settings.contact_rp] = 0
+        shape.append(no_bins)
+        origin.append(minimum)
+        bins_neg.append(round(-minimum / resolution - 0.5))
 
-    return df
+    shape, origin, bins_neg = tuple(shape), np.array(origin), np.array(bins_neg)
 
+    counts = fill_bins(contact_coordinates, origin, resolution, shape).reshape(shape)
 
-def add_boundaries_per_bin(bins, indices):
-    """ Adds bins with boundaries to a dataframe. """
+    if density_grid is not None:
+        # the old grid has its own amount of bins below zero, move its bins with the difference
+        old_bins_neg = np.round(-density_grid.origin / resolution - 0.5).astype(np.int64)
 
-    bins_x, bins_y, bins_z = bins[0], bins[1], bins[2]
+        ix, iy, iz = np.nonzero(density_grid.counts)
+        offset = bins_neg - old_bins_neg
 
-    xl, yl, zl = len(bins_x), len(bins_y), len(bins_z)
+        counts[ix + offset[0], iy + offset[1], iz + offset[2]] += density_grid.counts[ix, iy, iz]
 
-    xstart_list = np.repeat(bins_x, (yl * zl))
-    ystart_list = list(np.repeat(bins_y, zl)) * xl
-    zstart_list = list(bins_z) * (xl * yl)
+    return DensityGrid(counts, origin, resolution, contact_rp)
 
-    df = pd.DataFrame(np.array([xstart_list, ystart_list, zstart_list]).T,
-                      columns=['xstart', 'ystart', 'zstart'],
-                      index=indices)
 
-    df = df.apply(pd.to_numeric, downcast='float', errors='coerce')
+def fill_bins(contact_coordinates, origin, resolution, shape):
+    """ Count how many datapoints there are in each bin. The index of the bin of each point is calculated directly
+        from the origin of the grid and the resolution. Bins include their lower edge and exclude their upper edge,
+        so a point on the edge between two bins always ends up in the upper one. Only points on the outer edge of the
+        grid are put in the last bin. Returns the counts of the flattened grid. """
 
-    return df
+    bin_indices = np.floor((contact_coordinates - origin) / resolution).astype(np.int64)
+    bin_indices = np.clip(bin_indices, 0, np.array(shape) - 1)
 
+    flat_indices = np.ravel_multi_index(bin_indices.T, shape)
 
-@jit(nopython=True, parallel=True)
+    return np.bincount(flat_indices, minlength=int(np.prod(shape)))
+
+
+@jit(nopython=True, cache=True)
+def fill_bins_per_resolution(contact_coordinates, origins, resolutions, shapes, starts, counts):
+    """ Counts the points per bin for several grids at once, like fill_bins does for one grid. Each point is read once
+        and added to the bin it is in in every grid. The counts of grid r are counts[starts[r]:starts[r + 1]]. """
+
+    for i in range(contact_coordinates.shape[0]):
+        for r in range(resolutions.shape[0]):
+            flat_index = 0
+
+            for axis in range(3):
+                index = np.int64(np.floor((contact_coordinates[i, axis] - origins[r, axis]) / resolutions[r]))
+                index = min(max(index, 0), shapes[r, axis] - 1)
+
+                flat_index = flat_index * shapes[r, axis] + index
+
+            counts[starts[r] + flat_index] += 1
+
+    return counts
+
+
+@jit(nopython=True, parallel=True, cache=True)
 def calc_distances(in_vdw_volume, bin_coordinates, avg_f_p, indices, extra):
     """ Calc distances from contact rp's to closest atom from the central group model. """
 
@@ -177,87 +255,82 @@ def calc_distances(in_vdw_volume, bin_coordinates, avg_f_p, indices, extra):
     return in_vdw_volume
 
 
-def find_min_max_bounds(avg_fragment, extra):
-    """ Find minimum and maximum coordinates of the central model. """
-
-    avg_fragment['minx'] = avg_fragment['x'] - avg_fragment['vdw_radius'] - extra
-    avg_fragment['miny'] = avg_fragment['y'] - avg_fragment['vdw_radius'] - extra
-    avg_fragment['minz'] = avg_fragment['z'] - avg_fragment['vdw_radius'] - extra
-    avg_fragment['maxx'] = avg_fragment['x'] + avg_fragment['vdw_radius'] + extra
-    avg_fragment['maxy'] = avg_fragment['y'] + avg_fragment['vdw_radius'] + extra
-    avg_fragment['maxz'] = avg_fragment['z'] + avg_fragment['vdw_radius'] + extra
-
-    return avg_fragment
+def calc_vdw_volumes(avg_fragment, extra, resolution):
+    """ Calculates in one pass the volumes that are needed for the available volume:
+            - central: the vdw volume of the whole central group
+            - R: the vdw volume of only the R atoms
+            - expanded: the volume of the atoms that are not R, with the radii increased by extra
+            - total: the volume of the whole central group, with the radii increased by extra
 
+        The bins are those of the density grids, with their centers at multiples of the resolution. A bin is part of
+        a volume if its center is inside one of the spheres. Each sphere only visits the bins in its own bounding box
+        and sets its bit in one shared grid, so every volume is a count of one bit. """
 
-def calc_vdw_vol_central(avg_fragment, extra, resolution):
-    """ Input: the coordinates of the average fragment, the resolution on which we are calculating and the radius
-        of the contact group + 0.5.
+    is_R = avg_fragment.label.str.upper().str.contains("R").to_numpy()
+    points = np.array([avg_fragment.x, avg_fragment.y, avg_fragment.z], dtype='float64').T
+    vdw_radii = np.array(avg_fragment.vdw_radius, dtype='float64')
 
-        Output: dataframe with defined bins and whether they are in the volume or not, and the amount of bins that is
-        in the vdw volume.
+    central, R, expanded, total = 1, 2, 4, 8
 
-        0.1 provides an accurate and semi-instantaneous calculation, see thesis. """
+    spheres = np.concatenate([points, points[is_R], points[~is_R], points])
+    sphere_radii = np.concatenate([vdw_radii, vdw_radii[is_R], vdw_radii[~is_R] + extra, vdw_radii + extra])
+    sphere_flags = np.concatenate([np.full(len(points), central), np.full(is_R.sum(), R),
+                                   np.full((~is_R).sum(), expanded), np.full(len(points), total)]).astype(np.uint8)
 
-    avg_fragment = find_min_max_bounds(avg_fragment, extra)
+    # the grid fits all spheres, with one spare bin on each side
+    lower = np.floor((spheres - sphere_radii[:, np.newaxis]).min(axis=0) / resolution).astype(np.int64) - 1
+    upper = np.ceil((spheres + sphere_radii[:, np.newaxis]).max(axis=0) / resolution).astype(np.int64) + 1
 
-    minx, miny, minz = avg_fragment['minx'].min(), avg_fragment['miny'].min(), avg_fragment['minz'].min()
-    maxx, maxy, maxz = avg_fragment['maxx'].max(), avg_fragment['maxy'].max(), avg_fragment['maxz'].max()
+    flags = np.zeros(upper - lower + 1, dtype=np.uint8)
+    flags = rasterize_spheres(flags, lower, resolution, spheres, sphere_radii, sphere_flags)
 
-    no_bins_x, minx, maxx = calculate_no_bins(resolution=resolution, limits=[minx, maxx])
-    no_bins_y, miny, maxy = calculate_no_bins(resolution=resolution, limits=[miny, maxy])
-    no_bins_z, minz, maxz = calculate_no_bins(resolution=resolution, limits=[minz, maxz])
+    return [np.count_nonzero(flags & flag) * resolution**3 for flag in [central, R, expanded, total]]
 
-    amount_bins = no_bins_x * no_bins_y * no_bins_z
-    indices = [i for i in range(0, amount_bins)]
 
-    bins = [np.linspace(minx, maxx, num=no_bins_x, endpoint=False),
-            np.linspace(miny, maxy, num=no_bins_y, endpoint=False),
-            np.linspace(minz, maxz, num=no_bins_z, endpoint=False)]
+@jit(nopython=True, parallel=True, cache=True)
+def rasterize_spheres(flags, lower, resolution, spheres, sphere_radii, sphere_flags):
+    """ Sets the flag of each sphere in the bins of which the center lies inside that sphere. The bin with index
+        (i, j, k) has its center at (lower + (i, j, k)) * resolution. """
 
-    df = add_boundaries_per_bin(bins, indices)
+    for s in range(len(spheres)):
+        radius = sphere_radii[s]
 
-    # the bin counts as inside the vdw radius only if the center is in that radius
-    df['x_center'] = df.xstart + 0.5 * resolution
-    df['y_center'] = df.ystart + 0.5 * resolution
-    df['z_center'] = df.zstart + 0.5 * resolution
+        # the bounding box of the sphere in grid indices
+        first = np.floor((spheres[s] - radius) / resolution).astype(np.int64) - lower
+        last = np.ceil((spheres[s] + radius) / resolution).astype(np.int64) - lower
 
-    part_density = df[(df.x_center < maxx) & (df.x_center > minx) &
-                      (df.y_center < maxy) & (df.y_center > miny) &
-                      (df.z_center < maxz) & (df.z_center > minz)]
+        for i in prange(max(first[0], 0), min(last[0] + 1, flags.shape[0])):
+            dx = (lower[0] + i) * resolution - spheres[s, 0]
 
-    bin_coordinates = np.transpose(np.array([part_density.x_center, part_density.y_center, part_density.z_center]))
+            for j in range(max(first[1], 0), min(last[1] + 1, flags.shape[1])):
+                dy = (lower[1] + j) * resolution - spheres[s, 1]
 
-    in_vdw_vol = np.zeros(len(df))
+                for k in range(max(first[2], 0), min(last[2] + 1, flags.shape[2])):
+                    dz = (lower[2] + k) * resolution - spheres[s, 2]
 
-    for i, atom in avg_fragment.iterrows():
-        indices = np.transpose(np.where(in_vdw_vol == 0))
+                    if np.sqrt(dx**2 + dy**2 + dz**2) < radius:
+                        flags[i, j, k] |= sphere_flags[s]
 
-        fragment_point = np.array([atom.x, atom.y, atom.z, atom.vdw_radius])
+    return flags
 
-        in_vdw_vol = calc_distances(in_vdw_vol, bin_coordinates, fragment_point, indices, extra)
 
-    total = np.sum(in_vdw_vol)
+def find_available_volume(avg_fragment, extra, total=False, resolution=0.1, cache=None):
+    """ Find the available volume. If a VolumeCache is given, the volumes are only calculated if they are not
+        already saved for this central model. """
 
-    return total * resolution**3
+    volumes = None
+    if cache is not None:
+        volumes = cache.get_volumes(avg_fragment, extra, resolution)
 
+    if volumes is None:
+        volumes = calc_vdw_volumes(avg_fragment, extra, resolution)
 
-def find_available_volume(avg_fragment, extra, total=False, resolution=0.1):
-    """ Find the available volume. """
+        if cache is not None:
+            cache.add_volumes(avg_fragment, extra, resolution, volumes)
 
-    avg_fragment["label"] = avg_fragment["label"].str.upper()
-    avg_fragment_without_R = avg_fragment[~avg_fragment.label.str.contains("R")].copy()
-    only_R = avg_fragment[avg_fragment.label.str.contains("R")].copy()
+    volume_central, volume_R_min, volume_max, volume_total = volumes
 
     if total:
-        return calc_vdw_vol_central(avg_fragment=avg_fragment, extra=extra, resolution=resolution)
-
-    volume_central = calc_vdw_vol_central(avg_fragment=avg_fragment, extra=0, resolution=resolution)
-    volume_max = calc_vdw_vol_central(avg_fragment=avg_fragment_without_R, extra=extra, resolution=resolution)
-
-    volume_R_min = 0
-
-    if len(only_R) > 0:
-        volume_R_min = calc_vdw_vol_central(avg_fragment=only_R, extra=0, resolution=resolution)
+        return volume_total
 
     return (volume_max) - (volume_central - volume_R_min/2)
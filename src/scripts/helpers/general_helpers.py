@@ -2,11 +2,12 @@
 # This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
 # thesis in the Master Computational Science, University of Amsterdam, 2021.
 #
-# `general_helpers` contains a function for splitting large file and a check if label exists
+# `general_helpers` contains a function for splitting large file, one for hashing a file and a check if label exists
 #
 # Author: Natasja Wezel
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
+import hashlib
 import os
 import csv
 
@@ -21,6 +22,17 @@ def check_if_label_exists(atom, fragment):
     return atom
 
 
+def hash_file(filename):
+    """ Returns the sha1 hash of the contents of a file, read in blocks so big files do not have to fit in memory. """
+
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as inputfile:
+        for block in iter(lambda: inputfile.read(2**20), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+
 def split(filehandler, delimiter=',', row_limit=10000,
           output_name_template='output_%s.csv', output_path='.'):
     """
@@ -43,19 +55,24 @@ def split(filehandler, delimiter=',', row_limit=10000,
     current_piece = 1
     current_out_path = os.path.join(output_name_template % current_piece)
 
-    current_out_writer = csv.writer(open(current_out_path, 'w', newline=''))
+    current_out_file = open(current_out_path, 'w', newline='')
+    current_out_writer = csv.writer(current_out_file)
     current_limit = row_limit
 
     for i, row in enumerate(reader):
         if i + 1 > current_limit:
             print(f"{current_piece}th file is done")
+            current_out_file.close()
 
             current_piece += 1
             current_limit = row_limit * current_piece
             current_out_path = os.path.join(output_name_template % current_piece)
 
-            current_out_writer = csv.writer(open(current_out_path, 'w', newline=''))
+            current_out_file = open(current_out_path, 'w', newline='')
+            current_out_writer = csv.writer(current_out_file)
 
         current_out_writer.writerow(row)
 
+    current_out_file.close()
+
     print(f"Splitted input into {current_piece} different files")
@@ -11,13 +11,17 @@ import numpy as np
 import pandas as pd
 
 import copy
+import itertools
 
-import time
+from numba import jit, prange
 
-from numba import jit
+from constants.constants import MAX_PERMUTATION_ATOMS
 
 
 def make_coordinate_df(df, settings, avg_fragment, radii, again=False):
+    """ Makes the coordinate df if it doesn't already exist. The aligned fragments can be given as one df, or as an
+        iterable of parts, of which the coordinate dfs are calculated one at a time and merged. """
+
     try:
         if again:
             raise KeyError
@@ -25,100 +29,239 @@ def make_coordinate_df(df, settings, avg_fragment, radii, again=False):
         print("Coordinate df already existed, loaded from file")
     except (KeyError, FileNotFoundError):
         print("Searching for nearest atom from central group...")
-        t0 = time.time()
 
-        df = df[df.label == "-"]
+        if isinstance(df, pd.DataFrame):
+            df = [df]
+
+        with settings.profiler.stage('coordinates'):
+            coordinate_df = pd.concat([calc_coordinate_df(part, settings, avg_fragment, radii) for part in df],
+                                      ignore_index=True)
+
+            coordinate_df.to_hdf(settings.get_coordinate_df_filename(), settings.get_coordinate_df_key())
+
+        settings.profiler.add_items('coordinates', len(coordinate_df))
+
+    return coordinate_df
 
-        first_fragment_df = df[df.fragment_id == df.fragment_id.unique()[0]]
 
-        print("Atoms in contact group:", len(first_fragment_df), "atom to count: ", settings.contact_rp)
-        find_closest_contact_atom = False
+def calc_coordinate_df(df, settings, avg_fragment, radii):
+    """ Finds the reference point of each contact group and its distance to the closest atom of the central group
+        model. Every contact group has the same amount of atoms in the same order, so the contact atoms are handled as
+        a matrix of shape (fragments, contact atoms) instead of per group. """
 
-        if settings.contact_rp.lower() == "centroid":
-            # plot centroids of all contact fragments
-            longest_vdw = radii.get_vdw_distance_contact(settings.contact_rp)
-            coordinate_df = df.groupby("fragment_id").mean().reset_index()
+    df = df[df.label == "-"]
 
-        elif len(first_fragment_df[first_fragment_df["symbol"] == settings.contact_rp]) == 1:
-            longest_vdw = radii.get_vdw_distance_contact(settings.contact_rp)
+    no_atoms_contact = count_atoms_per_fragment(df)
+    no_fragments = len(df) // no_atoms_contact
 
-            # atom is unique, plot all of them
-            coordinate_df = df[df.symbol == settings.contact_rp].reset_index().copy()
+    print("Atoms in contact group:", no_atoms_contact, "atom to count: ", settings.contact_rp)
+    longest_vdw = radii.get_vdw_distance_contact(settings.contact_rp)
 
-        else:
-            longest_vdw = radii.get_vdw_distance_contact(settings.contact_rp)
-            coordinate_df = df[df.symbol == settings.contact_rp].reset_index().copy()
+    if settings.contact_rp.lower() == "centroid":
+        # plot centroids of all contact fragments
+        coordinates = np.array([df.x, df.y, df.z]).T.reshape(no_fragments, no_atoms_contact, 3)
+        centroids = coordinates.mean(axis=1)
 
-            # atom is not unique, find closest later
-            find_closest_contact_atom = True
+        coordinate_df = pd.DataFrame({'fragment_id': df.fragment_id.to_numpy()[::no_atoms_contact],
+                                      'x': centroids[:, 0], 'y': centroids[:, 1], 'z': centroids[:, 2]})
 
         coordinate_df = distances_closest_vdw_central(coordinate_df, avg_fragment)
 
-        if find_closest_contact_atom:
-            # find closest atom
-            coordinate_df = coordinate_df.loc[coordinate_df.groupby('fragment_id').distance.idxmin()]\
-                                         .reset_index(drop=True)
+    else:
+        is_contact_rp = (df.symbol == settings.contact_rp).to_numpy()
+        coordinate_df = df[is_contact_rp].reset_index().copy()
+
+        coordinate_df = distances_closest_vdw_central(coordinate_df, avg_fragment)
 
-        coordinate_df['longest_vdw'] = longest_vdw
-        coordinate_df.to_hdf(settings.get_coordinate_df_filename(), settings.get_coordinate_df_key())
+        # if the atom is not unique, only keep the one closest to the central group
+        if is_contact_rp[:no_atoms_contact].sum() != 1:
+            coordinate_df = select_closest_contact_atoms(coordinate_df, is_contact_rp, no_fragments, no_atoms_contact)
 
-        t1 = time.time()
-        print("Coordinate df is made, duration:", t1-t0, 's')
+    coordinate_df['longest_vdw'] = longest_vdw
 
     return coordinate_df
 
 
-def distances_closest_vdw_central(coordinate_df, avg_fragment, labels=""):
-    length = len(coordinate_df)
+def count_atoms_per_fragment(df):
+    """ Returns the amount of atoms per fragment, and checks that it is the same for every fragment. """
+
+    fragment_ids = df.fragment_id.to_numpy()
+    no_atoms = np.argmax(fragment_ids != fragment_ids[0]) or len(fragment_ids)
+
+    assert len(fragment_ids) % no_atoms == 0 and \
+        (fragment_ids.reshape(-1, no_atoms) == fragment_ids[::no_atoms, np.newaxis]).all(), \
+        "Fragments do not all have the same amount of atoms"
+
+    return no_atoms
+
+
+def select_closest_contact_atoms(coordinate_df, is_contact_rp, no_fragments, no_atoms_contact):
+    """ Keeps per fragment the contact atom with the shortest distance to the central group. The distances are put in
+        a (fragments, contact atoms) matrix, in which the atoms that are not the reference point are infinitely far
+        away, so the closest atom is the argmin of each row. """
+
+    positions = np.flatnonzero(is_contact_rp)
 
-    # prepare numpy stuff
-    closest_distances = np.zeros(length)
-    closest_atoms_vdw = np.zeros(length)
+    distances = np.full((no_fragments, no_atoms_contact), np.inf)
+    distances.flat[positions] = coordinate_df.distance
 
-    points_avg_f = np.array([avg_fragment.x, avg_fragment.y, avg_fragment.z]).T
-    vdw_radii = np.array(avg_fragment.vdw_radius)
+    rows = np.full((no_fragments, no_atoms_contact), -1)
+    rows.flat[positions] = np.arange(len(positions))
 
-    xcoord = np.array(coordinate_df.x)
-    ycoord = np.array(coordinate_df.y)
-    zcoord = np.array(coordinate_df.z)
+    closest_atoms = distances.argmin(axis=1)
+    closest_rows = rows[np.arange(no_fragments), closest_atoms]
 
-    # so we can use JIT for the distance calculation
-    closest_atoms_vdw, closest_distances = p_dist_calc(closest_atoms_vdw, closest_distances,
-                                                       xcoord, ycoord, zcoord,
-                                                       length, points_avg_f, vdw_radii)
+    # fragments without the reference point atom are left out
+    closest_rows = closest_rows[closest_rows >= 0]
+
+    return coordinate_df.iloc[closest_rows].reset_index(drop=True)
+
+
+def distances_closest_vdw_central(coordinate_df, avg_fragment, labels=""):
+    """ Returns a new df with the distance to the closest atom of the average fragment and its vdw radius added, the
+        given coordinate df is not changed. """
+
+    points = np.array([coordinate_df.x, coordinate_df.y, coordinate_df.z]).T
+
+    closest_distances, _, closest_atoms_vdw = find_closest_atoms(points, avg_fragment)
 
     # add the label to the column name for fingerprints: so they don't overwrite other columns
-    coordinate_df.loc[:, "distance" + labels] = closest_distances
-    coordinate_df.loc[:, "vdw_closest_atom" + labels] = closest_atoms_vdw
+    return coordinate_df.assign(**{"distance" + labels: closest_distances,
+                                   "vdw_closest_atom" + labels: closest_atoms_vdw})
 
-    return coordinate_df
 
+def find_closest_atoms(points, avg_fragment):
+    """ Returns for every point the distance to the closest atom of the average fragment, the index of that atom in
+        the average fragment and its vdw radius. """
+
+    points_avg_f = np.ascontiguousarray(np.array([avg_fragment.x, avg_fragment.y, avg_fragment.z]).T,
+                                        dtype='float64')
+    vdw_radii = np.array(avg_fragment.vdw_radius, dtype='float64')
 
-@jit(nopython=True)
-def p_dist_calc(closest_atoms_vdw, closest_distances, xcoord, ycoord, zcoord, length, points_avg_f, vdw_radii):
+    closest_distances, closest_atoms = p_dist_calc(np.ascontiguousarray(points, dtype='float64'), points_avg_f)
 
-    for idx in range(length):
+    return closest_distances, closest_atoms, vdw_radii[closest_atoms]
 
-        # grab x, y and z of current contact from np arrays
-        contact_point = np.array([xcoord[idx], ycoord[idx], zcoord[idx]])
 
+@jit(nopython=True, parallel=True, cache=True)
+def p_dist_calc(points, points_avg_f):
+    """ Finds the closest atom of the average fragment for every point. The points are divided over the threads,
+        and the square root is only taken of the shortest distance. """
+
+    length = points.shape[0]
+
+    closest_distances = np.empty(length)
+    closest_atoms = np.empty(length, dtype=np.int64)
+
+    for idx in prange(length):
         # set distance to infinite so you'll find a lower distance soon
-        min_dist = 1000000000
-        min_atom_vdw = None
+        min_dist = np.inf
+        min_atom = -1
 
         # calc distance with every avg fragment point, remember shortest one
-        for i, avg_fragment_point in enumerate(points_avg_f):
-            t_dist = np.sqrt(np.sum((avg_fragment_point - contact_point)**2, axis=0))
+        for i in range(points_avg_f.shape[0]):
+            dx = points_avg_f[i, 0] - points[idx, 0]
+            dy = points_avg_f[i, 1] - points[idx, 1]
+            dz = points_avg_f[i, 2] - points[idx, 2]
+            t_dist = dx * dx + dy * dy + dz * dz
 
-            # also remember the vdw radius of the closest atom
             if t_dist < min_dist:
                 min_dist = t_dist
-                min_atom_vdw = vdw_radii[i]
+                min_atom = i
+
+        closest_distances[idx] = np.sqrt(min_dist)
+        closest_atoms[idx] = min_atom
+
+    return closest_distances, closest_atoms
+
+
+def assign_atoms_to_centers(coordinates, centers):
+    """ Returns for every atom of every fragment the index of a center, so that every fragment uses every center once
+        and the sum of the squared distances of the atoms to their centers is as small as possible. Coordinates has
+        shape (fragments, atoms, 3) and there are as many centers as atoms. """
+
+    no_atoms = coordinates.shape[1]
+    coordinates = np.ascontiguousarray(coordinates, dtype='float64')
+    centers = np.ascontiguousarray(centers, dtype='float64')
 
-        closest_distances[idx] = min_dist
-        closest_atoms_vdw[idx] = min_atom_vdw
+    # small central groups try all permutations of the centers, bigger ones are solved afterwards
+    if no_atoms <= MAX_PERMUTATION_ATOMS:
+        permutations = np.array(list(itertools.permutations(range(no_atoms))), dtype=np.int64)
+    else:
+        permutations = np.empty((0, no_atoms), dtype=np.int64)
+
+    assignments, unsolved = assign_closest_centers(coordinates, centers, permutations)
+
+    if unsolved.any():
+        # scipy is only needed for big central groups
+        from scipy.optimize import linear_sum_assignment
+
+        costs = ((coordinates[unsolved, :, np.newaxis] - centers[np.newaxis, np.newaxis]) ** 2).sum(axis=3)
+        assignments[unsolved] = [linear_sum_assignment(fragment_costs)[1] for fragment_costs in costs]
+
+    return assignments
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def assign_closest_centers(coordinates, centers, permutations):
+    """ Assigns the atoms of each fragment to the centers, the fragments are divided over the threads. If every atom
+        is closest to a different center, that is the best assignment. Otherwise the permutation of the centers with
+        the lowest total squared distance is used, or, if there are no permutations given, the fragment is marked as
+        unsolved. """
+
+    no_fragments, no_atoms = coordinates.shape[0], coordinates.shape[1]
+
+    assignments = np.empty((no_fragments, no_atoms), dtype=np.int64)
+    unsolved = np.zeros(no_fragments, dtype=np.bool_)
+
+    for idx in prange(no_fragments):
+        costs = np.empty((no_atoms, no_atoms))
+        taken = np.zeros(no_atoms, dtype=np.bool_)
+        conflict = False
+
+        for atom in range(no_atoms):
+            min_cost = np.inf
+            min_center = -1
+
+            for center in range(no_atoms):
+                dx = coordinates[idx, atom, 0] - centers[center, 0]
+                dy = coordinates[idx, atom, 1] - centers[center, 1]
+                dz = coordinates[idx, atom, 2] - centers[center, 2]
+                costs[atom, center] = dx * dx + dy * dy + dz * dz
+
+                if costs[atom, center] < min_cost:
+                    min_cost = costs[atom, center]
+                    min_center = center
+
+            assignments[idx, atom] = min_center
+
+            if taken[min_center]:
+                conflict = True
+            taken[min_center] = True
+
+        if not conflict:
+            continue
 
-    return closest_atoms_vdw, closest_distances
+        if permutations.shape[0] == 0:
+            unsolved[idx] = True
+            continue
+
+        min_cost = np.inf
+        min_permutation = 0
+
+        for p in range(permutations.shape[0]):
+            cost = 0.0
+            for atom in range(no_atoms):
+                cost += costs[atom, permutations[p, atom]]
+
+            if cost < min_cost:
+                min_cost = cost
+                min_permutation = p
+
+        for atom in range(no_atoms):
+            assignments[idx, atom] = permutations[min_permutation, atom]
+
+    return assignments, unsolved
 
 
 def get_dihedral_and_h(CSV, central_name):
@@ -231,29 +374,8 @@ def average_fragment(df, settings, radii):
     # take average R vdw radius
     counts = central_group_df[central_group_df['label'].str.contains("R")]['symbol'].value_counts()
 
-    if len(counts) > 0:
-        # TODO: what happens if multiple R?
-        if 'kmeans_label' not in central_group_df.columns:
-            print("\nR consists of:")
-            elements = counts.index.to_list()
-            counts_list = counts.to_list()
-            percentages = [count/np.sum(counts) for count in counts_list]
-
-            for element in elements[:5]:
-                print(element.ljust(10), end="")
-            print("other      ")
-            for percentage in percentages[:5]:
-                print(f"{percentage * 100 :.2f}%    ".ljust(10), end="")
-            print(f'{np.sum(percentages[5:] * 100) :.2f}%\n')
-
-        vdw, cov = 0, 0
-        atoms = 0
-        for i, count in counts.items():
-            atoms += count
-            vdw += count * radii.get_vdw_radius(i)
-            cov += count * radii.get_cov_radius(i)
-        avg_vdw = vdw / atoms
-        avg_cov = cov / atoms
+    if len(counts) > 0 and 'kmeans_label' not in central_group_df.columns:
+        print_R_composition(counts)
 
     if 'kmeans_label' not in central_group_df.columns:
         # sort must be false to preserve the order of the rows/labels
@@ -269,15 +391,40 @@ def average_fragment(df, settings, radii):
                                                                                     'y': 'mean',
                                                                                     'z': 'mean'}).reset_index()
 
-    avg_fragment_df["vdw_radius"] = 0
-    avg_fragment_df["cov_radius"] = 0
+    return add_radii(avg_fragment_df, counts, radii)
+
+
+def print_R_composition(counts):
+    """ Prints which elements the R atoms consist of, given the amount of R atoms of each element. """
+
+    print("\nR consists of:")
+    elements = counts.index.to_list()
+    counts_list = counts.to_list()
+    percentages = [count/np.sum(counts) for count in counts_list]
+
+    for element in elements[:5]:
+        print(element.ljust(10), end="")
+    print("other      ")
+    for percentage in percentages[:5]:
+        print(f"{percentage * 100 :.2f}%    ".ljust(10), end="")
+    print(f'{np.sum(percentages[5:] * 100) :.2f}%\n')
+
+
+def add_radii(avg_fragment_df, counts, radii):
+    """ Adds the vdw and covalent radii to the average fragment. The R atoms get the average radii of the elements
+        they consist of, weighted with the amount of R atoms of each element in counts. """
+
+    vdw_radius = radii.get_vdw_radii(avg_fragment_df.symbol)
+    cov_radius = radii.get_cov_radii(avg_fragment_df.symbol)
+
+    is_R = avg_fragment_df.label.str.contains("R").to_numpy()
+
+    if is_R.any():
+        # TODO: what happens if multiple R?
+        vdw_radius[is_R] = (counts.to_numpy() * radii.get_vdw_radii(counts.index)).sum() / counts.sum()
+        cov_radius[is_R] = (counts.to_numpy() * radii.get_cov_radii(counts.index)).sum() / counts.sum()
 
-    for idx, row in avg_fragment_df.iterrows():
-        if "R" in row.label:
-            avg_fragment_df.loc[idx, "vdw_radius"] = avg_vdw
-            avg_fragment_df.loc[idx, "cov_radius"] = avg_cov
-        else:
-            avg_fragment_df.loc[idx, "vdw_radius"] = radii.get_vdw_radius(row.symbol)
-            avg_fragment_df.loc[idx, "cov_radius"] = radii.get_cov_radius(row.symbol)
+    avg_fragment_df["vdw_radius"] = vdw_radius
+    avg_fragment_df["cov_radius"] = cov_radius
 
     return avg_fragment_df
@@ -13,24 +13,22 @@ import numpy as np
 from mpl_toolkits.mplot3d import Axes3D
 
 
-def plot_density(ax, df, settings):
-    df['ymiddle'] = (df['ystart'] * 2 + settings.resolution) / 2
-    df['xmiddle'] = (df['xstart'] * 2 + settings.resolution) / 2
-    df['zmiddle'] = (df['zstart'] * 2 + settings.resolution) / 2
-
-    # normalize column
-    df[settings.contact_rp + "_normalized"] = df[settings.contact_rp] / df[settings.contact_rp].sum()
+def plot_density(ax, density_grid, settings):
+    fractions = density_grid.get_fractions()
 
     # use threshold to determine lower limit
-    lower_lim = settings.threshold * df[settings.contact_rp + "_normalized"].max()
-    points = df[df[settings.contact_rp + "_normalized"] > lower_lim]
+    lower_lim = settings.threshold * fractions.max()
+    mask = fractions > lower_lim
+
+    centers = density_grid.get_bin_centers(mask)
+    points = fractions[mask]
 
-    norm = plt.Normalize(lower_lim, points[settings.contact_rp + "_normalized"].max())
+    norm = plt.Normalize(lower_lim, points.max())
     cmap = matplotlib.colors.LinearSegmentedColormap.from_list("", ["lightblue", "fuchsia", "red"])
 
-    p = ax.scatter(list(points.xmiddle), list(points.ymiddle), list(points.zmiddle),
-                   s=list(10000 * points[settings.contact_rp + "_normalized"]),
-                   c=list(points[settings.contact_rp + "_normalized"]),
+    p = ax.scatter(centers[:, 0], centers[:, 1], centers[:, 2],
+                   s=10000 * points,
+                   c=points,
                    cmap=cmap,
                    norm=norm)
 
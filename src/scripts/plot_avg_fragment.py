@@ -9,9 +9,8 @@
 
 import sys
 
-import pandas as pd
-
 from classes.Settings import Settings
+from classes.Session import Session
 from helpers.plot_functions import plot_fragment_colored
 
 import matplotlib.pyplot as plt
@@ -29,11 +28,12 @@ def main():
     inputfilename = sys.argv[1]
 
     settings = Settings(WORKDIR, inputfilename)
-    plot_avg_fragment(settings)
+    plot_avg_fragment(Session(settings))
 
 
-def plot_avg_fragment(settings, labels=False):
-    fragment = pd.read_csv(settings.get_avg_frag_filename())
+def plot_avg_fragment(session, labels=False):
+    settings = session.settings
+    fragment = session.get_central_model()
 
     fig = plt.figure()
     ax: Axes3D = fig.add_subplot(111, projection='3d')
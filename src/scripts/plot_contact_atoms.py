@@ -15,8 +15,7 @@ from matplotlib.widgets import Slider
 from mpl_toolkits.mplot3d import Axes3D
 
 from classes.Settings import Settings
-from classes.Radii import Radii
-from helpers.geometry_helpers import (make_coordinate_df)
+from classes.Session import Session
 from constants.colors import AXCOLOR
 from constants.constants import STANDARD_EXTRA_VDW
 
@@ -24,8 +23,6 @@ from helpers.plot_functions import plot_fragment_colored, plot_vdw_spheres
 
 from constants.paths import WORKDIR
 
-import pandas as pd
-
 
 def main():
 
@@ -36,27 +33,24 @@ def main():
     settings = Settings(WORKDIR, sys.argv[1])
     settings.set_contact_reference_point(sys.argv[2])
 
-    df = pd.read_csv(settings.get_aligned_csv_filename())
-
-    avg_fragment = pd.read_csv(settings.get_avg_frag_filename())
-
-    radii = Radii(settings.get_radii_csv_name())
-    coordinate_df = make_coordinate_df(df, settings, avg_fragment, radii)
+    make_contact_rps_plot(Session(settings))
 
-    make_contact_rps_plot(avg_fragment, coordinate_df, settings)
 
-
-def make_contact_rps_plot(avg_fragment, coordinate_df, settings):
+def make_contact_rps_plot(session):
     """ Plot all the surrounding contact groups around the central group. """
 
-    radii = Radii(settings.get_radii_csv_name())
-    vdw_distance_contact = radii.get_vdw_distance_contact(settings.contact_rp)
+    settings = session.settings
+    avg_fragment = session.get_central_model()
+    coordinate_df = session.get_coordinate_df()
+
+    vdw_distance_contact = session.get_radii().get_vdw_distance_contact(settings.contact_rp)
 
     title = "Central fragment: " + settings.central_name + "\n" +\
         "Scattered contact atoms: " + settings.contact_name + "(" + settings.contact_rp + ")"
 
-    # calculate corrected vdw distance
-    coordinate_df["vdw_corr"] = coordinate_df.distance - coordinate_df.vdw_closest_atom - vdw_distance_contact
+    # calculate corrected vdw distance, in a new df so the coordinates of the session are not changed
+    coordinate_df = coordinate_df[['x', 'y', 'z']].assign(vdw_corr=coordinate_df.distance
+                                                          - coordinate_df.vdw_closest_atom - vdw_distance_contact)
 
     fig = plt.figure()
     ax: Axes3D = fig.add_subplot(111, projection='3d')
@@ -13,10 +13,10 @@
 import sys
 
 import matplotlib.pyplot as plt
-import pandas as pd
 from mpl_toolkits.mplot3d import Axes3D
 
 from classes.Settings import Settings
+from classes.Session import Session
 from helpers.plot_functions import plot_density, plot_fragment_colored, plot_vdw_spheres
 
 from constants.paths import WORKDIR
@@ -36,25 +36,31 @@ def main():
 
     settings.set_contact_reference_point(sys.argv[4])
 
+    session = Session(settings)
+
     try:
-        avg_fragment = pd.read_csv(settings.get_avg_frag_filename())
-        density_df = pd.read_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
+        session.get_central_model()
+        session.get_density_grid()
     except (FileNotFoundError, KeyError) as exception:
         print(exception)
         print("Run avg_frag and calc_density first")
         sys.exit(1)
 
-    make_density_plot(avg_fragment, density_df, settings)
+    make_density_plot(session)
+
 
+def make_density_plot(session):
+    settings = session.settings
+    avg_fragment = session.get_central_model()
+    density_grid = session.get_density_grid()
 
-def make_density_plot(avg_fragment, density_df, settings):
     plot_spheres = True
     plotname = settings.get_density_plotname()
     fig = plt.figure()
     ax: Axes3D = fig.add_subplot(111, projection='3d')
 
     ax = plot_fragment_colored(ax, avg_fragment)
-    p, ax = plot_density(ax=ax, df=density_df, settings=settings)
+    p, ax = plot_density(ax=ax, density_grid=density_grid, settings=settings)
 
     if plot_spheres:
         ax, _ = plot_vdw_spheres(avg_fragment, ax)
@@ -10,13 +10,10 @@
 import sys
 import time
 
-import pandas as pd
-
 from classes.Settings import Settings
-from classes.Radii import Radii
+from classes.Session import Session
 from classes.Fingerprint import Fingerprint
 
-from helpers.geometry_helpers import (make_coordinate_df)
 from helpers.geometry_helpers import distances_closest_vdw_central
 
 from constants.paths import WORKDIR
@@ -34,25 +31,30 @@ def main():
     settings = Settings(WORKDIR, sys.argv[1])
     settings.set_contact_reference_point(sys.argv[2])
 
+    session = Session(settings)
+
     try:
-        df = pd.read_csv(settings.get_aligned_csv_filename(), header=0)
-        avg_frag = pd.read_csv(settings.outputfile_prefix + "_avg_fragment.csv", header=0)
+        session.get_aligned_fragments()
+        session.get_central_model()
     except FileNotFoundError:
         print('First align and calculate average fragment.')
         sys.exit(2)
 
-    make_fingerprint_plots(df, avg_frag, settings, STANDARD_EXTRA_VDW)
+    make_fingerprint_plots(session, STANDARD_EXTRA_VDW)
     t1 = time.time() - t0
     print("Duration: %.2f s." % t1)
 
 
-def make_fingerprint_plots(df, avg_frag, settings, STANDARD_EXTRA_VDW):
+def make_fingerprint_plots(session, STANDARD_EXTRA_VDW):
+    settings = session.settings
     fingerprint = Fingerprint(settings)
 
-    radii = Radii(settings.get_radii_csv_name())
-    coordinate_df = make_coordinate_df(df, settings, avg_frag, radii)
-    coordinate_df['moved'] = coordinate_df['distance'] - coordinate_df['vdw_closest_atom']\
-        - coordinate_df['longest_vdw']
+    avg_frag = session.get_central_model()
+
+    # only the columns that are needed, so the coordinates of the session are not changed
+    coordinate_df = session.get_coordinate_df()[['x', 'y', 'z', 'distance', 'vdw_closest_atom', 'longest_vdw']]
+    coordinate_df = coordinate_df.assign(moved=coordinate_df['distance'] - coordinate_df['vdw_closest_atom']
+                                         - coordinate_df['longest_vdw'])
 
     # make first the fingerprint plot with everything
     fingerprint.make_plot(coordinate_df, STANDARD_EXTRA_VDW)
@@ -64,9 +66,9 @@ def make_fingerprint_plots(df, avg_frag, settings, STANDARD_EXTRA_VDW):
 
         coordinate_df_f = distances_closest_vdw_central(coordinate_df, avg_frag_f, labels)
 
-        coordinate_df_f['moved'] = coordinate_df_f['distance' + labels]\
-            - coordinate_df_f['vdw_closest_atom' + labels]\
-            - coordinate_df_f['longest_vdw']
+        coordinate_df_f = coordinate_df_f.assign(moved=coordinate_df_f['distance' + labels]
+                                                 - coordinate_df_f['vdw_closest_atom' + labels]
+                                                 - coordinate_df_f['longest_vdw'])
 
         fingerprint.make_plot(coordinate_df_f, STANDARD_EXTRA_VDW)
 
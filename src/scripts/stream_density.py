@@ -0,0 +1,180 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
+# thesis in the Master Computational Science, University of Amsterdam, 2021.
+#
+# `stream_density.py` goes from the coordinate file to the central group model and the density around it, without
+# saving the aligned fragments. The fragments are read and aligned one chunk at a time. The first pass over the
+# fragments adds the central groups to the model, the second pass adds the contact reference points of each chunk to
+# the density grid. Only one chunk is in memory at the same time, so this works for coordinate files that are bigger
+# than the memory. The aligned fragments are not saved, so the plots of the aligned fragments, the fingerprints and
+# the contact group coordinates can not be made afterwards.
+#
+# Author: Natasja Wezel
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import sys
+
+import numpy as np
+import pandas as pd
+
+from classes.Settings import AlignmentSettings
+from classes.Radii import Radii
+from constants.paths import WORKDIR
+from constants.constants import READ_CHUNK_SIZE, RMSE_TEST, STANDARD_RES
+
+from align_kabsch import iterate_aligned_parts, split_file_if_too_big
+from calc_avg_fragment import calc_kabsch_rmse, calc_avg_rmse, add_model_methyl_if_needed
+
+from helpers.geometry_helpers import calc_coordinate_df, print_R_composition, add_radii
+from helpers.density_helpers import add_to_density_grid
+
+
+def main():
+
+    if len(sys.argv) != 3:
+        print("Usage: python stream_density.py <path/to/coordinatefile> <contact group reference point>")
+        sys.exit(1)
+
+    settings = AlignmentSettings(WORKDIR, sys.argv[1])
+    settings.set_contact_reference_point(sys.argv[2])
+    settings.set_resolution(STANDARD_RES)
+
+    split_file_if_too_big(settings.coordinate_file, settings.no_atoms)
+    settings.update_coordinate_filename()
+
+    radii = Radii(settings.get_radii_csv_name())
+
+    stream_density(settings, radii)
+
+    settings.profiler.print_report()
+
+
+def stream_density(settings, radii, to_mirror=True, chunk_size=READ_CHUNK_SIZE):
+    """ Makes the central group model and the density grid, aligning the fragments chunk by chunk. Both are saved in
+        the same files as in the normal pipeline. Returns the model and the grid. """
+
+    central_model = stream_central_model(settings, radii, to_mirror, chunk_size)
+    central_model.to_csv(settings.get_avg_frag_filename(), index=False)
+
+    density_grid = stream_density_grid(settings, central_model, radii, to_mirror, chunk_size)
+    density_grid.to_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
+
+    return central_model, density_grid
+
+
+def stream_central_model(settings, radii, to_mirror, chunk_size):
+    """ First pass: aligns all fragments and keeps the sum of the coordinates of each central atom, and the amount of
+        R atoms of each element. The structures are saved like in the normal alignment, and the central groups of the
+        first 100 fragments are kept for the rmse test, because the model is only known after the last chunk. """
+
+    print("Making central group model, pass 1/2")
+
+    sums, counts, first_coordinates = None, pd.Series(dtype='int64'), None
+    profiler = settings.profiler
+    structures_csv_filename = settings.get_structure_csv_filename()
+
+    for part, (data, structures) in enumerate(iterate_aligned_parts(settings, to_mirror, chunk_size)):
+        no_fragments = len(structures)
+        no_atoms_central = settings.no_atoms_central
+
+        with profiler.stage('write'):
+            mode, header = ('w', True) if part == 0 else ('a', False)
+            structures.to_csv(structures_csv_filename, index=False, mode=mode, header=header)
+
+        profiler.add_items('write', no_fragments)
+
+        with profiler.stage('average'):
+            coordinates = data[['x', 'y', 'z']].to_numpy().reshape(no_fragments, settings.no_atoms, 3)
+            symbols = data.symbol.to_numpy().reshape(no_fragments, settings.no_atoms)[:, :no_atoms_central]
+
+            labels = np.array(settings.label_list[:no_atoms_central])
+            is_R = np.char.find(labels.astype(str), "R") >= 0
+
+            if sums is None:
+                sums = np.zeros((no_atoms_central, 3))
+                first_symbols = symbols[0]
+                first_coordinates = coordinates[:100, :no_atoms_central].copy()
+
+            sums += coordinates[:, :no_atoms_central].sum(axis=0)
+            counts = counts.add(pd.Series(symbols[:, is_R].ravel()).value_counts(), fill_value=0)
+
+        profiler.add_items('average', no_fragments)
+
+    # without fragments there are no labels and no sums to make the model from
+    if sums is None:
+        print("No fragments were found in " + settings.coordinate_file + ", a central group model can not be made.")
+        sys.exit(1)
+
+    total_fragments = settings.get_no_fragments()
+
+    # labels that occur more than once in a fragment are averaged together, like in average_fragment
+    avg_fragment_df = pd.DataFrame({'label': labels, 'symbol': first_symbols,
+                                    'x': sums[:, 0], 'y': sums[:, 1], 'z': sums[:, 2], 'amount': total_fragments})
+    avg_fragment_df = avg_fragment_df.groupby('label', sort=False).agg({'symbol': 'first', 'x': 'sum', 'y': 'sum',
+                                                                        'z': 'sum', 'amount': 'sum'}).reset_index()
+
+    for column in ['x', 'y', 'z']:
+        avg_fragment_df[column] /= avg_fragment_df['amount']
+    avg_fragment_df = avg_fragment_df.drop(columns='amount')
+
+    counts = counts.astype('int64').sort_values(ascending=False)
+    if len(counts) > 0:
+        print_R_composition(counts)
+
+    with profiler.stage('average'):
+        central_model = add_radii(avg_fragment_df, counts, radii)
+
+        calc_kabsch_rmse(settings)
+        rmses = calc_avg_rmse(central_model, first_coordinates, labels)
+
+    # resetting the labels with kmeans needs all fragments at once, which is exactly what streaming avoids
+    if rmses.mean() > RMSE_TEST:
+        print("RMSEs too high, the labels have to be reset using KMeans. This is not possible while streaming, run " +
+              "the normal pipeline instead.")
+        sys.exit(1)
+
+    with profiler.stage('average'):
+        return add_model_methyl_if_needed(central_model, settings, radii)
+
+
+def stream_density_grid(settings, central_model, radii, to_mirror, chunk_size):
+    """ Second pass: aligns all fragments again, finds the reference point of each contact group in the chunk and
+        adds them to the density grid. """
+
+    print("Making density grid, pass 2/2")
+
+    density_grid, limits = None, None
+
+    profiler = settings.profiler
+
+    for data, _ in iterate_aligned_parts(settings, to_mirror, chunk_size):
+        with profiler.stage('coordinates'):
+            coordinate_df = calc_coordinate_df(data, settings, central_model, radii)
+
+        profiler.add_items('coordinates', len(coordinate_df))
+
+        if len(coordinate_df) == 0:
+            continue
+
+        with profiler.stage('density'):
+            contact_coordinates = np.transpose(np.array([coordinate_df.x,
+                                                         coordinate_df.y,
+                                                         coordinate_df.z], dtype='float64'))
+
+            minimum, maximum = contact_coordinates.min(axis=0), contact_coordinates.max(axis=0)
+            if limits is not None:
+                minimum, maximum = np.minimum(minimum, limits[0]), np.maximum(maximum, limits[1])
+            limits = minimum, maximum
+
+            density_grid = add_to_density_grid(density_grid, contact_coordinates, limits, settings.resolution,
+                                               settings.contact_rp)
+
+        profiler.add_items('density', len(contact_coordinates))
+
+    assert density_grid is not None, "No contact reference points found"
+
+    return density_grid
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
+# thesis in the Master Computational Science, University of Amsterdam, 2021.
+#
+# `benchmark.py` times the slowest functions of the pipeline on synthetic datasets of increasing size, made with
+# generate_conquest_data.py. For every function and size it reports the time, the throughput per fragment or point,
+# and how the time scales with the size. The results can be saved as a baseline, and every later run is compared to
+# it, so a change that makes a function slower is noticed. Timings depend on the machine, so only compare to a
+# baseline that was made on the same machine. Run it from the tools folder, like the other tools.
+#
+# Author: Natasja Wezel
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+
+import matplotlib
+import numpy as np
+
+# the fingerprint plots are only saved, never shown
+matplotlib.use('Agg')
+
+sys.path.append('../scripts')
+
+from classes.Settings import AlignmentSettings
+from classes.Radii import Radii
+from classes.Session import Session
+from constants.paths import WORKDIR
+from constants.constants import STANDARD_EXTRA_VDW
+
+from align_kabsch import prepare_data, rotate_first_fragment, do_kabsch_align
+from calc_avg_fragment import reset_labels_with_kmeans
+from plot_fingerprint import make_fingerprint_plots
+
+from helpers.alignment_helpers import read_raw_data
+from helpers.geometry_helpers import average_fragment, p_dist_calc
+from helpers.density_helpers import calculate_no_bins, fill_bins, calc_vdw_volumes
+
+import generate_conquest_data
+
+BENCHMARKS = ['read_raw_data', 'do_kabsch_align', 'do_rotation_align', 'reset_labels_with_kmeans', 'p_dist_calc',
+              'fill_bins', 'calc_vdw_volumes', 'make_fingerprint_plots']
+
+
+def main():
+    parser = initiate_parser()
+    args = parser.parse_args()
+
+    sizes = sorted(int(float(size)) for size in args.sizes.split(','))
+    benchmarks = BENCHMARKS if args.benchmarks is None else args.benchmarks.split(',')
+
+    folder = args.workdir + "\\results\\benchmark\\"
+    baseline_filename = args.baseline if args.baseline is not None else folder + "baseline.json"
+
+    # the first run also compiles the numba functions, so it is done once on the smallest size and thrown away
+    print("Warming up...")
+    run_benchmarks(benchmarks, make_inputs(args.workdir, folder, min(sizes), args), args, repeat=1)
+
+    results = []
+    for size in sizes:
+        print(f"Benchmarking {size} fragments...")
+        results += run_benchmarks(benchmarks, make_inputs(args.workdir, folder, size, args), args, args.repeat)
+
+    add_scaling(results)
+    slower = compare_to_baseline(results, baseline_filename, args.tolerance)
+
+    print_results(results)
+
+    report = {'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+              'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                          'cpu_count': os.cpu_count(), 'python': platform.python_version(),
+                          'numpy': np.__version__},
+              'resolution': args.resolution,
+              'results': results}
+
+    report_filename = folder + "benchmark_" + time.strftime("%Y%m%d_%H%M%S") + ".json"
+    save_json(report_filename, report)
+    print(f"Results saved in {report_filename}")
+
+    if args.save:
+        save_json(baseline_filename, report)
+        print(f"Saved as baseline in {baseline_filename}")
+
+    if len(slower) > 0:
+        print(f"\n{len(slower)} benchmark(s) are more than {args.tolerance * 100 :.0f}% slower than the baseline:")
+        for result in slower:
+            print(f"\t{result['benchmark']} ({result['size']}): {result['time']:.4f} s, " +
+                  f"baseline {result['baseline']:.4f} s")
+        sys.exit(1)
+
+
+def make_inputs(workdir, folder, size, args):
+    """ Makes the synthetic dataset of this size if it doesn't exist yet, and the settings to read it. The dataset
+        always has the same seed, so every run uses exactly the same fragments. """
+
+    os.makedirs(folder, exist_ok=True)
+
+    name = f"NO3_R2CO_synthetic_{size}"
+    coordinate_file = folder + name + ".cor"
+
+    if not os.path.exists(coordinate_file):
+        generator_args = generate_conquest_data.initiate_parser().parse_args(['NO3', 'R2CO', '-s', str(args.seed)])
+        central_group = generate_conquest_data.get_central_group('NO3', workdir + "\\src\\files\\central_groups.csv")
+        directions = generate_conquest_data.parse_directions(generator_args.directions)
+
+        generate_conquest_data.generate(central_group, generate_conquest_data.CONTACT_GROUPS['R2CO'], size,
+                                        directions, generator_args, coordinate_file, folder + name + ".csv")
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        settings = AlignmentSettings(workdir, coordinate_file)
+
+    settings.set_contact_reference_point('O')
+    settings.set_resolution(args.resolution)
+
+    return {'settings': settings, 'coordinate_file': coordinate_file, 'size': size,
+            'radii': Radii(settings.get_radii_csv_name())}
+
+
+def run_benchmarks(benchmarks, inputs, args, repeat):
+    """ Runs the benchmarks in order. Every benchmark uses the output of the ones before it as its input, like in
+        the pipeline. """
+
+    results = []
+
+    for benchmark in benchmarks:
+        setup, function, items, unit = BENCHMARK_FUNCTIONS[benchmark](inputs)
+
+        if function is None:
+            results.append({'benchmark': benchmark, 'size': inputs['size'], 'skipped': setup})
+            continue
+
+        times = []
+        for _ in range(repeat):
+            arguments = setup()
+
+            # the functions print their progress, which is not part of the benchmark
+            with contextlib.redirect_stdout(io.StringIO()):
+                t0 = time.perf_counter()
+                function(*arguments)
+                times.append(time.perf_counter() - t0)
+
+        results.append({'benchmark': benchmark, 'size': inputs['size'], 'time': min(times), 'items': items,
+                        'unit': unit, 'throughput': items / min(times)})
+
+    return results
+
+
+def benchmark_read_raw_data(inputs):
+    settings = inputs['settings']
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        inputs['data'], inputs['structures'] = read_raw_data(inputs['coordinate_file'], settings.no_atoms_file)
+
+    def setup():
+        return inputs['coordinate_file'], settings.no_atoms_file
+
+    return setup, read_raw_data, inputs['size'], 'fragment'
+
+
+def benchmark_do_kabsch_align(inputs):
+    settings = inputs['settings']
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        settings, _, data = prepare_data(settings, inputs['data'].copy())
+
+    data_matrix = np.array([np.array(data.x), np.array(data.y), np.array(data.z)]).T
+    structures, data_matrix, first_fragment = rotate_first_fragment(settings, data_matrix,
+                                                                    inputs['structures'].copy(), True)
+
+    # the aligned fragments are the input of the benchmarks after this one
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, aligned_matrix = do_kabsch_align(settings, data_matrix.copy(), structures.copy(), first_fragment, True)
+    data.x, data.y, data.z = aligned_matrix.T
+    inputs['aligned'] = data
+
+    def setup():
+        return settings, data_matrix.copy(), structures.copy(), first_fragment, True
+
+    return setup, do_kabsch_align, inputs['size'], 'fragment'
+
+
+def benchmark_do_rotation_align(inputs):
+    try:
+        from align_rotation import do_rotation_align
+    except ImportError as error:
+        return f"align_rotation can not be imported: {error}", None, None, None
+
+    settings = inputs['settings']
+
+    data = inputs['data']
+    data_matrix = np.array([np.array(data.x), np.array(data.y), np.array(data.z)]).T
+    structures, data_matrix, first_fragment = rotate_first_fragment(settings, data_matrix,
+                                                                    inputs['structures'].copy(), True)
+
+    def setup():
+        return settings, data_matrix.copy(), structures.copy(), first_fragment, True
+
+    return setup, do_rotation_align, inputs['size'], 'fragment'
+
+
+def benchmark_reset_labels_with_kmeans(inputs):
+    def setup():
+        return inputs['aligned'], inputs['settings']
+
+    return setup, reset_labels_with_kmeans, inputs['size'], 'fragment'
+
+
+def get_contact_points(inputs):
+    """ The contact reference points and the model of the central group, made from the aligned fragments. """
+
+    if 'contact_points' not in inputs:
+        aligned = inputs['aligned']
+        contact = aligned[(aligned.label == '-') & (aligned.symbol == 'O')]
+
+        inputs['contact_points'] = np.array([contact.x, contact.y, contact.z], dtype='float64').T
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            inputs['avg_fragment'] = average_fragment(aligned, inputs['settings'], inputs['radii'])
+
+    return inputs['contact_points'], inputs['avg_fragment']
+
+
+def benchmark_p_dist_calc(inputs):
+    points, avg_fragment = get_contact_points(inputs)
+    points_avg_f = np.array([avg_fragment.x, avg_fragment.y, avg_fragment.z], dtype='float64').T
+
+    def setup():
+        return points, points_avg_f
+
+    return setup, p_dist_calc, len(points), 'point'
+
+
+def benchmark_fill_bins(inputs):
+    points, _ = get_contact_points(inputs)
+    resolution = inputs['settings'].resolution
+
+    shape, origin = [], []
+    for minimum, maximum in zip(points.min(axis=0), points.max(axis=0)):
+        no_bins, minimum, _ = calculate_no_bins(resolution, [minimum, maximum])
+        shape.append(no_bins)
+        origin.append(minimum)
+
+    def setup():
+        return points, np.array(origin), resolution, tuple(shape)
+
+    return setup, fill_bins, len(points), 'point'
+
+
+def benchmark_calc_vdw_volumes(inputs):
+    _, avg_fragment = get_contact_points(inputs)
+    extra = STANDARD_EXTRA_VDW + inputs['radii'].get_vdw_distance_contact('O')
+
+    def setup():
+        return avg_fragment, extra, inputs['settings'].resolution
+
+    # the volumes only depend on the model, not on the amount of fragments
+    return setup, calc_vdw_volumes, 1, 'model'
+
+
+def benchmark_make_fingerprint_plots(inputs):
+    settings = inputs['settings']
+    _, avg_fragment = get_contact_points(inputs)
+
+    def setup():
+        # the contact coordinates would otherwise be loaded from the previous run
+        if os.path.exists(settings.get_coordinate_df_filename()):
+            os.remove(settings.get_coordinate_df_filename())
+
+        # a new session, so the coordinates are made from the aligned fragments every repeat
+        session = Session(settings)
+        session.set_aligned_fragments(inputs['aligned'])
+        session.set_central_model(avg_fragment)
+        session.set_radii(inputs['radii'])
+
+        return session, STANDARD_EXTRA_VDW
+
+    return setup, make_fingerprint_plots, inputs['size'], 'fragment'
+
+
+BENCHMARK_FUNCTIONS = {'read_raw_data': benchmark_read_raw_data,
+                       'do_kabsch_align': benchmark_do_kabsch_align,
+                       'do_rotation_align': benchmark_do_rotation_align,
+                       'reset_labels_with_kmeans': benchmark_reset_labels_with_kmeans,
+                       'p_dist_calc': benchmark_p_dist_calc,
+                       'fill_bins': benchmark_fill_bins,
+                       'calc_vdw_volumes': benchmark_calc_vdw_volumes,
+                       'make_fingerprint_plots': benchmark_make_fingerprint_plots}
+
+
+def add_scaling(results):
+    """ Adds the scaling exponent of each benchmark to its results: the slope of log(time) against log(size). An
+        exponent of 1 means the time grows linearly with the size. """
+
+    for benchmark in BENCHMARKS:
+        timed = [result for result in results if result['benchmark'] == benchmark and 'time' in result]
+
+        if len(timed) < 2:
+            continue
+
+        exponent = np.polyfit(np.log([result['size'] for result in timed]),
+                              np.log([result['time'] for result in timed]), 1)[0]
+
+        for result in timed:
+            result['scaling'] = float(exponent)
+
+
+def compare_to_baseline(results, baseline_filename, tolerance):
+    """ Adds the time of the baseline to each result, and returns the results that are slower than the baseline by
+        more than the tolerance. """
+
+    if not os.path.exists(baseline_filename):
+        return []
+
+    with open(baseline_filename) as inputfile:
+        baseline = {(result['benchmark'], result['size']): result.get('time')
+                    for result in json.load(inputfile)['results']}
+
+    slower = []
+    for result in results:
+        baseline_time = baseline.get((result['benchmark'], result['size']))
+
+        if baseline_time is None or 'time' not in result:
+            continue
+
+        result['baseline'] = baseline_time
+        if result['time'] > baseline_time * (1 + tolerance):
+            slower.append(result)
+
+    return slower
+
+
+def print_results(results):
+    print(f"\n{'benchmark':<26}{'size':>10}{'time (s)':>12}{'throughput':>22}{'scaling':>10}{'vs baseline':>14}")
+
+    for result in results:
+        if 'skipped' in result:
+            print(f"{result['benchmark']:<26}{result['size']:>10}   skipped: {result['skipped']}")
+            continue
+
+        throughput = f"{result['throughput']:.3g} {result['unit']}/s"
+        scaling = f"{result['scaling']:.2f}" if 'scaling' in result else "-"
+        change = f"{(result['time'] / result['baseline'] - 1) * 100:+.0f}%" if 'baseline' in result else "-"
+
+        print(f"{result['benchmark']:<26}{result['size']:>10}{result['time']:>12.4f}{throughput:>22}{scaling:>10}" +
+              f"{change:>14}")
+
+    print()
+
+
+def save_json(filename, report):
+    with open(filename, 'w') as outputfile:
+        json.dump(report, outputfile, indent=4)
+
+
+def initiate_parser():
+    parser = argparse.ArgumentParser(description='Times the slowest functions of the pipeline.')
+
+    parser.add_argument('-n', '--sizes', default='1000,10000,100000', help='amounts of fragments, separated by\
+                        commas (default 1000,10000,100000)')
+    parser.add_argument('-b', '--benchmarks', help=f"benchmarks to run, separated by commas (default all:\
+                        {', '.join(BENCHMARKS)})")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='times every benchmark is run, the fastest time\
+                        counts (default 3)')
+    parser.add_argument('--resolution', type=float, default=0.2, help='resolution of the density grid and volumes\
+                        (default 0.2)')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--baseline', help='baseline file (default results/benchmark/baseline.json)')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2, help='fraction a benchmark may be slower than\
+                        the baseline (default 0.2)')
+    parser.add_argument('-w', '--workdir', default=WORKDIR, help='main folder of the project (default ../..)')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='seed of the synthetic datasets (default 0)')
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
+# thesis in the Master Computational Science, University of Amsterdam, 2021.
+#
+# `generate_conquest_data.py` makes a synthetic coordinate file and label file in the layout of a conquest export, of
+# any size, so the pipeline can be tested at scale without access to the CSD. Every fragment is a central group with
+# a bit of noise on its atoms, and one contact group. The contact groups are placed around the central group in
+# lobes of a chosen direction and spread, plus an isotropic background, and then the whole fragment is moved to a
+# random place with a random rotation, like fragments in a crystal structure.
+#
+# Author: Natasja Wezel
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import argparse
+import os
+import string
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+# geometries of the central groups in central_groups.csv: label, element and coordinates in angstrom
+CENTRAL_GROUPS = {
+    'NO3': [('LAB2', 'N', 0.0, 0.0, 0.0),
+            ('LAB1', 'O', 0.0, 1.25, 0.0),
+            ('LAB3', 'O', 1.0825, -0.625, 0.0),
+            ('LAB4', 'O', -1.0825, -0.625, 0.0)],
+    'H2O': [('LAB1', 'H', 0.7572, 0.5865, 0.0),
+            ('LAB2', 'O', 0.0, 0.0, 0.0),
+            ('LAB3', 'H', -0.7572, 0.5865, 0.0)],
+}
+
+# contact groups: element and distance behind the placed point, away from the central group, in angstrom
+CONTACT_GROUPS = {
+    'R2CO': [('O', 0.0), ('C', 1.22)],
+    'XH': [('N', 1.01), ('H', 0.0)],
+}
+
+CHUNK_SIZE = 100000         # amount of fragments that is made and written at once
+MIN_DISTANCE = 2.5          # minimal distance of the placed contact atom to the atoms of the central group
+CELL_SIZE = 20              # fragments are moved to a random place in a box of this size (angstrom)
+
+
+def main():
+    parser = initiate_parser()
+    args = parser.parse_args()
+
+    t0 = time.time()
+
+    central_group = get_central_group(args.central, args.central_groups, args.model)
+
+    if args.contact not in CONTACT_GROUPS:
+        print(f"Unknown contact group {args.contact}, choose from {', '.join(CONTACT_GROUPS)}")
+        sys.exit(1)
+
+    no_fragments = int(float(args.fragments))
+    directions = parse_directions(args.directions)
+
+    name = f"{args.central}_{args.contact}_synthetic_{no_fragments}"
+    coordinate_filename = os.path.join(args.output, name + ".cor")
+    label_filename = os.path.join(args.output, name + ".csv")
+
+    generate(central_group, CONTACT_GROUPS[args.contact], no_fragments, directions, args, coordinate_filename,
+             label_filename)
+
+    t1 = time.time() - t0
+    print(f"Made {no_fragments} fragments in {coordinate_filename} and {label_filename}")
+    print("Duration: %.2f s." % t1)
+
+
+def get_central_group(central, central_groups_filename, model_filename=None):
+    """ Returns the template of the central group as a dataframe with the columns label, symbol, x, y and z. The
+        geometry comes from a central group model made by the pipeline if it is given, otherwise from the built in
+        geometries. The central group has to be in central_groups.csv, with all labels it uses for the alignment. """
+
+    central_groups = pd.read_csv(central_groups_filename, comment="#")
+    central_groups = central_groups[central_groups.name == central]
+
+    if len(central_groups) == 0:
+        print(f"Central group {central} is not in {central_groups_filename}")
+        sys.exit(1)
+
+    if model_filename is not None:
+        template = pd.read_csv(model_filename)[['label', 'symbol', 'x', 'y', 'z']]
+    elif central in CENTRAL_GROUPS:
+        template = pd.DataFrame(CENTRAL_GROUPS[central], columns=['label', 'symbol', 'x', 'y', 'z'])
+    else:
+        print(f"No geometry known for {central}, give a central group model with -m")
+        sys.exit(1)
+
+    alignment_labels = central_groups[['center_label', 'y_axis_label', 'xy_plane_label']].iloc[0]
+    missing = [label for label in alignment_labels if label not in list(template.label)]
+    assert len(missing) == 0, f"The template of {central} misses the alignment labels {missing}"
+
+    return template
+
+
+def parse_directions(directions):
+    """ Makes unit vectors of directions written as 'x,y,z;x,y,z'. """
+
+    directions = np.array([[float(value) for value in direction.split(',')] for direction in directions.split(';')])
+
+    return directions / np.linalg.norm(directions, axis=1)[:, np.newaxis]
+
+
+def generate(central_group, contact_group, no_fragments, directions, args, coordinate_filename, label_filename):
+    """ Makes the fragments chunk by chunk and appends them to the coordinate and label file, so files of millions
+        of fragments can be made with a constant amount of memory. """
+
+    rng = np.random.default_rng(args.seed)
+
+    central_coordinates = central_group[['x', 'y', 'z']].to_numpy(dtype=float)
+    central_coordinates -= central_coordinates.mean(axis=0)
+
+    atom_ids = make_atom_ids(list(central_group.symbol) + [symbol for symbol, _ in contact_group])
+    line_template = make_line_template(atom_ids)
+
+    with open(coordinate_filename, 'w') as coordinate_file, open(label_filename, 'w') as label_file:
+        label_file.write("Query, Refcode," + ",".join(f"{label:<6}" for label in central_group.label) +
+                         ",DIST1 \n")
+
+        for start in range(0, no_fragments, CHUNK_SIZE):
+            amount = min(CHUNK_SIZE, no_fragments - start)
+
+            coordinates, distances = make_fragments(rng, central_coordinates, contact_group, amount, directions,
+                                                    args)
+            refcodes, fragment_numbers = make_refcodes(rng, amount)
+
+            write_coordinates(coordinate_file, line_template, coordinates, refcodes, fragment_numbers)
+            write_labels(label_file, atom_ids[:len(central_group)], refcodes, distances)
+
+
+def make_fragments(rng, central_coordinates, contact_group, amount, directions, args):
+    """ Returns the coordinates of amount fragments as an array of shape (amount, atoms, 3), and the distance of
+        each placed contact atom to the closest atom of its central group. """
+
+    # pick for each contact group a direction: around one of the lobes, or any direction for the background
+    lobes = rng.integers(0, len(directions), amount)
+    outward = directions[lobes] + np.radians(args.spread) * rng.standard_normal((amount, 3))
+
+    background = rng.random(amount) < args.background
+    outward[background] = rng.standard_normal((background.sum(), 3))
+    outward /= np.linalg.norm(outward, axis=1)[:, np.newaxis]
+
+    # distance from the middle of the central group, at least MIN_DISTANCE from all of its atoms
+    distances = rng.normal(args.distance, args.distance_sd, amount)
+    distances = np.maximum(distances, min_distance_on_ray(central_coordinates, outward, MIN_DISTANCE))
+
+    points = outward * distances[:, np.newaxis]
+    contact = np.stack([points + outward * offset for _, offset in contact_group], axis=1)
+
+    central = np.broadcast_to(central_coordinates, (amount,) + central_coordinates.shape)
+    fragments = np.concatenate([central, contact], axis=1)
+    fragments = fragments + args.noise * rng.standard_normal(fragments.shape)
+
+    # move every fragment with a random rotation and translation
+    rotations = random_rotations(rng, amount)
+    fragments = np.einsum('fij,faj->fai', rotations, fragments) + \
+        rng.uniform(0, CELL_SIZE, (amount, 1, 3))
+
+    closest = np.linalg.norm(points[:, np.newaxis] - central_coordinates[np.newaxis], axis=2).min(axis=1)
+
+    return fragments, closest
+
+
+def min_distance_on_ray(atoms, directions, min_distance):
+    """ Returns for each ray from the origin the smallest distance along it at which the point is at least
+        min_distance away from all atoms. """
+
+    # projection of each atom on each ray, and the distance of the atom to the ray
+    along = directions @ atoms.T
+    perpendicular = np.sum(atoms ** 2, axis=1)[np.newaxis] - along ** 2
+
+    # on the ray, the point is too close to an atom between along - reach and along + reach
+    reach = np.sqrt(np.maximum(min_distance ** 2 - perpendicular, 0))
+    reach[perpendicular >= min_distance ** 2] = -np.inf
+
+    return np.max(along + reach, axis=1, initial=0)
+
+
+def random_rotations(rng, amount):
+    """ Returns amount uniformly distributed rotation matrices, made from random unit quaternions. """
+
+    q = rng.standard_normal((amount, 4))
+    w, x, y, z = (q / np.linalg.norm(q, axis=1)[:, np.newaxis]).T
+
+    return np.stack([np.stack([1 - 2 * (y**2 + z**2), 2 * (x*y - z*w), 2 * (x*z + y*w)], axis=1),
+                     np.stack([2 * (x*y + z*w), 1 - 2 * (x**2 + z**2), 2 * (y*z - x*w)], axis=1),
+                     np.stack([2 * (x*z - y*w), 2 * (y*z + x*w), 1 - 2 * (x**2 + y**2)], axis=1)], axis=1)
+
+
+def make_atom_ids(symbols):
+    """ Numbers the atoms per element, like conquest does: N1, O1, O2, ... """
+
+    counts = {}
+    atom_ids = []
+
+    for symbol in symbols:
+        counts[symbol] = counts.get(symbol, 0) + 1
+        atom_ids.append(symbol + str(counts[symbol]))
+
+    return atom_ids
+
+
+def make_line_template(atom_ids):
+    """ Makes the format of one fragment: a header with the refcode and fragment number, and a line per atom with its
+        id, coordinates and a number. """
+
+    template = "%-8s**FRAG**%9d\n"
+    for i, atom_id in enumerate(atom_ids):
+        template += f"{atom_id:<8}%12.5f%10.5f%10.5f{1555001 + i:>12}\n"
+
+    return template
+
+
+def make_refcodes(rng, amount):
+    """ Makes random refcodes, where one structure often contains several fragments. These are numbered per
+        structure, like in conquest. """
+
+    letters = np.array(list(string.ascii_uppercase))
+    no_structures = max(1, amount // 3)
+
+    refcodes = np.array(["".join(code) for code in letters[rng.integers(0, 26, (no_structures, 6))]])
+    refcodes = np.sort(refcodes[rng.integers(0, no_structures, amount)])
+
+    # number the fragments within each structure, starting at 1
+    first = np.r_[True, refcodes[1:] != refcodes[:-1]]
+    starts = np.flatnonzero(first)
+    fragment_numbers = np.arange(amount) - np.repeat(starts, np.diff(np.r_[starts, amount])) + 1
+
+    return refcodes, fragment_numbers
+
+
+def write_coordinates(outputfile, line_template, coordinates, refcodes, fragment_numbers):
+    values = coordinates.reshape(len(coordinates), -1).tolist()
+
+    outputfile.write("".join(line_template % (refcode, number, *fragment)
+                             for refcode, number, fragment in zip(refcodes, fragment_numbers.tolist(), values)))
+
+
+def write_labels(outputfile, central_atom_ids, refcodes, distances):
+    labels = pd.DataFrame({'query': 1, 'refcode': refcodes})
+
+    for i, atom_id in enumerate(central_atom_ids):
+        labels[i] = atom_id
+
+    labels['distance'] = np.round(distances, 3)
+
+    labels.to_csv(outputfile, index=False, header=False)
+
+
+def initiate_parser():
+    parser = argparse.ArgumentParser(description='Makes a synthetic conquest coordinate file and label file.')
+
+    parser.add_argument('central', help='name of the central group, as in central_groups.csv')
+    parser.add_argument('contact', help=f"name of the contact group ({', '.join(CONTACT_GROUPS)})")
+    parser.add_argument('-n', '--fragments', default='1000', help='amount of fragments, for example 1000 or 1e7\
+                        (default 1000)')
+    parser.add_argument('-o', '--output', default='.', help='folder to save the files in (default .)')
+    parser.add_argument('-g', '--central_groups', default=os.path.join('..', 'files', 'central_groups.csv'),
+                        help='central groups file (default ../files/central_groups.csv)')
+    parser.add_argument('-m', '--model', help='central group model made by the pipeline (avg_fragment.csv), to use\
+                        its geometry instead of the built in one')
+    parser.add_argument('-d', '--directions', default='0,0,1;0,0,-1', help='directions of the lobes of contact\
+                        groups in the frame of the central group, as x,y,z;x,y,z (default 0,0,1;0,0,-1)')
+    parser.add_argument('--spread', type=float, default=20, help='spread of each lobe in degrees (default 20)')
+    parser.add_argument('--background', type=float, default=0.2, help='fraction of contact groups that is placed in\
+                        any direction (default 0.2)')
+    parser.add_argument('--distance', type=float, default=3.3, help='mean distance of the contact atom to the middle\
+                        of the central group in angstrom (default 3.3)')
+    parser.add_argument('--distance_sd', type=float, default=0.3, help='standard deviation of that distance\
+                        (default 0.3)')
+    parser.add_argument('--noise', type=float, default=0.02, help='standard deviation of the noise on every atom in\
+                        angstrom (default 0.02)')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='seed of the random generator (default 0)')
+
+    return parser
+
+
+if __name__ == "__main__":
+    main()